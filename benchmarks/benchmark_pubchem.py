@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+Throughput and latency benchmarks for PubChem methods.
+
+Requests are answered by a local stand-in for the PubChem services, so
+results are reproducible and do not depend on network conditions or the
+PubChem queue. Use --latency, --job-time and --failure-rate to simulate
+remote conditions.
+"""
+import argparse
+import numpy as np
+import time
+
+from pubchem_utils import PubChem
+from pubchem_utils.pug import ExponentialBackoff
+from pubchem_utils.test.server import PubChemServer
+
+__author__ = "Steven Kearnes"
+__copyright__ = "Copyright 2014, Stanford University"
+__license__ = "3-clause BSD"
+
+
+def parse_args(input_args=None):
+    """
+    Parse command-line arguments.
+
+    Parameters
+    ----------
+    input_args : list, optional
+        Input arguments. If not provided, defaults to sys.argv[1:].
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Benchmarks to run. If not provided, all ' +
+                             'benchmarks are run. Choices: ' +
+                             ', '.join(sorted(BENCHMARKS)) + '.')
+    parser.add_argument('-n', '--n-ids', type=int, default=10000,
+                        help='Number of IDs per request.')
+    parser.add_argument('-r', '--repeats', type=int, default=5,
+                        help='Number of times to run each benchmark.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Server latency per request, in seconds.')
+    parser.add_argument('--job-time', type=float, default=0,
+                        help='Number of seconds before PUG queries ' +
+                             'complete.')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='Fraction of requests that fail with HTTP 503.')
+    parser.add_argument('--backoff', action='store_true',
+                        help='Poll with exponential backoff instead of a ' +
+                             'fixed delay.')
+    parser.add_argument('-d', '--delay', type=float, default=0.1,
+                        help='Number of seconds to wait between status ' +
+                             'checks.')
+    return parser.parse_args(input_args)
+
+
+def get_records(engine, server, n_ids):
+    """
+    Download SDF records with a single PUG query.
+    """
+    return lambda: engine.get_records(xrange(1, n_ids + 1)), n_ids
+
+
+def get_records_chunked(engine, server, n_ids):
+    """
+    Download SDF records with concurrent chunked PUG queries.
+    """
+    chunk_size = max(1, n_ids // 4)
+    return lambda: engine.get_records(xrange(1, n_ids + 1),
+                                      chunk_size=chunk_size,
+                                      max_in_flight=4), n_ids
+
+
+def get_records_rest(engine, server, n_ids):
+    """
+    Download SDF records with batched PUG REST requests.
+    """
+    return lambda: engine.get_records_rest(xrange(1, n_ids + 1),
+                                           n_jobs=4), n_ids
+
+
+def id_exchange(engine, server, n_ids):
+    """
+    Map registry IDs to CIDs.
+    """
+    ids = ['CHEMBL{}'.format(i) for i in xrange(1, n_ids + 1)]
+    return lambda: engine.id_exchange(ids), n_ids
+
+
+def get_assay_data(engine, server, n_ids):
+    """
+    Download an assay data table.
+    """
+    server.n_assay_ids = n_ids
+    return lambda: engine.get_assay_data(466), n_ids
+
+
+def get_ids_from_assay(engine, server, n_ids):
+    """
+    Retrieve IDs tested in an assay.
+    """
+    server.n_assay_ids = n_ids
+    return lambda: engine.get_ids_from_assay(466), n_ids
+
+
+def structure_search(engine, server, n_ids):
+    """
+    Search for a single structure.
+    """
+    return lambda: engine.structure_search('CC(=O)OC1=CC=CC=C1C(=O)O'), 1
+
+
+def get_assay_descriptions(engine, server, n_ids):
+    """
+    Retrieve assay descriptions.
+    """
+    n_aids = max(1, n_ids // 10)
+    return lambda: engine.get_assay_descriptions(range(1, n_aids + 1)), n_aids
+
+
+BENCHMARKS = {
+    'get_records': get_records,
+    'get_records_chunked': get_records_chunked,
+    'get_records_rest': get_records_rest,
+    'id_exchange': id_exchange,
+    'get_assay_data': get_assay_data,
+    'get_ids_from_assay': get_ids_from_assay,
+    'structure_search': structure_search,
+    'get_assay_descriptions': get_assay_descriptions,
+}
+
+
+def run_benchmark(func, repeats):
+    """
+    Time repeated calls to a function.
+
+    Parameters
+    ----------
+    func : callable
+        Function to time.
+    repeats : int
+        Number of calls.
+
+    Returns
+    -------
+    times : ndarray
+        Duration of each call, in seconds.
+    """
+    times = []
+    for _ in xrange(repeats):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return np.asarray(times)
+
+
+def main(benchmarks=None, n_ids=10000, repeats=5, latency=0, job_time=0,
+         failure_rate=0, backoff=False, delay=0.1):
+    """
+    Run benchmarks and report throughput and latency.
+
+    Parameters
+    ----------
+    benchmarks : list, optional
+        Benchmarks to run. If not provided, all benchmarks are run.
+    n_ids : int, optional (default 10000)
+        Number of IDs per request.
+    repeats : int, optional (default 5)
+        Number of times to run each benchmark.
+    latency : float, optional (default 0)
+        Server latency per request, in seconds.
+    job_time : float, optional (default 0)
+        Number of seconds before PUG queries complete.
+    failure_rate : float, optional (default 0)
+        Fraction of requests that fail with HTTP 503.
+    backoff : bool, optional (default False)
+        Whether to poll with exponential backoff.
+    delay : float, optional (default 0.1)
+        Number of seconds to wait between status checks (or before the
+        first status check, with backoff).
+    """
+    if not benchmarks:
+        benchmarks = sorted(BENCHMARKS)
+    if backoff:
+        delay = ExponentialBackoff(initial=delay)
+    print '{:<24}{:>10}{:>12}{:>12}{:>14}'.format(
+        'benchmark', 'items', 'median (s)', 'p90 (s)', 'items/s')
+    with PubChemServer(latency=latency, job_time=job_time,
+                       failure_rate=failure_rate, seed=0) as server:
+        engine = PubChem(delay=delay, pug_url=server.pug_url,
+                         rest_url=server.rest_url)
+        for name in benchmarks:
+            func, n_items = BENCHMARKS[name](engine, server, n_ids)
+            times = run_benchmark(func, repeats)
+            median = np.median(times)
+            print '{:<24}{:>10}{:>12.4f}{:>12.4f}{:>14.1f}'.format(
+                name, n_items, median, np.percentile(times, 90),
+                n_items / median)
+        engine.pool.close()
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.benchmarks, args.n_ids, args.repeats, args.latency,
+         args.job_time, args.failure_rate, args.backoff, args.delay)
@@ -1,17 +1,30 @@
 """
 Utilities for interacting with PubChem.
 """
+import bz2
+import gzip
 import json
 import numpy as np
+import os
 import shutil
 import re
+import tempfile
 import time
 import urllib
 import urllib2
 
 from joblib import delayed, Parallel
 
-from .pug import PugQuery
+from .batching import BatchQueue
+from .connection import ConnectionPool
+from .idset import IDSet
+from .metrics import Metrics
+from .pug import (AsyncCall, AsyncPugQuery, get_polling_policy,
+                  PugQuery, PUGError, wait)
+from .queries import (assay_data_query, download_query,
+                      id_exchange_query)
+from .streaming import (ChainedReader, iter_assay_table, iter_sdf_records,
+                        read_int_array)
 
 __author__ = "Steven Kearnes"
 __copyright__ = "Copyright 2014-2015, Stanford University"
@@ -26,16 +39,70 @@ class PubChem(object):
     ----------
     submit : bool, optional (default True)
         Whether to automatically submit PUGQuery queries.
-    delay : int, optional (default 10)
+    delay : int or PollingPolicy, optional (default 10)
         Number of seconds for PUGQuery objects to wait between status
-        checks.
+        checks, or a policy that chooses the wait before each status check
+        (see `pug.ExponentialBackoff`).
     verbose : bool, optional (default False)
         Whether to create PUG queries in verbose mode.
+    pug_url : str, optional
+        PUG URL. Defaults to the PubChem PUG service
+        ('https://pubchem.ncbi.nlm.nih.gov/pug/pug.cgi').
+    rest_url : str, optional
+        Base URL for PUG REST requests. Defaults to the PubChem PUG REST
+        service ('https://pubchem.ncbi.nlm.nih.gov/rest/pug').
+    cache : cache.RecordCache, optional
+        Cache for SDF records retrieved with `get_records` and `get_record`.
+        If provided, only records that are not cached are downloaded.
+    mapping_store : cache.MappingStore, optional
+        Store for mappings resolved with `id_exchange`. If provided, only
+        IDs without a stored mapping are sent to PubChem.
+    journal : journal.JobJournal, optional
+        Journal of submitted PUG queries. If provided, queries whose results
+        were not fetched (for example, because the process was interrupted)
+        reattach to the recorded PUG request or reuse its download URL
+        instead of being submitted again.
+    pool_size : int, optional (default 10)
+        Maximum number of idle keep-alive connections per host in the
+        connection pool shared by all requests.
+    rate_limiter : ratelimit.RateLimiter, optional
+        Rate limiter shared by all requests sent by this instance, including
+        requests from worker threads (see `ratelimit.RateLimiter` and
+        `ratelimit.FileRateLimiter`).
+    metrics : metrics.Metrics, optional
+        Metrics for requests and PUG queries sent by this instance. If not
+        provided, a new Metrics object is created.
+
+    Attributes
+    ----------
+    metrics : metrics.Metrics
+        Per-endpoint request counts and latencies, aggregate PUG query
+        timings and recent query timing records. Use `metrics.add_hook` to
+        export them as they are recorded.
     """
-    def __init__(self, submit=True, delay=10, verbose=False):
+    pug_url = 'https://pubchem.ncbi.nlm.nih.gov/pug/pug.cgi'
+    rest_url = 'https://pubchem.ncbi.nlm.nih.gov/rest/pug'
+    stream_threshold = 100000  # stream bodies of queries with more IDs
+
+    def __init__(self, submit=True, delay=10, verbose=False, cache=None,
+                 pool_size=10, pug_url=None, rest_url=None,
+                 mapping_store=None, journal=None, rate_limiter=None,
+                 metrics=None):
         self.submit = submit
         self.delay = delay
         self.verbose = verbose
+        self.cache = cache
+        self.mapping_store = mapping_store
+        self.journal = journal
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.pool = ConnectionPool(pool_size, rate_limiter=rate_limiter,
+                                   metrics=metrics)
+        if pug_url is not None:
+            self.pug_url = pug_url
+        if rest_url is not None:
+            self.rest_url = rest_url
 
     def get_query(self, query):
         """
@@ -47,11 +114,61 @@ class PubChem(object):
             PUG query XML.
         """
         return PugQuery(query, submit=self.submit, delay=self.delay,
-                        verbose=self.verbose)
+                        verbose=self.verbose, pool=self.pool,
+                        url=self.pug_url, journal=self.journal,
+                        metrics=self.metrics)
+
+    def get_async_query(self, query):
+        """
+        Create a PUG request that does not wait for the query to complete
+        when it is submitted.
+
+        Parameters
+        ----------
+        query : str
+            PUG query XML.
+        """
+        return AsyncPugQuery(query, submit=self.submit, delay=self.delay,
+                             verbose=self.verbose, pool=self.pool,
+                             url=self.pug_url, journal=self.journal,
+                             metrics=self.metrics)
+
+    def _fetch(self, query, filename=None, compression=None, stream=False,
+               n_segments=1):
+        """
+        Fetch the result of a PUG query.
+
+        Parameters
+        ----------
+        query : PugQuery
+            PUG query.
+        filename : str, optional
+            Output filename. If not provided, the data is read into memory.
+        compression : str, optional
+            Compression type used to decode data.
+        stream : bool, optional (default False)
+            Whether to return a file-like object that downloads and
+            decompresses the data as it is read.
+        n_segments : int, optional (default 1)
+            Number of byte ranges to download in parallel when writing to
+            filename.
+        """
+        return query.fetch(filename, compression=compression, stream=stream,
+                           n_segments=n_segments)
+
+    def _fetch_many(self, queries, filename=None, compression=None,
+                    max_in_flight=1, stream=False):
+        """
+        Fetch the merged results of chunk queries. See `_fetch_chunks` for
+        parameters.
+        """
+        return self._fetch_chunks(queries, filename, compression,
+                                  max_in_flight, stream)
 
     def get_records(self, ids, filename=None, sids=False,
                     download_format='sdf', compression='gzip', use_3d=False,
-                    n_conformers=1):
+                    n_conformers=1, chunk_size=None, max_in_flight=1,
+                    stream=False, n_segments=1):
         """
         Download records for substances or compounds identified by
         PubChem substance IDs (SIDs) or compound IDs (CIDs).
@@ -73,80 +190,284 @@ class PubChem(object):
             retrieved.
         n_conformers : int, optional (default 1)
             Number of conformers to download if retrieving 3D structures.
+        chunk_size : int, optional
+            Maximum number of IDs per PUG query. If provided, IDs are split
+            into chunks that are downloaded as separate queries and merged in
+            input order. Compressed chunks are concatenated as multi-member
+            gzip or multi-stream bzip2 files.
+        max_in_flight : int, optional (default 1)
+            Maximum number of chunk queries to run concurrently.
+        stream : bool, optional (default False)
+            Whether to return a file-like object that downloads and
+            decompresses the data as it is read. Ignored if filename is
+            provided. With chunk_size, the chunks are streamed one after
+            another in input order.
+        n_segments : int, optional (default 1)
+            Number of byte ranges to download in parallel when writing to
+            filename, if the server supports range requests. Ignored with
+            chunk_size (chunks are downloaded concurrently instead; see
+            max_in_flight) and for cached records.
+        """
+        if (self.cache is not None and download_format == 'sdf' and
+                not (stream and filename is None)):
+            return self._get_cached_records(
+                ids, filename, sids, compression, use_3d, n_conformers,
+                chunk_size, max_in_flight)
+        queries = self._get_records_queries(
+            ids, sids, download_format, compression, use_3d, n_conformers,
+            chunk_size)
+
+        # construct query
+        if len(queries) == 1:
+            query = self.get_query(queries[0])
+            rval = self._fetch(query, filename, compression=compression,
+                               stream=stream, n_segments=n_segments)
+            return rval
+        return self._fetch_many(queries, filename, compression,
+                                max_in_flight, stream)
+
+    def _get_cached_records(self, ids, filename=None, sids=False,
+                            compression='gzip', use_3d=False,
+                            n_conformers=1, chunk_size=None,
+                            max_in_flight=1):
+        """
+        Get SDF records from the cache, downloading only missing records.
+
+        Parameters
+        ----------
+        ids : iterable
+            PubChem substance or compound IDs.
+        filename : str, optional
+            Output filename. If not provided, records are returned as a
+            string.
+        sids : bool, optional (default False)
+            Whether ids are SIDs. If False, IDs are assumed to be CIDs.
+        compression : str, optional (default 'gzip')
+            Compression type for downloaded structures and the output file.
+        use_3d : bool, optional (default False)
+            Whether to query 3D information. If False, 2D information is
+            retrieved.
+        n_conformers : int, optional (default 1)
+            Number of conformers to download if retrieving 3D structures.
+        chunk_size : int, optional
+            Maximum number of IDs per PUG query.
+        max_in_flight : int, optional (default 1)
+            Maximum number of chunk queries to submit ahead of the chunk that
+            is currently being read.
         """
-        query_template = """
-        <PCT-Data>
-         <PCT-Data_input>
-          <PCT-InputData>
-           <PCT-InputData_download>
-            <PCT-Download>
-             <PCT-Download_uids>
-              <PCT-QueryUids>
-               <PCT-QueryUids_ids>
-                <PCT-ID-List>
-                 <PCT-ID-List_db>%(database)s</PCT-ID-List_db>
-                 <PCT-ID-List_uids>
-                  %(uids)s
-                 </PCT-ID-List_uids>
-                </PCT-ID-List>
-               </PCT-QueryUids_ids>
-              </PCT-QueryUids>
-             </PCT-Download_uids>
-             <PCT-Download_format value="%(download_format)s"/>
-             <PCT-Download_compression value="%(compression)s"/>
-             <PCT-Download_use-3d value="%(use_3d)s"/>
-             <PCT-Download_n-3d-conformers>
-              %(n_conformers)s
-             </PCT-Download_n-3d-conformers>
-            </PCT-Download>
-           </PCT-InputData_download>
-          </PCT-InputData>
-         </PCT-Data_input>
-        </PCT-Data>
-        """
-        mapping = {}
-
-        # database
         if sids:
-            mapping['database'] = 'pcsubstance'
+            database = 'pcsubstance'
         else:
-            mapping['database'] = 'pccompound'
-
-        # download format
-        download_formats = ['text-asn', 'binary-asn', 'xml', 'sdf', 'image',
-                            'image-small', 'smiles', 'inchi']
-        assert download_format in download_formats, (
-            'download_format must be one of ' + str(download_formats))
-        mapping['download_format'] = download_format
-
-        # compression
-        if compression is None:
-            compression = 'none'
-        compressions = ['none', 'gzip', 'bzip2']
-        assert compression in compressions, (
-            'compression must be one of ' + str(compressions))
-        mapping['compression'] = compression
-
-        # 3D
-        if use_3d:
-            mapping['use_3d'] = 'true'
+            database = 'pccompound'
+        ids = [int(uid) for uid in ids]
+        records = self.cache.get(database, ids, 'sdf', use_3d, n_conformers)
+        missing = []
+        for uid in ids:
+            if uid not in records:
+                missing.append(uid)
+                records[uid] = None
+        if missing:
+            fetched = {}
+            for uid, record in self.iter_records(
+                    missing, sids, compression, use_3d, n_conformers,
+                    chunk_size, max_in_flight):
+                fetched.setdefault(uid, []).append(record)
+            fetched = {uid: ''.join(value) for uid, value in
+                       fetched.iteritems()}
+            self.cache.put(database, fetched, 'sdf', use_3d, n_conformers)
+            records.update(fetched)
+        data = ''.join(records[uid] for uid in ids if records[uid] is not None)
+        if filename is None:
+            return data
+        if compression == 'gzip':
+            f = gzip.open(filename, 'wb')
+        elif compression == 'bzip2':
+            f = bz2.BZ2File(filename, 'wb')
         else:
-            mapping['use_3d'] = 'false'
+            f = open(filename, 'wb')
+        with f:
+            f.write(data)
+        return filename
 
-        # conformers
-        mapping['n_conformers'] = n_conformers
+    def iter_records(self, ids, sids=False, compression='gzip',
+                     use_3d=False, n_conformers=1, chunk_size=None,
+                     max_in_flight=1):
+        """
+        Iterate over SDF records for substances or compounds identified by
+        PubChem substance IDs (SIDs) or compound IDs (CIDs).
 
-        # create XML for each ID
-        xml_uids = ''
-        for uid in ids:
-            xml_uids += ('<PCT-ID-List_uids_E>{}'.format(uid) +
-                         '</PCT-ID-List_uids_E>\n')
-        mapping['uids'] = xml_uids
+        Records are parsed from the download stream as it arrives, so the
+        first record is available before the download is complete.
 
-        # construct query
-        query = self.get_query(query_template % mapping)
-        rval = query.fetch(filename, compression=compression)
-        return rval
+        Parameters
+        ----------
+        ids : iterable
+            PubChem substance or compound IDs.
+        sids : bool, optional (default False)
+            Whether ids are SIDs. If False, IDs are assumed to be CIDs.
+        compression : str, optional (default 'gzip')
+            Compression type for downloaded structures.
+        use_3d : bool, optional (default False)
+            Whether to query 3D information. If False, 2D information is
+            retrieved.
+        n_conformers : int, optional (default 1)
+            Number of conformers to download if retrieving 3D structures.
+        chunk_size : int, optional
+            Maximum number of IDs per PUG query. Chunks are downloaded in
+            input order.
+        max_in_flight : int, optional (default 1)
+            Maximum number of chunk queries to submit ahead of the chunk that
+            is currently being read.
+
+        Yields
+        ------
+        uid : int
+            PubChem substance or compound ID.
+        record : str
+            SDF record.
+        """
+        queries = self._get_records_queries(
+            ids, sids, 'sdf', compression, use_3d, n_conformers, chunk_size)
+        for f in self._iter_chunk_readers(queries, compression,
+                                          max_in_flight):
+            with f:
+                for uid, record in iter_sdf_records(f, sids):
+                    yield uid, record
+
+    def _iter_chunk_readers(self, queries, compression=None,
+                            max_in_flight=1):
+        """
+        Iterate over streamed results of PUG queries in order.
+
+        Up to max_in_flight queries are submitted ahead of the one that is
+        currently being read.
+
+        Parameters
+        ----------
+        queries : list
+            PUG query XML strings.
+        compression : str, optional
+            Compression type used to decode data.
+        max_in_flight : int, optional (default 1)
+            Maximum number of queries to submit ahead of the query that is
+            currently being read.
+
+        Yields
+        ------
+        f : DecompressingReader
+            File-like object that downloads and decompresses the result of
+            a query as it is read.
+        """
+        pending = []
+        for i in xrange(len(queries)):
+            while (len(pending) < max_in_flight and
+                   i + len(pending) < len(queries)):
+                pending.append(
+                    self.get_async_query(queries[i + len(pending)]))
+            query = pending.pop(0)
+            yield query.fetch(compression=compression, stream=True)
+
+    def _get_records_queries(self, ids, sids=False, download_format='sdf',
+                             compression='gzip', use_3d=False,
+                             n_conformers=1, chunk_size=None):
+        """
+        Construct PUG download queries for substances or compounds.
+
+        Parameters
+        ----------
+        ids : iterable
+            PubChem substance or compound IDs.
+        sids : bool, optional (default False)
+            Whether ids are SIDs. If False, IDs are assumed to be CIDs.
+        download_format : str, optional (default 'sdf')
+            Download file format.
+        compression : str, optional (default 'gzip')
+            Compression type for downloaded structures.
+        use_3d : bool, optional (default False)
+            Whether to query 3D information. If False, 2D information is
+            retrieved.
+        n_conformers : int, optional (default 1)
+            Number of conformers to download if retrieving 3D structures.
+        chunk_size : int, optional
+            Maximum number of IDs per query. If not provided, a single query
+            is constructed.
+
+        Returns
+        -------
+        queries : list
+            PUG query XML for each chunk of IDs.
+        """
+        if not isinstance(ids, np.ndarray):
+            ids = list(ids)
+        if chunk_size is None:
+            chunks = [ids]
+        else:
+            chunks = [ids[i:i + chunk_size]
+                      for i in xrange(0, len(ids), chunk_size)]
+        return [self._get_query_body(
+            download_query, chunk, sids, download_format, compression,
+            use_3d, n_conformers) for chunk in chunks]
+
+    def _get_query_body(self, builder, ids, *args, **kwargs):
+        """
+        Build a PUG query, streaming the request body if it contains more
+        than stream_threshold IDs.
+
+        Parameters
+        ----------
+        builder : callable
+            Query builder from `queries`.
+        ids : list
+            IDs.
+        args : list, optional
+            Additional arguments for builder.
+        kwargs : dict, optional
+            Additional keyword arguments for builder.
+        """
+        kwargs['stream'] = len(ids) > self.stream_threshold
+        return builder(ids, *args, **kwargs)
+
+    def _fetch_chunks(self, queries, filename=None, compression=None,
+                      max_in_flight=1, stream=False):
+        """
+        Run several PUG queries concurrently and merge their results in
+        query order.
+
+        Parameters
+        ----------
+        queries : list
+            PUG query XML for each chunk.
+        filename : str, optional
+            Output filename. If not provided, the decompressed results are
+            concatenated in memory.
+        compression : str, optional
+            Compression type used to decode data.
+        max_in_flight : int, optional (default 1)
+            Maximum number of queries to run concurrently.
+        stream : bool, optional (default False)
+            Whether to return a file-like object that streams the results
+            one after another. Ignored if filename is provided.
+        """
+        if stream and filename is None:
+            return ChainedReader(self._iter_chunk_readers(
+                queries, compression, max_in_flight))
+        if filename is None:
+            results = Parallel(n_jobs=max_in_flight, backend='threading')(
+                delayed(_fetch_query)(self, query, compression=compression)
+                for query in queries)
+            return ''.join(results)
+        temp_dir = tempfile.mkdtemp()
+        try:
+            chunk_filenames = [
+                os.path.join(temp_dir, 'chunk-{}'.format(i))
+                for i in xrange(len(queries))]
+            Parallel(n_jobs=max_in_flight, backend='threading')(
+                delayed(_fetch_query)(self, query, chunk_filename)
+                for query, chunk_filename in zip(queries, chunk_filenames))
+            _concatenate_files(chunk_filenames, filename)
+        finally:
+            shutil.rmtree(temp_dir)
+        return filename
 
     def get_record(self, id, filename=None, sid=False, use_3d=False):
         """
@@ -185,7 +506,7 @@ class PubChem(object):
         will throw a urllib2.HTTPError (404).
         """
 
-        base = 'http://pubchem.ncbi.nlm.nih.gov/rest/pug/%s?%s'
+        base = self.rest_url + '/%s?%s'
         if sid:
             specialization = 'substance/sid/%s/SDF' % id
         else:
@@ -196,40 +517,180 @@ class PubChem(object):
         else:
             params = {}
 
+        if self.cache is not None:
+            if sid:
+                database = 'pcsubstance'
+            else:
+                database = 'pccompound'
+            data = self.cache.get(database, [id], 'sdf', use_3d).get(int(id))
+            if data is None:
+                url = base % (specialization, urllib.urlencode(params))
+                data = self.pool.urlopen(url).read()
+                self.cache.put(database, {id: data}, 'sdf', use_3d)
+            if filename is None:
+                return data
+            with open(filename, 'wb') as f:
+                f.write(data)
+            return
+
         url = base % (specialization, urllib.urlencode(params))
-        comm = urllib2.urlopen(url)
+        comm = self.pool.urlopen(url)
 
         if filename is None:
             return comm.read()
         else:
             with open(filename, 'wb') as f:
                 shutil.copyfileobj(comm, f)
+            comm.close()
 
-    def get_parent_cids(self, cids):
+    def get_records_rest(self, ids, filename=None, sids=False, use_3d=False,
+                         batch_size=100, n_jobs=1, max_attempts=3):
         """
-        Get IDs of parent compounds. Note that the parent IDs are not
-        guaranteed to be returned in the same order as the child IDs, so we
-        return a set.
+        Download SDF records for substances or compounds with synchronous,
+        batched PUG REST requests.
+
+        For tens to a few thousand IDs this avoids waiting for a queued PUG
+        download job. Records are returned in input order (IDs without
+        records are omitted).
 
         Parameters
         ----------
         ids : iterable
             PubChem substance or compound IDs.
+        filename : str, optional
+            Output filename. If not provided, the records are returned as a
+            string.
         sids : bool, optional (default False)
             Whether ids are SIDs. If False, IDs are assumed to be CIDs.
+        use_3d : bool, optional (default False)
+            Whether to query 3D information. If False, 2D information is
+            retrieved.
+        batch_size : int, optional (default 100)
+            Number of IDs per request.
+        n_jobs : int, optional (default 1)
+            Number of concurrent requests.
+        max_attempts : int, optional (default 3)
+            Maximum number of attempts for each batch. The batch_size is
+            halved after each failure.
+        """
+        if sids:
+            database = 'pcsubstance'
+        else:
+            database = 'pccompound'
+        ids = [int(uid) for uid in ids]
+        records = {}
+        if self.cache is not None:
+            records = self.cache.get(database, ids, 'sdf', use_3d)
+        missing = []
+        for uid in ids:
+            if uid not in records:
+                missing.append(uid)
+                records[uid] = None
+        if missing:
+            n_jobs = max(1, min(n_jobs, len(missing)))
+            results = Parallel(n_jobs=n_jobs, backend='threading')(
+                delayed(_get_records_rest)
+                (this_ids, sids, use_3d, batch_size, max_attempts, self.pool,
+                 self.rest_url)
+                for this_ids in np.array_split(missing, n_jobs))
+            fetched = {}
+            for result in results:
+                for data in result:
+                    for uid, record in iter_sdf_records(
+                            data.splitlines(True), sids):
+                        fetched[uid] = record
+            if self.cache is not None:
+                self.cache.put(database, fetched, 'sdf', use_3d)
+            records.update(fetched)
+        data = ''.join(records[uid] for uid in ids if records[uid] is not None)
+        if filename is None:
+            return data
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+
+    def get_parent_cids(self, cids, ordered=False, batch_size=10000,
+                        n_jobs=1, max_attempts=3, id_set=False):
         """
-        url_template = ('http://pubchem.ncbi.nlm.nih.gov/rest/pug/compound' +
-                        '/cid/%(cids)s/cids/TXT?cids_type=parent')
-        mapping = {'cids': ','.join([str(cid) for cid in cids])}
-        response = urllib2.urlopen(url_template % mapping)
-        parents = set()
-        for line in response.readlines():
-            cid = int(line)
-            if cid:  # 0 is not a valid ID
-                parents.add(cid)
-        return parents
+        Get IDs of parent compounds.
 
-    def get_ids_from_assay(self, aid, sids=False, activity_outcome=None):
+        CIDs are POSTed in batches, so lists of any length can be queried.
+        Parents are requested grouped by input CID, so the result does not
+        depend on the order in which PubChem returns them.
+
+        Parameters
+        ----------
+        cids : iterable
+            PubChem compound IDs. A ValueError is raised for IDs that are not
+            non-negative 32-bit integers.
+        ordered : bool, optional (default False)
+            Whether to return an array of parent CIDs aligned with cids. If
+            False, the set of parent CIDs is returned. Ordered output
+            requires each CID to have at most one parent; a PUGError is
+            raised for CIDs with several parents (such as mixtures).
+        batch_size : int, optional (default 10000)
+            Number of CIDs per request.
+        n_jobs : int, optional (default 1)
+            Number of concurrent requests.
+        max_attempts : int, optional (default 3)
+            Maximum number of query attempts. The batch_size is halved after
+            each failure.
+        id_set : bool, optional (default False)
+            Whether to return the parent CIDs as an IDSet instead of a set.
+            Ignored if ordered is True.
+
+        Returns
+        -------
+        parents : set, IDSet or ndarray
+            If ordered, a uint32 array containing the parent CID for each
+            input CID, with 0 where there is no parent. Otherwise, the set of
+            parent CIDs.
+        """
+        if not isinstance(cids, np.ndarray):
+            cids = np.fromiter(cids, dtype=np.int64)
+        if cids.size and (not np.issubdtype(cids.dtype, np.integer) or
+                          cids.min() < 0 or
+                          cids.max() > np.iinfo(np.uint32).max):
+            raise ValueError('CIDs must be non-negative 32-bit integers.')
+        cids = cids.astype(np.uint32, copy=False)
+        unique = np.unique(cids)
+        children = np.zeros(0, dtype=np.uint32)
+        parents = np.zeros(0, dtype=np.uint32)
+        if unique.size:
+            n_jobs = max(1, min(n_jobs, int(np.ceil(
+                float(unique.size) / batch_size))))
+            results = Parallel(n_jobs=n_jobs, backend='threading')(
+                delayed(_get_parent_cids)
+                (this_cids, batch_size, max_attempts, self.pool,
+                 self.rest_url)
+                for this_cids in np.array_split(unique, n_jobs))
+            children = np.concatenate([result[0] for result in results])
+            parents = np.concatenate([result[1] for result in results])
+        if not ordered:
+            parents = np.unique(parents)
+            if id_set:
+                return IDSet.from_sorted(parents)
+            return set(parents.tolist())
+
+        # sort (child, parent) pairs by child and check for multiple parents
+        pairs = np.unique((children.astype(np.uint64) << np.uint64(32)) |
+                          parents.astype(np.uint64))
+        children = (pairs >> np.uint64(32)).astype(np.uint32)
+        parents = (pairs & np.uint64(0xffffffff)).astype(np.uint32)
+        repeated = np.flatnonzero(children[1:] == children[:-1])
+        if repeated.size:
+            cid = children[repeated[0]]
+            raise PUGError('CID {} has {} parents.'.format(
+                cid, np.count_nonzero(children == cid)))
+        index = np.searchsorted(children, cids)
+        found = index < children.size
+        found[found] = children[index[found]] == cids[found]
+        values = np.zeros(cids.size, dtype=np.uint32)
+        values[found] = parents[index[found]]
+        return values
+
+    def get_ids_from_assay(self, aid, sids=False, activity_outcome=None,
+                           id_set=False):
         """
         Retrieve substance or compound IDs tested in a PubChem BioAssay
         assay.
@@ -243,29 +704,55 @@ class PubChem(object):
         activity_outcome : str, optional
             If provided, only retrieve records with this activity outcome,
             such as 'active'.
+        id_set : bool, optional (default False)
+            Whether to return the unique IDs as an IDSet instead of an array
+            of IDs in the order returned by PubChem.
         """
-        url_template = ('https://pubchem.ncbi.nlm.nih.gov/rest/pug/assay/aid' +
-                        '/%(aid)s/%(database)s/txt')
-        mapping = {'aid': aid}
-        if sids:
-            mapping['database'] = 'sids'
-        else:
-            mapping['database'] = 'cids'
-        if activity_outcome is not None:
-            url_template += '?{}_type={}'.format(mapping['database'],
-                                                 activity_outcome.lower())
-        url = url_template % mapping
-        response = urllib2.urlopen(url)
-        ids = []
-        for this in response.readlines():
-            this = this.strip()
-            if int(this):  # 0 is not a valid ID
-                ids.append(this)
-        ids = np.asarray(ids, dtype=int)
+        ids = _get_ids_from_assay(aid, sids, activity_outcome, self.pool,
+                                  self.rest_url)
+        if id_set:
+            return IDSet(ids)
         return ids
 
+    def get_ids_from_assays(self, aids, sids=False, activity_outcome=None,
+                            n_jobs=1, id_set=False):
+        """
+        Retrieve substance or compound IDs tested in several PubChem
+        BioAssay assays.
+
+        Parameters
+        ----------
+        aids : iterable
+            PubChem BioAssay assay IDs (AIDs).
+        sids : bool, optional (default False)
+            Whether ids are SIDs. If False, IDs are assumed to be CIDs.
+        activity_outcome : str, optional
+            If provided, only retrieve records with this activity outcome,
+            such as 'active'.
+        n_jobs : int, optional (default 1)
+            Number of concurrent requests.
+        id_set : bool, optional (default False)
+            Whether to return the IDs for each assay as an IDSet.
+
+        Returns
+        -------
+        ids : dict
+            Maps each AID to an array (or IDSet) of IDs.
+        """
+        aids = list(aids)
+        if not aids:
+            return {}
+        results = Parallel(n_jobs=max(1, min(n_jobs, len(aids))),
+                           backend='threading')(
+            delayed(_get_ids_from_assay)
+            (aid, sids, activity_outcome, self.pool, self.rest_url)
+            for aid in aids)
+        if id_set:
+            results = [IDSet(ids) for ids in results]
+        return dict(zip(aids, results))
+
     def get_assay_data(self, aids, filename=None, substance_view=True,
-                       concise=False, compression='gzip'):
+                       concise=False, compression='gzip', stream=False):
         """
         Download PubChem BioAssay data table.
 
@@ -284,101 +771,144 @@ class PubChem(object):
         concise : bool, optional (default False)
             Whether to return the concise data table. If False, the complete
             data table is retrieved.
+        stream : bool, optional (default False)
+            Whether to return a file-like object that downloads and
+            decompresses the data as it is read. Ignored if filename is
+            provided.
         """
-        query_template = """
-<PCT-Data>
-  <PCT-Data_input>
-    <PCT-InputData>
-      <PCT-InputData_query>
-        <PCT-Query>
-          <PCT-Query_type>
-            <PCT-QueryType>
-              <PCT-QueryType_bas>
-                <PCT-QueryAssayData>
-    <PCT-QueryAssayData_output value="csv">4</PCT-QueryAssayData_output>
-                  <PCT-QueryAssayData_aids>
-                    <PCT-QueryUids>
-                      <PCT-QueryUids_ids>
-                        <PCT-ID-List>
-                          <PCT-ID-List_db>pcassay</PCT-ID-List_db>
-                          <PCT-ID-List_uids>
-                            %(aids)s
-                          </PCT-ID-List_uids>
-                        </PCT-ID-List>
-                      </PCT-QueryUids_ids>
-                    </PCT-QueryUids>
-                  </PCT-QueryAssayData_aids>
-                    %(dataset)s
-                  <PCT-QueryAssayData_focus>
-                    <PCT-Assay-FocusOption>
-                    %(group_by)s
-                    </PCT-Assay-FocusOption>
-                  </PCT-QueryAssayData_focus>
-                  <PCT-QueryAssayData_compression value="%(compression)s"/>
-                </PCT-QueryAssayData>
-              </PCT-QueryType_bas>
-            </PCT-QueryType>
-          </PCT-Query_type>
-        </PCT-Query>
-      </PCT-InputData_query>
-    </PCT-InputData>
-  </PCT-Data_input>
-</PCT-Data>
-"""
-        group_by = ('<PCT-Assay-FocusOption_group-results-by value="{}">{}' +
-                    '</PCT-Assay-FocusOption_group-results-by>')
-        if substance_view:
-            group_by = group_by.format('substance', 4)
-        else:
-            group_by = group_by.format('compound', 0)
-
-        dataset = ('<PCT-QueryAssayData_dataset value="{}">{}' +
-                   '</PCT-QueryAssayData_dataset>')
-        if concise:
-            dataset = dataset.format('concise', 1)
-        else:
-            dataset = dataset.format('complete', 0)
-        aid_xml = ''
-        for aid in np.atleast_1d(aids):
-            aid_xml += ('<PCT-ID-List_uids_E>{}'.format(aid) +
-                        '</PCT-ID-List_uids_E>')
-        mapping = {'group_by': group_by, 'dataset': dataset, 'aids': aid_xml,
-                   'compression': compression}
-        query = self.get_query(query_template % mapping)
-        rval = query.fetch(filename, compression=compression)
+        query = self.get_query(self._get_assay_data_query(
+            aids, substance_view, concise, compression))
+        rval = self._fetch(query, filename, compression=compression,
+                           stream=stream)
         return rval
 
+    def iter_assay_data(self, aids, columns=None, chunk_size=100000,
+                        substance_view=True, concise=False,
+                        compression='gzip'):
+        """
+        Download PubChem BioAssay data tables and iterate over them in
+        typed, columnar chunks.
+
+        The table is parsed as it is downloaded, so memory use is bounded by
+        chunk_size rather than by the size of the table.
+
+        Parameters
+        ----------
+        aids : array_like
+            PubChem BioAssay IDs (AIDs).
+        columns : list, optional
+            Columns to read. Defaults to the SID, CID, activity outcome and
+            activity score columns (see `streaming.iter_assay_table`).
+        chunk_size : int, optional (default 100000)
+            Maximum number of rows per chunk.
+        substance_view : bool, optional (default True)
+            Whether to group results by substance. If False, results will be
+            grouped by compound.
+        concise : bool, optional (default False)
+            Whether to return the concise data table. If False, the complete
+            data table is retrieved.
+        compression : str, optional (default 'gzip')
+            Compression type for assay data.
+
+        Yields
+        ------
+        chunk : ndarray
+            Structured array with a field for each column.
+        """
+        query = self.get_query(self._get_assay_data_query(
+            aids, substance_view, concise, compression))
+        with query.fetch(compression=compression, stream=True) as f:
+            for chunk in iter_assay_table(f, columns, chunk_size):
+                yield chunk
+
+    def get_assay_table(self, aids, columns=None, substance_view=True,
+                        concise=False, compression='gzip'):
+        """
+        Download PubChem BioAssay data tables as a structured array.
+
+        Parameters
+        ----------
+        aids : array_like
+            PubChem BioAssay IDs (AIDs).
+        columns : list, optional
+            Columns to read. Defaults to the SID, CID, activity outcome and
+            activity score columns (see `streaming.iter_assay_table`).
+        substance_view : bool, optional (default True)
+            Whether to group results by substance. If False, results will be
+            grouped by compound.
+        concise : bool, optional (default False)
+            Whether to return the concise data table. If False, the complete
+            data table is retrieved.
+        compression : str, optional (default 'gzip')
+            Compression type for assay data.
+        """
+        chunks = list(self.iter_assay_data(
+            aids, columns, substance_view=substance_view, concise=concise,
+            compression=compression))
+        if not chunks:
+            return None
+        return np.concatenate(chunks)
+
+    def _get_assay_data_query(self, aids, substance_view=True,
+                              concise=False, compression='gzip'):
+        """
+        Construct a PUG query for PubChem BioAssay data tables.
+
+        Parameters
+        ----------
+        aids : array_like
+            PubChem BioAssay IDs (AIDs).
+        substance_view : bool, optional (default True)
+            Whether to group results by substance.
+        concise : bool, optional (default False)
+            Whether to return the concise data table.
+        compression : str, optional (default 'gzip')
+            Compression type for assay data.
+        """
+        return self._get_query_body(assay_data_query, np.atleast_1d(aids),
+                                    substance_view, concise, compression)
+
     def get_assay_descriptions(self, aids, output_format='json',
                                batch_size=500, n_jobs=1, max_attempts=3):
         """
         Get assay descriptions.
 
+        Requests are made from n_jobs threads that share an adaptive batch
+        size (see `batching.BatchQueue`), and each response is parsed as soon
+        as it arrives.
+
         Parameters
         ----------
         aids : list
             List of assay IDs.
         output_format : str (default='json')
             Output format.
+        batch_size : int (default 500)
+            Maximum number of descriptions per request. The batch size is
+            halved after each failure and grows back after successes.
+        n_jobs : int (default 1)
+            Number of concurrent requests.
+        max_attempts : int (default 3)
+            Maximum number of consecutive failures for any assay.
         """
-        results = Parallel(n_jobs=n_jobs, verbose=5)(
+        if output_format != 'json':
+            raise NotImplementedError(output_format)
+        aids = [int(aid) for aid in aids]
+        queue = BatchQueue(len(aids), batch_size, max_attempts)
+        results = {}
+        Parallel(n_jobs=n_jobs, backend='threading')(
             delayed(_get_assay_descriptions)
-            (this_aids, output_format, batch_size, max_attempts)
-            for this_aids in np.array_split(aids, n_jobs))
+            (aids, queue, results, output_format, self.pool, self.rest_url)
+            for _ in xrange(n_jobs))
+        if queue.error is not None:
+            raise queue.error
         descriptions = []
-        if output_format == 'json':
-            for result in results:
-                for this in result:
-                    data = json.loads(this)
-                    assert len(data) == 1
-                    assert data.keys()[0] == 'PC_AssayContainer'
-                    for description in data['PC_AssayContainer']:
-                        descriptions.append(description['assay']['descr'])
-        else:
-            raise NotImplementedError(output_format)
+        for start in sorted(results):
+            descriptions.extend(results[start])
         return descriptions
 
     def id_exchange(self, ids, source=None, operation_type='same',
-                    output_type='cid'):
+                    output_type='cid', chunk_size=None, max_in_flight=1):
         """
         Use the PubChem Identifier exchange service.
 
@@ -395,76 +925,63 @@ class PubChem(object):
             Operation type. Defaults to exact matches.
         output_type : str, optional (default 'cid')
             Output type. Defaults to PubChem CIDs.
+        chunk_size : int, optional
+            Maximum number of IDs per PUG query. If provided, IDs are split
+            into chunks that are submitted as separate queries and the
+            results are merged.
+        max_in_flight : int, optional (default 1)
+            Maximum number of chunk queries to run concurrently.
         """
-        query_template = """
-<PCT-Data>
-  <PCT-Data_input>
-    <PCT-InputData>
-      <PCT-InputData_query>
-        <PCT-Query>
-          <PCT-Query_type>
-            <PCT-QueryType>
-              <PCT-QueryType_id-exchange>
-                <PCT-QueryIDExchange>
-                  <PCT-QueryIDExchange_input>
-                    <PCT-QueryUids>
-                      <PCT-QueryUids_source-ids>
-                        <PCT-RegistryIDs>
-        <PCT-RegistryIDs_source-name>%(source)s</PCT-RegistryIDs_source-name>
-                          <PCT-RegistryIDs_source-ids>
-                            %(source_ids)s
-                          </PCT-RegistryIDs_source-ids>
-                        </PCT-RegistryIDs>
-                      </PCT-QueryUids_source-ids>
-                    </PCT-QueryUids>
-                  </PCT-QueryIDExchange_input>
-                  <PCT-QueryIDExchange_operation-type
-                    value="%(operation_type)s"/>
-                  <PCT-QueryIDExchange_output-type value="%(output_type)s"/>
-                  <PCT-QueryIDExchange_output-method value="file-pair"/>
-                  <PCT-QueryIDExchange_compression value="gzip"/>
-                </PCT-QueryIDExchange>
-              </PCT-QueryType_id-exchange>
-            </PCT-QueryType>
-          </PCT-Query_type>
-        </PCT-Query>
-      </PCT-InputData_query>
-    </PCT-InputData>
-  </PCT-Data_input>
-</PCT-Data>
-"""
-        ids = np.atleast_1d(ids)
-        if np.unique(ids).size != len(ids):
+        if isinstance(ids, basestring):
+            ids = [ids]
+        ids = list(ids)
+        if len(set(ids)) != len(ids):
             raise ValueError('Source IDs must be unique.')
         if source is None:
             source = self.guess_source(ids[0])
             if source is None:
                 raise ValueError('Cannot guess identifier source.')
-        mapping = {'source': source, 'operation_type': operation_type,
-                   'output_type': output_type}
-        source_ids = []
-        for source_id in ids:
-            id_xml = ('<PCT-RegistryIDs_source-ids_E>{}'.format(source_id) +
-                      '</PCT-RegistryIDs_source-ids_E>\n')
-            source_ids.append(id_xml)
-        mapping['source_ids'] = ''.join(source_ids)
 
-        # construct query
-        query = self.get_query(query_template % mapping)
-        rval = query.fetch(compression='gzip')
+        # only query IDs without a stored mapping
+        id_map = {}
+        query_ids = ids
+        if self.mapping_store is not None:
+            id_map = self.mapping_store.get(source, ids, operation_type,
+                                            output_type)
+            query_ids = [source_id for source_id in ids
+                         if source_id not in id_map]
+        if not query_ids:
+            return id_map
+
+        # construct queries
+        if chunk_size is None:
+            chunk_size = len(query_ids)
+        queries = [self._get_query_body(
+            id_exchange_query, query_ids[start:start + chunk_size], source,
+            operation_type, output_type)
+            for start in xrange(0, len(query_ids), chunk_size)]
+        if len(queries) == 1:
+            rval = self.get_query(queries[0]).fetch(compression='gzip')
+        else:
+            rval = self._fetch_chunks(queries, compression='gzip',
+                                      max_in_flight=max_in_flight)
 
         # identify matched and unmatched IDs
-        id_map = {}
+        new_map = {}
         for line in rval.splitlines():
-            source, dest = line.split()
+            source_id, dest = line.split()
             try:
                 dest = int(dest)  # try to convert to an int
             except ValueError:
                 pass
-            if source in id_map and id_map[source] != dest:
+            if source_id in new_map and new_map[source_id] != dest:
                 raise ValueError('Nonidentical duplicate mapping.')
-            id_map[source] = dest
-        for source_id in ids:
+            new_map[source_id] = dest
+        if self.mapping_store is not None:
+            self.mapping_store.put(source, new_map, operation_type,
+                                   output_type)
+        id_map.update(new_map)
+        for source_id in query_ids:
             if source_id not in id_map:
                 id_map[source_id] = None
         return id_map
@@ -497,75 +1014,809 @@ class PubChem(object):
         structure_format : str, optional (default 'smiles')
             Structure format. Can be either 'smiles' or 'sdf'.
         """
-        query_template = ('http://pubchem.ncbi.nlm.nih.gov/rest/pug/compound' +
-                          '/identity/{}/XML')
-        status_template = ('http://pubchem.ncbi.nlm.nih.gov/rest/pug' +
-                           '/compound/listkey/{}/cids/XML')
-        request_id = None
-        post_data = urllib.urlencode({structure_format: structure})
-        req = urllib2.Request(query_template.format(structure_format))
-        req.add_header('Content-Type', 'application/x-www-form-urlencoded')
-        response = urllib2.urlopen(req, data=post_data)
-        for line in response.readlines():
-            search = re.search('<ListKey>(\d+)</ListKey>', line)
-            if search is not None:
-                request_id = search.groups()[0]
-        if request_id is None:
-            return None
-        cid = None
-        while True:
-            try:
-                response = urllib2.urlopen(
-                    status_template.format(request_id))
-            except urllib2.HTTPError:
-                break
-            for line in response.readlines():
-                search = re.search('<CID>(\d+)</CID>', line)
-                if search is not None:
-                    cid = int(search.groups()[0])
-            if cid is not None:
-                break
-            time.sleep(self.delay)
-        return cid
-
-
-def _get_assay_descriptions(aids, output_format='json', batch_size=500,
-                            max_attempts=3):
+        return self._get_structure_search(structure,
+                                          structure_format).result()
+
+    def _get_structure_search(self, structure, structure_format='smiles'):
+        """
+        Submit an identity search.
+
+        Parameters
+        ----------
+        structure : str
+            SMILES or SDF query.
+        structure_format : str, optional (default 'smiles')
+            Structure format. Can be either 'smiles' or 'sdf'.
+        """
+        return AsyncStructureSearch(structure, structure_format,
+                                    delay=self.delay, pool=self.pool,
+                                    rest_url=self.rest_url)
+
+    def structure_search_many(self, structures, structure_format='smiles',
+                              max_in_flight=100, n_jobs=10, max_attempts=3):
+        """
+        Search PubChem for identical structures and return matching CIDs.
+
+        Identity searches are submitted concurrently and all open searches
+        are polled together, each when its own status check is due.
+
+        Parameters
+        ----------
+        structures : list
+            SMILES or SDF queries.
+        structure_format : str, optional (default 'smiles')
+            Structure format. Can be either 'smiles' or 'sdf'.
+        max_in_flight : int, optional (default 100)
+            Maximum number of open searches.
+        n_jobs : int, optional (default 10)
+            Maximum number of concurrent requests.
+        max_attempts : int, optional (default 3)
+            Maximum number of attempts to submit each search, and maximum
+            number of consecutive failed status checks for each search.
+            Structures that are rejected by PubChem have no matching CID.
+
+        Returns
+        -------
+        cids : list
+            Matching CID (or None) for each structure, in input order.
+        """
+        cids = [None] * len(structures)
+        polling = get_polling_policy(self.delay)
+        pending = {}  # maps index to [ListKey, n_checks, due, failures]
+        next_index = 0
+        with Parallel(n_jobs=n_jobs, backend='threading') as parallel:
+            while next_index < len(structures) or pending:
+
+                # submit new searches
+                n_new = min(max_in_flight - len(pending),
+                            len(structures) - next_index)
+                if n_new > 0:
+                    indices = range(next_index, next_index + n_new)
+                    request_ids = parallel(
+                        delayed(_submit_structure_search)(
+                            structures[i], structure_format, max_attempts,
+                            strict=False, pool=self.pool,
+                            rest_url=self.rest_url)
+                        for i in indices)
+                    now = time.time()
+                    for i, request_id in zip(indices, request_ids):
+                        if request_id is not None:
+                            pending[i] = [request_id, 0, now, 0]
+                    next_index += n_new
+                if not pending:
+                    continue
+
+                # check searches that are due
+                next_check = min(search[2] for search in pending.values())
+                now = time.time()
+                if next_check > now:
+                    time.sleep(next_check - now)
+                now = time.time()
+                indices = [i for i, search in pending.iteritems()
+                           if search[2] <= now]
+                results = parallel(
+                    delayed(_check_structure_search)(
+                        pending[i][0], pending[i][3], max_attempts,
+                        pool=self.pool, rest_url=self.rest_url)
+                    for i in indices)
+                now = time.time()
+                for i, (done, cid, failures) in zip(indices, results):
+                    search = pending[i]
+                    search[3] = failures
+                    if done:
+                        cids[i] = cid
+                        del pending[i]
+                    else:
+                        search[2] = now + polling.get_delay(search[1])
+                        search[1] += 1
+        return cids
+
+
+class AsyncPubChem(PubChem):
     """
-    Parallel worker for PubChem.get_assay_descriptions.
+    Submit queries to PUG without waiting for them to complete.
+
+    PUG downloads (`get_records` and `get_assay_data`) return AsyncPugQuery
+    objects, or ChunkedQuery objects for chunked downloads, and
+    `structure_search` returns an AsyncStructureSearch instead of results.
+    Records served from the cache and the PUG REST ID lookups
+    (`get_parent_cids`, `get_ids_from_assay` and `get_ids_from_assays`)
+    run in background threads and return pug.AsyncCall objects. Use
+    `gather` to monitor any number of pending requests from a single thread
+    and collect their results in order. Other methods behave as in PubChem.
 
     Parameters
     ----------
-    aids : list
-        List of assay IDs.
-    output_format : str (default='json')
-        Output format.
-    batch_size : int (default 500)
-        Number of descriptions per request.
+    submit : bool, optional (default True)
+        Whether to automatically submit AsyncPugQuery queries.
+    delay : int or PollingPolicy, optional (default 10)
+        Number of seconds for AsyncPugQuery objects to wait between status
+        checks, or a policy that chooses the wait before each status check.
+    verbose : bool, optional (default False)
+        Whether to create PUG queries in verbose mode.
+    """
+    def get_query(self, query):
+        """
+        Create an asynchronous PUG request.
+
+        Parameters
+        ----------
+        query : str
+            PUG query XML.
+        """
+        return self.get_async_query(query)
+
+    def structure_search(self, structure, structure_format='smiles'):
+        """
+        Submit an identity search without waiting for it to complete.
+
+        Parameters
+        ----------
+        structure : str
+            SMILES or SDF query.
+        structure_format : str, optional (default 'smiles')
+            Structure format. Can be either 'smiles' or 'sdf'.
+
+        Returns
+        -------
+        search : AsyncStructureSearch
+            Pending search. Its result is the matching CID (or None).
+        """
+        return self._get_structure_search(structure, structure_format)
+
+    def _get_cached_records(self, *args, **kwargs):
+        """
+        Get SDF records from the cache, downloading missing records, in a
+        background thread. See PubChem._get_cached_records for parameters.
+        """
+        return AsyncCall(super(AsyncPubChem, self)._get_cached_records,
+                         args, kwargs, submit=self.submit)
+
+    def _fetch_many(self, queries, filename=None, compression=None,
+                    max_in_flight=1, stream=False):
+        """
+        Create a pending chunked download. See PubChem._fetch_chunks for
+        parameters.
+        """
+        query = ChunkedQuery(self, queries, max_in_flight, submit=self.submit)
+        query.fetch_args = {'filename': filename, 'compression': compression,
+                            'stream': stream}
+        return query
+
+    def get_parent_cids(self, *args, **kwargs):
+        """
+        Get IDs of parent compounds in a background thread. See
+        PubChem.get_parent_cids for parameters.
+
+        Returns
+        -------
+        call : AsyncCall
+            Pending call. Its result is the return value of
+            PubChem.get_parent_cids.
+        """
+        return AsyncCall(super(AsyncPubChem, self).get_parent_cids, args,
+                         kwargs, submit=self.submit)
+
+    def get_ids_from_assay(self, *args, **kwargs):
+        """
+        Retrieve IDs tested in a PubChem BioAssay assay in a background
+        thread. See PubChem.get_ids_from_assay for parameters.
+
+        Returns
+        -------
+        call : AsyncCall
+            Pending call. Its result is the return value of
+            PubChem.get_ids_from_assay.
+        """
+        return AsyncCall(super(AsyncPubChem, self).get_ids_from_assay, args,
+                         kwargs, submit=self.submit)
+
+    def get_ids_from_assays(self, *args, **kwargs):
+        """
+        Retrieve IDs tested in several PubChem BioAssay assays in a
+        background thread. See PubChem.get_ids_from_assays for parameters.
+
+        Returns
+        -------
+        call : AsyncCall
+            Pending call. Its result is the return value of
+            PubChem.get_ids_from_assays.
+        """
+        return AsyncCall(super(AsyncPubChem, self).get_ids_from_assays, args,
+                         kwargs, submit=self.submit)
+
+    def _fetch(self, query, filename=None, compression=None, stream=False,
+               n_segments=1):
+        """
+        Store fetch arguments and return the pending query.
+
+        Parameters
+        ----------
+        query : AsyncPugQuery
+            PUG query.
+        filename : str, optional
+            Output filename. If not provided, the data is read into memory.
+        compression : str, optional
+            Compression type used to decode data.
+        stream : bool, optional (default False)
+            Whether to return a file-like object that downloads and
+            decompresses the data as it is read.
+        n_segments : int, optional (default 1)
+            Number of byte ranges to download in parallel when writing to
+            filename.
+        """
+        query.fetch_args = {'filename': filename, 'compression': compression,
+                            'stream': stream, 'n_segments': n_segments}
+        return query
+
+    @staticmethod
+    def gather(queries, timeout=None):
+        """
+        Wait for pending queries and return their results in order.
+
+        Parameters
+        ----------
+        queries : iterable
+            Pending requests, such as AsyncPugQuery, ChunkedQuery,
+            AsyncStructureSearch or AsyncCall objects.
+        timeout : float, optional
+            Maximum number of seconds to wait. If not provided, wait until all
+            queries are complete.
+        """
+        queries = list(queries)
+        if not wait(queries, timeout=timeout):
+            raise PUGError('Timed out waiting for PUG queries.')
+        return [query.result() for query in queries]
+
+
+class AsyncStructureSearch(object):
+    """
+    PUG REST identity search that can be monitored with `pug.wait` (and
+    `AsyncPubChem.gather`) alongside AsyncPugQuery objects.
+
+    Parameters
+    ----------
+    structure : str
+        SMILES or SDF query.
+    structure_format : str, optional (default 'smiles')
+        Structure format. Can be either 'smiles' or 'sdf'.
+    submit : bool, optional (default True)
+        Whether to automatically submit the search.
+    delay : int or PollingPolicy, optional (default 10)
+        Number of seconds to wait between status checks, or a policy that
+        chooses the wait before each status check.
+    pool : ConnectionPool, optional
+        Connection pool used for requests. If not provided, a new pool is
+        created.
+    rest_url : str, optional
+        Base URL for PUG REST requests.
+    max_attempts : int, optional (default 3)
+        Maximum number of consecutive failed status checks before the error
+        is raised.
+    """
+    def __init__(self, structure, structure_format='smiles', submit=True,
+                 delay=10, pool=None, rest_url=PubChem.rest_url,
+                 max_attempts=3):
+        self.structure = structure
+        self.structure_format = structure_format
+        self.polling = get_polling_policy(delay)
+        self.max_attempts = max_attempts
+        if pool is None:
+            pool = ConnectionPool()
+        self.pool = pool
+        self.rest_url = rest_url
+
+        self.id = None
+        self.cid = None
+        self.n_checks = 0
+        self.failures = 0
+        self.next_check = None
+        self.alive = False
+        self.finished = False
+
+        if submit:
+            self.submit()
+
+    def submit(self):
+        """
+        Submit the search. The first status check is due immediately.
+        """
+        self.id = _submit_structure_search(
+            self.structure, self.structure_format, pool=self.pool,
+            rest_url=self.rest_url)
+        if self.id is None:
+            self.finished = True
+            return
+        self.alive = True
+        self.next_check = time.time()
+
+    def done(self):
+        """
+        Whether the search is complete.
+        """
+        return self.finished
+
+    def poll(self):
+        """
+        Check the status of the search once and return whether it is done.
+        """
+        if not self.finished:
+            done, cid, self.failures = _check_structure_search(
+                self.id, self.failures, self.max_attempts, pool=self.pool,
+                rest_url=self.rest_url)
+            if done:
+                self.cid = cid
+                self.finished = True
+                self.alive = False
+            else:
+                delay = self.polling.get_delay(self.n_checks)
+                self.next_check = time.time() + delay
+                self.n_checks += 1
+        return self.finished
+
+    def result(self):
+        """
+        Wait for the search to complete and return the matching CID (or
+        None).
+        """
+        wait([self])
+        return self.cid
+
+
+class ChunkedQuery(object):
+    """
+    Chunked PUG download that can be monitored with `pug.wait` (and
+    `AsyncPubChem.gather`) alongside other pending requests.
+
+    Chunk queries are submitted as earlier chunks complete, with at most
+    max_in_flight running at once. Their results are fetched and merged in
+    chunk order by `result`, using the stored fetch arguments.
+
+    Parameters
+    ----------
+    engine : AsyncPubChem
+        Engine used to create the chunk queries.
+    queries : list
+        PUG query XML for each chunk.
+    max_in_flight : int, optional (default 1)
+        Maximum number of chunk queries to run concurrently.
+    submit : bool, optional (default True)
+        Whether to automatically submit the first chunk queries.
+    """
+    def __init__(self, engine, queries, max_in_flight=1, submit=True):
+        self.engine = engine
+        self.queries = queries
+        self.max_in_flight = max(1, max_in_flight)
+
+        self.chunks = []
+        self.fetch_args = {}
+        self.alive = False
+
+        if submit:
+            self.submit()
+
+    @property
+    def next_check(self):
+        """
+        Time of the next status check due for a running chunk query.
+        """
+        checks = [query.next_check for query in self.chunks
+                  if not query.done()]
+        if not checks:
+            return time.time()
+        return min(checks)
+
+    def submit(self):
+        """
+        Submit the first chunk queries.
+        """
+        self.alive = True
+        self.submit_chunks()
+
+    def submit_chunks(self):
+        """
+        Submit chunk queries until max_in_flight are running.
+        """
+        running = sum(1 for query in self.chunks if not query.done())
+        while (running < self.max_in_flight and
+               len(self.chunks) < len(self.queries)):
+            query = self.engine.get_async_query(
+                self.queries[len(self.chunks)])
+            if not query.alive and not query.done():
+                query.submit()
+            self.chunks.append(query)
+            if not query.done():
+                running += 1
+        if self.done():
+            self.alive = False
+
+    def done(self):
+        """
+        Whether every chunk query is complete.
+        """
+        return (len(self.chunks) == len(self.queries) and
+                all(query.done() for query in self.chunks))
+
+    def poll(self):
+        """
+        Check the status of chunk queries that are due, submit further
+        chunks and return whether every chunk is complete.
+        """
+        now = time.time()
+        for query in self.chunks:
+            if not query.done() and query.next_check <= now:
+                query.poll()
+        self.submit_chunks()
+        return self.done()
+
+    def result(self):
+        """
+        Wait for every chunk to complete and fetch the merged result.
+        """
+        wait([self])
+        filename = self.fetch_args.get('filename')
+        compression = self.fetch_args.get('compression')
+        if filename is None:
+            if self.fetch_args.get('stream'):
+                return ChainedReader(
+                    query.fetch(compression=compression, stream=True)
+                    for query in self.chunks)
+            return ''.join(query.fetch(compression=compression)
+                           for query in self.chunks)
+        temp_dir = tempfile.mkdtemp()
+        try:
+            chunk_filenames = [
+                os.path.join(temp_dir, 'chunk-{}'.format(i))
+                for i in xrange(len(self.chunks))]
+            for query, chunk_filename in zip(self.chunks, chunk_filenames):
+                query.fetch(chunk_filename)
+            _concatenate_files(chunk_filenames, filename)
+        finally:
+            shutil.rmtree(temp_dir)
+        return filename
+
+
+def _concatenate_files(filenames, filename):
+    """
+    Concatenate files.
+
+    Parameters
+    ----------
+    filenames : list
+        Input filenames.
+    filename : str
+        Output filename.
+    """
+    with open(filename, 'wb') as outfile:
+        for chunk_filename in filenames:
+            with open(chunk_filename, 'rb') as infile:
+                shutil.copyfileobj(infile, outfile)
+
+
+def _fetch_query(engine, query, filename=None, compression=None):
+    """
+    Worker for PubChem._fetch_chunks.
+
+    Parameters
+    ----------
+    engine : PubChem
+        PubChem instance used to create the query.
+    query : str
+        PUG query XML.
+    filename : str, optional
+        Output filename. If not provided, the data is read into memory.
+    compression : str, optional
+        Compression type used to decode data.
+    """
+    return engine.get_query(query).fetch(filename, compression=compression)
+
+
+def _get_records_rest(ids, sids=False, use_3d=False, batch_size=100,
+                      max_attempts=3, pool=None, rest_url=PubChem.rest_url):
+    """
+    Parallel worker for PubChem.get_records_rest.
+
+    Parameters
+    ----------
+    ids : list
+        PubChem substance or compound IDs.
+    sids : bool, optional (default False)
+        Whether ids are SIDs. If False, IDs are assumed to be CIDs.
+    use_3d : bool, optional (default False)
+        Whether to query 3D information.
+    batch_size : int (default 100)
+        Number of IDs per request.
     max_attempts : int (default 3)
         Maximum number of query attempts. The batch_size is halved after each
         failure.
+    pool : ConnectionPool, optional
+        Connection pool used for requests. If not provided, a new pool is
+        created.
+    rest_url : str, optional
+        Base URL for PUG REST requests.
     """
-    url = ('http://pubchem.ncbi.nlm.nih.gov/rest/pug/assay/aid/' +
-           '{aids}/description/{format}')
-    descriptions = []
+    if pool is None:
+        pool = ConnectionPool()
+    if sids:
+        url = rest_url + '/substance/sid/SDF'
+        key = 'sid'
+    else:
+        url = rest_url + '/compound/cid/SDF'
+        key = 'cid'
+    if use_3d:
+        url += '?record_type=3d'
+    records = []
     failures = 0
     start = 0
-    while True:
-        if start >= len(aids):
-            break  # stop when we are out of AIDs
-        query_aids = aids[start:start+batch_size]
-        query = url.format(aids=','.join([str(aid) for aid in query_aids]),
-                           format=output_format)
+    while start < len(ids):
+        query_ids = ids[start:start + batch_size]
+        post_data = urllib.urlencode(
+            {key: ','.join([str(uid) for uid in query_ids])})
         try:
-            response = urllib2.urlopen(query)
-        except urllib2.HTTPError as e:
+            response = pool.urlopen(url, post_data)
+        except urllib2.URLError as e:  # HTTP and network errors
             failures += 1
-            batch_size /= 2  # halve the batch size and try again
+            batch_size = max(1, batch_size // 2)  # halve the batch size
             if failures >= max_attempts:
                 raise e
             continue
-        descriptions.append(response.read())
+        records.append(response.read())
         failures = 0  # reset the failure count
-        start += batch_size  # move the start index
-    return descriptions
+        start += len(query_ids)  # move the start index
+    return records
+
+
+def _get_ids_from_assay(aid, sids=False, activity_outcome=None, pool=None,
+                        rest_url=PubChem.rest_url):
+    """
+    Parallel worker for PubChem.get_ids_from_assay and
+    PubChem.get_ids_from_assays.
+
+    Parameters
+    ----------
+    aid : int
+        PubChem BioAssay assay ID (AID).
+    sids : bool, optional (default False)
+        Whether ids are SIDs. If False, IDs are assumed to be CIDs.
+    activity_outcome : str, optional
+        If provided, only retrieve records with this activity outcome, such
+        as 'active'.
+    pool : ConnectionPool, optional
+        Connection pool used for requests. If not provided, a new pool is
+        created.
+    rest_url : str, optional
+        Base URL for PUG REST requests.
+    """
+    if pool is None:
+        pool = ConnectionPool()
+    url_template = rest_url + '/assay/aid/%(aid)s/%(database)s/txt'
+    mapping = {'aid': aid}
+    if sids:
+        mapping['database'] = 'sids'
+    else:
+        mapping['database'] = 'cids'
+    if activity_outcome is not None:
+        url_template += '?{}_type={}'.format(mapping['database'],
+                                             activity_outcome.lower())
+    response = pool.urlopen(url_template % mapping)
+    try:
+        ids = read_int_array(response)
+    finally:
+        response.close()
+    return ids[ids != 0]  # 0 is not a valid ID
+
+
+def _get_parent_cids(cids, batch_size=10000, max_attempts=3, pool=None,
+                     rest_url=PubChem.rest_url):
+    """
+    Parallel worker for PubChem.get_parent_cids.
+
+    Parameters
+    ----------
+    cids : ndarray
+        Unique PubChem compound IDs.
+    batch_size : int (default 10000)
+        Number of CIDs per request.
+    max_attempts : int (default 3)
+        Maximum number of query attempts. The batch_size is halved after each
+        failure.
+    pool : ConnectionPool, optional
+        Connection pool used for requests. If not provided, a new pool is
+        created.
+    rest_url : str, optional
+        Base URL for PUG REST requests.
+
+    Returns
+    -------
+    children : ndarray
+        Input CIDs, repeated once for each of their parents (uint32).
+    parents : ndarray
+        Parent CIDs, aligned with children (uint32).
+    """
+    if pool is None:
+        pool = ConnectionPool()
+    url = (rest_url + '/compound/cid/cids/JSON' +
+           '?cids_type=parent&list_return=grouped')
+    children, parents = [], []
+    failures = 0
+    start = 0
+    while start < len(cids):
+        query_cids = cids[start:start + batch_size]
+        post_data = urllib.urlencode(
+            {'cid': ','.join([str(cid) for cid in query_cids])})
+        try:
+            response = pool.urlopen(url, post_data)
+        except urllib2.URLError as e:  # HTTP and network errors
+            failures += 1
+            batch_size = max(1, batch_size // 2)  # halve the batch size
+            if failures >= max_attempts:
+                raise e
+            continue
+        info = json.loads(response.read())['InformationList']['Information']
+        counts = np.zeros(len(info), dtype=np.int64)
+        for i, entry in enumerate(info):
+            if not isinstance(entry.get('CID'), (int, long)):
+                raise PUGError('Unexpected parent CID response: {}'.format(
+                    entry))
+            counts[i] = len(entry.get('ParentCID', ()))
+        batch_children = np.fromiter((entry['CID'] for entry in info),
+                                     dtype=np.int64, count=len(info))
+        batch_parents = np.fromiter(
+            (parent for entry in info
+             for parent in entry.get('ParentCID', ())),
+            dtype=np.int64, count=counts.sum())
+        children.append(np.repeat(batch_children, counts).astype(np.uint32))
+        parents.append(batch_parents.astype(np.uint32))
+        failures = 0  # reset the failure count
+        start += len(query_cids)  # move the start index
+    if not children:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint32)
+    return np.concatenate(children), np.concatenate(parents)
+
+
+def _submit_structure_search(structure, structure_format='smiles',
+                             max_attempts=1, strict=True, pool=None,
+                             rest_url=PubChem.rest_url):
+    """
+    Submit a PUG REST identity search.
+
+    Parameters
+    ----------
+    structure : str
+        SMILES or SDF query.
+    structure_format : str, optional (default 'smiles')
+        Structure format. Can be either 'smiles' or 'sdf'.
+    max_attempts : int, optional (default 1)
+        Maximum number of attempts.
+    strict : bool, optional (default True)
+        Whether to raise an exception if the query is rejected. If False,
+        None is returned instead.
+    pool : ConnectionPool, optional
+        Connection pool used for requests. If not provided, a new pool is
+        created.
+    rest_url : str, optional
+        Base URL for PUG REST requests.
+
+    Returns
+    -------
+    request_id : str
+        ListKey for the search, or None if the search was not accepted.
+    """
+    if pool is None:
+        pool = ConnectionPool()
+    url = rest_url + '/compound/identity/{}/XML'.format(structure_format)
+    post_data = urllib.urlencode({structure_format: structure})
+    for attempt in xrange(max_attempts):
+        try:
+            response = pool.urlopen(url, data=post_data)
+            break
+        except urllib2.URLError as e:
+            code = getattr(e, 'code', 500)  # retry network errors
+            if code < 500 and not strict:
+                return None
+            if code < 500 or attempt == max_attempts - 1:
+                raise e
+    request_id = None
+    for line in response.readlines():
+        search = re.search('<ListKey>(\d+)</ListKey>', line)
+        if search is not None:
+            request_id = search.groups()[0]
+    return request_id
+
+
+def _check_structure_search(request_id, failures=0, max_attempts=3,
+                            pool=None, rest_url=PubChem.rest_url):
+    """
+    Check the status of a PUG REST identity search.
+
+    Parameters
+    ----------
+    request_id : str
+        ListKey for the search.
+    failures : int, optional (default 0)
+        Number of consecutive failed status checks before this one.
+    max_attempts : int, optional (default 3)
+        Maximum number of consecutive failed status checks. Server and
+        network errors are raised once this limit is reached.
+    pool : ConnectionPool, optional
+        Connection pool used for requests. If not provided, a new pool is
+        created.
+    rest_url : str, optional
+        Base URL for PUG REST requests.
+
+    Returns
+    -------
+    done : bool
+        Whether the search is complete. Server errors below max_attempts are
+        treated as incomplete searches so they are checked again.
+    cid : int
+        Matching CID, or None if the search is not complete or did not
+        match.
+    failures : int
+        Number of consecutive failed status checks, including this one.
+    """
+    if pool is None:
+        pool = ConnectionPool()
+    url = rest_url + '/compound/listkey/{}/cids/XML'.format(request_id)
+    try:
+        response = pool.urlopen(url)
+    except urllib2.URLError as e:
+        if getattr(e, 'code', 500) < 500:
+            return True, None, 0
+        failures += 1
+        if failures >= max_attempts:
+            raise
+        return False, None, failures
+    cid = None
+    for line in response.readlines():
+        search = re.search('<CID>(\d+)</CID>', line)
+        if search is not None:
+            cid = int(search.groups()[0])
+    return cid is not None, cid, 0
+
+
+def _get_assay_descriptions(aids, queue, results, output_format='json',
+                            pool=None, rest_url=PubChem.rest_url):
+    """
+    Thread worker for PubChem.get_assay_descriptions.
+
+    Parameters
+    ----------
+    aids : list
+        List of assay IDs.
+    queue : BatchQueue
+        Queue of batches over aids shared by all workers.
+    results : dict
+        Maps the start index of each completed batch to its descriptions.
+    output_format : str (default='json')
+        Output format.
+    pool : ConnectionPool, optional
+        Connection pool used for requests. If not provided, a new pool is
+        created.
+    rest_url : str, optional
+        Base URL for PUG REST requests.
+    """
+    if pool is None:
+        pool = ConnectionPool()
+    url = rest_url + '/assay/aid/{aids}/description/{format}'
+    while True:
+        batch = queue.get()
+        if batch is None:
+            break  # stop when we are out of AIDs
+        start, stop, _ = batch
+        query = url.format(aids=','.join([str(aid) for aid in
+                                          aids[start:stop]]),
+                           format=output_format)
+        try:
+            data = json.loads(pool.urlopen(query).read())
+            assert len(data) == 1
+            assert data.keys()[0] == 'PC_AssayContainer'
+            results[start] = [description['assay']['descr']
+                              for description in data['PC_AssayContainer']]
+        except urllib2.URLError as e:  # HTTP and network errors
+            queue.failed(batch, e)
+            continue
+        except Exception as e:
+            queue.stop(e)  # don't leave other workers waiting
+            raise
+        queue.done(batch)
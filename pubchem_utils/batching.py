@@ -0,0 +1,136 @@
+"""
+Adaptive batching for concurrent PUG REST requests.
+"""
+import threading
+
+__author__ = "Steven Kearnes"
+__copyright__ = "Copyright 2014, Stanford University"
+__license__ = "3-clause BSD"
+
+
+class BatchQueue(object):
+    """
+    Thread-safe queue of batches over a sequence of items.
+
+    Workers take batches with `get` and report them with `done` or `failed`.
+    The batch size is halved after a failure and doubled after `patience`
+    consecutive successes (up to the initial batch size), so it tracks the
+    largest batch the server currently accepts. Failed batches are split in
+    half and retried; a batch that fails max_attempts times in a row stops
+    the queue.
+
+    Parameters
+    ----------
+    n_items : int
+        Number of items.
+    batch_size : int
+        Initial (and maximum) number of items per batch.
+    max_attempts : int, optional (default 3)
+        Maximum number of consecutive failures for any item.
+    patience : int, optional (default 10)
+        Number of consecutive successes before the batch size is increased.
+    """
+    def __init__(self, n_items, batch_size, max_attempts=3, patience=10):
+        self.n_items = n_items
+        self.max_batch_size = batch_size
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.patience = patience
+
+        self.condition = threading.Condition()
+        self.next_start = 0
+        self.retries = []
+        self.n_in_flight = 0
+        self.n_successes = 0
+        self.error = None
+
+    def get(self):
+        """
+        Get the next batch, waiting for batches that may be retried.
+
+        Returns
+        -------
+        batch : tuple
+            (start, stop, attempts) for the next batch, or None if there
+            are no more batches or the queue was stopped by an error.
+        """
+        with self.condition:
+            while True:
+                if self.error is not None:
+                    return None
+                if self.retries:
+                    batch = self.retries.pop()
+                    break
+                if self.next_start < self.n_items:
+                    stop = min(self.next_start + self.batch_size,
+                               self.n_items)
+                    batch = (self.next_start, stop, 0)
+                    self.next_start = stop
+                    break
+                if not self.n_in_flight:
+                    return None
+                self.condition.wait()
+            self.n_in_flight += 1
+            return batch
+
+    def done(self, batch):
+        """
+        Report a successful batch.
+
+        Parameters
+        ----------
+        batch : tuple
+            Batch returned by `get`.
+        """
+        with self.condition:
+            self.n_in_flight -= 1
+            self.n_successes += 1
+            if (self.n_successes >= self.patience and
+                    self.batch_size < self.max_batch_size):
+                self.batch_size = min(2 * self.batch_size,
+                                      self.max_batch_size)
+                self.n_successes = 0
+            self.condition.notify_all()
+
+    def failed(self, batch, error):
+        """
+        Report a failed batch. The batch is split in half and retried.
+
+        Parameters
+        ----------
+        batch : tuple
+            Batch returned by `get`.
+        error : Exception
+            Error raised for the batch. It is stored in the error attribute
+            if the batch has failed max_attempts times.
+        """
+        start, stop, attempts = batch
+        attempts += 1
+        with self.condition:
+            self.n_in_flight -= 1
+            self.n_successes = 0
+            self.batch_size = max(1, min(self.batch_size,
+                                         (stop - start) // 2))
+            if attempts >= self.max_attempts:
+                self.error = error
+            elif stop - start > 1:
+                middle = start + (stop - start) // 2
+                self.retries.extend([(middle, stop, attempts),
+                                     (start, middle, attempts)])
+            else:
+                self.retries.append((start, stop, attempts))
+            self.condition.notify_all()
+
+    def stop(self, error):
+        """
+        Stop the queue after an unexpected error in a worker.
+
+        Parameters
+        ----------
+        error : Exception
+            Error raised by the worker.
+        """
+        with self.condition:
+            self.n_in_flight -= 1
+            self.error = error
+            self.condition.notify_all()
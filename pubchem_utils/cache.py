@@ -0,0 +1,279 @@
+"""
+Persistent on-disk caches for PubChem records and identifier mappings.
+"""
+import sqlite3
+import threading
+import time
+
+__author__ = "Steven Kearnes"
+__copyright__ = "Copyright 2014, Stanford University"
+__license__ = "3-clause BSD"
+
+
+class RecordCache(object):
+    """
+    SQLite cache for PubChem records.
+
+    Records are keyed by (database, ID, format, use_3d, n_conformers). When
+    the total size of cached records exceeds max_size, the least recently
+    used records are evicted. The cache can be shared between threads.
+
+    Parameters
+    ----------
+    filename : str
+        SQLite database filename. Use ':memory:' for a temporary cache.
+    max_size : int, optional
+        Maximum total size of cached records, in bytes. If not provided,
+        records are never evicted.
+    """
+    batch_size = 500  # stay below the SQLite limit on query parameters
+
+    def __init__(self, filename, max_size=None):
+        self.filename = filename
+        self.max_size = max_size
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.text_factory = str
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS records (
+                    database TEXT NOT NULL,
+                    uid INTEGER NOT NULL,
+                    format TEXT NOT NULL,
+                    use_3d INTEGER NOT NULL,
+                    n_conformers INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    accessed REAL NOT NULL,
+                    PRIMARY KEY (database, uid, format, use_3d, n_conformers)
+                )""")
+            self.connection.execute("""
+                CREATE INDEX IF NOT EXISTS records_accessed
+                ON records (accessed)""")
+
+    def __len__(self):
+        with self.lock:
+            cursor = self.connection.execute('SELECT COUNT(*) FROM records')
+            return cursor.fetchone()[0]
+
+    def get(self, database, uids, download_format='sdf', use_3d=False,
+            n_conformers=1):
+        """
+        Get cached records.
+
+        Parameters
+        ----------
+        database : str
+            PubChem database ('pccompound' or 'pcsubstance').
+        uids : iterable
+            PubChem substance or compound IDs.
+        download_format : str, optional (default 'sdf')
+            Record format.
+        use_3d : bool, optional (default False)
+            Whether records contain 3D information.
+        n_conformers : int, optional (default 1)
+            Number of conformers per record.
+
+        Returns
+        -------
+        records : dict
+            Maps IDs to cached records. IDs that are not cached are omitted.
+        """
+        uids = [int(uid) for uid in uids]
+        records = {}
+        now = time.time()
+        with self.lock, self.connection:
+            for i in xrange(0, len(uids), self.batch_size):
+                batch = uids[i:i + self.batch_size]
+                params = [database, download_format, int(use_3d),
+                          n_conformers]
+                where = ('database = ? AND format = ? AND use_3d = ? AND '
+                         'n_conformers = ? AND uid IN ({})'.format(
+                             ','.join('?' * len(batch))))
+                cursor = self.connection.execute(
+                    'SELECT uid, data FROM records WHERE ' + where,
+                    params + batch)
+                for uid, data in cursor:
+                    records[uid] = str(data)
+                self.connection.execute(
+                    'UPDATE records SET accessed = ? WHERE ' + where,
+                    [now] + params + batch)
+        return records
+
+    def put(self, database, records, download_format='sdf', use_3d=False,
+            n_conformers=1):
+        """
+        Add records to the cache.
+
+        Parameters
+        ----------
+        database : str
+            PubChem database ('pccompound' or 'pcsubstance').
+        records : dict
+            Maps PubChem substance or compound IDs to records.
+        download_format : str, optional (default 'sdf')
+            Record format.
+        use_3d : bool, optional (default False)
+            Whether records contain 3D information.
+        n_conformers : int, optional (default 1)
+            Number of conformers per record.
+        """
+        now = time.time()
+        rows = [(database, int(uid), download_format, int(use_3d),
+                 n_conformers, sqlite3.Binary(data), len(data), now)
+                for uid, data in records.iteritems()]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO records '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            if self.max_size is not None:
+                self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used records until the cache is no larger
+        than max_size. Must be called with the lock held.
+        """
+        cursor = self.connection.execute('SELECT SUM(size) FROM records')
+        size = cursor.fetchone()[0] or 0
+        if size <= self.max_size:
+            return
+        cursor = self.connection.execute(
+            'SELECT rowid, size FROM records ORDER BY accessed')
+        rowids = []
+        for rowid, record_size in cursor:
+            if size <= self.max_size:
+                break
+            rowids.append(rowid)
+            size -= record_size
+        for i in xrange(0, len(rowids), self.batch_size):
+            batch = rowids[i:i + self.batch_size]
+            self.connection.execute(
+                'DELETE FROM records WHERE rowid IN ({})'.format(
+                    ','.join('?' * len(batch))), batch)
+
+    def clear(self):
+        """
+        Remove all records from the cache.
+        """
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM records')
+
+    def close(self):
+        """
+        Close the cache database.
+        """
+        with self.lock:
+            self.connection.close()
+
+
+class MappingStore(object):
+    """
+    SQLite store for resolved PubChem identifier exchange mappings.
+
+    Mappings are keyed by (source, operation_type, output_type, source ID).
+    Only matched IDs are stored, so unmatched IDs are looked up again by
+    later queries. The store can be shared between threads.
+
+    Parameters
+    ----------
+    filename : str
+        SQLite database filename. Use ':memory:' for a temporary store.
+    """
+    batch_size = 500  # stay below the SQLite limit on query parameters
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.text_factory = str
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS mappings (
+                    source TEXT NOT NULL,
+                    operation_type TEXT NOT NULL,
+                    output_type TEXT NOT NULL,
+                    source_id TEXT NOT NULL,
+                    dest NOT NULL,
+                    PRIMARY KEY (source, operation_type, output_type,
+                                 source_id)
+                )""")
+
+    def __len__(self):
+        with self.lock:
+            cursor = self.connection.execute('SELECT COUNT(*) FROM mappings')
+            return cursor.fetchone()[0]
+
+    def get(self, source, source_ids, operation_type='same',
+            output_type='cid'):
+        """
+        Get stored mappings.
+
+        Parameters
+        ----------
+        source : str
+            Input source, such as 'ChEMBL'.
+        source_ids : iterable
+            Input identifiers.
+        operation_type : str, optional (default 'same')
+            Operation type.
+        output_type : str, optional (default 'cid')
+            Output type.
+
+        Returns
+        -------
+        id_map : dict
+            Maps input identifiers to output identifiers. Identifiers that
+            are not stored are omitted.
+        """
+        source_ids = [str(source_id) for source_id in source_ids]
+        id_map = {}
+        with self.lock:
+            for i in xrange(0, len(source_ids), self.batch_size):
+                batch = source_ids[i:i + self.batch_size]
+                cursor = self.connection.execute(
+                    'SELECT source_id, dest FROM mappings WHERE source = ? '
+                    'AND operation_type = ? AND output_type = ? AND '
+                    'source_id IN ({})'.format(','.join('?' * len(batch))),
+                    [source, operation_type, output_type] + batch)
+                id_map.update(cursor)
+        return id_map
+
+    def put(self, source, id_map, operation_type='same', output_type='cid'):
+        """
+        Add mappings to the store. Unmatched IDs (mapped to None) are
+        ignored.
+
+        Parameters
+        ----------
+        source : str
+            Input source, such as 'ChEMBL'.
+        id_map : dict
+            Maps input identifiers to output identifiers.
+        operation_type : str, optional (default 'same')
+            Operation type.
+        output_type : str, optional (default 'cid')
+            Output type.
+        """
+        rows = [(source, operation_type, output_type, str(source_id), dest)
+                for source_id, dest in id_map.iteritems()
+                if dest is not None]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO mappings VALUES (?, ?, ?, ?, ?)', rows)
+
+    def clear(self):
+        """
+        Remove all mappings from the store.
+        """
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM mappings')
+
+    def close(self):
+        """
+        Close the store database.
+        """
+        with self.lock:
+            self.connection.close()
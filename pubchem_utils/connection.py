@@ -0,0 +1,686 @@
+"""
+Persistent HTTP connections for PubChem requests.
+"""
+import base64
+import httplib
+import json
+import os
+import re
+import shutil
+import socket
+from StringIO import StringIO
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+from joblib import delayed, Parallel
+
+from .streaming import DecompressingReader
+
+__author__ = "Steven Kearnes"
+__copyright__ = "Copyright 2014, Stanford University"
+__license__ = "3-clause BSD"
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of keep-alive HTTP and HTTPS connections.
+
+    Connections are checked out for the duration of a single request and
+    returned to the pool once the response has been read, so consecutive
+    requests to the same host skip TCP and TLS setup. As with
+    urllib2.urlopen, error responses raise urllib2.HTTPError and network
+    errors (such as refused or reset connections) raise urllib2.URLError.
+
+    FTP URLs on hosts listed in `ftp_mirrors` (such as the PUG download URLs
+    on ftp.ncbi.nlm.nih.gov) are fetched from their HTTPS mirrors, so they
+    use pooled connections and resumable, segmented downloads.
+
+    Requests are sent through the proxies configured in the environment
+    (http_proxy, https_proxy and no_proxy), as with urllib2.urlopen: HTTP
+    requests are sent to the proxy with absolute URIs and HTTPS connections
+    are tunneled through the proxy with CONNECT.
+
+    Parameters
+    ----------
+    pool_size : int, optional (default 10)
+        Maximum number of idle connections kept for each host.
+    timeout : float, optional
+        Socket timeout, in seconds.
+    max_redirects : int, optional (default 5)
+        Maximum number of redirects to follow for a single request.
+    rate_limiter : ratelimit.RateLimiter, optional
+        Rate limiter consulted before every request sent through the pool,
+        including redirects and download range requests.
+    metrics : metrics.Metrics, optional
+        Metrics that record the latency of every request sent through the
+        pool, by endpoint.
+    proxies : dict, optional
+        Proxy URLs keyed by URL scheme ('http' or 'https'). Defaults to the
+        proxies configured in the environment (see urllib.getproxies).
+    """
+    ftp_mirrors = {'ftp.ncbi.nlm.nih.gov': 'https://ftp.ncbi.nlm.nih.gov'}
+
+    def __init__(self, pool_size=10, timeout=None, max_redirects=5,
+                 rate_limiter=None, metrics=None, proxies=None):
+        if proxies is None:
+            proxies = urllib.getproxies()
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        self.proxies = proxies
+
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        state['connections'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_proxy(self, scheme, host):
+        """
+        Get the proxy for requests to a host.
+
+        Parameters
+        ----------
+        scheme : str
+            URL scheme ('http' or 'https').
+        host : str
+            Host name, optionally including a port.
+
+        Returns
+        -------
+        proxy : urlparse.SplitResult
+            Parsed proxy URL, or None if requests to the host are not
+            proxied.
+        """
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.proxy_bypass(host.split(':')[0]):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        return urlparse.urlsplit(proxy)
+
+    @staticmethod
+    def get_proxy_headers(proxy):
+        """
+        Get the headers that authenticate requests to a proxy.
+
+        Parameters
+        ----------
+        proxy : urlparse.SplitResult
+            Parsed proxy URL.
+        """
+        if proxy.username is None:
+            return {}
+        credentials = '{}:{}'.format(urllib.unquote(proxy.username),
+                                     urllib.unquote(proxy.password or ''))
+        return {'Proxy-Authorization':
+                'Basic ' + base64.b64encode(credentials)}
+
+    def get_connection(self, scheme, host):
+        """
+        Check out an idle connection or create a new one.
+
+        Connections to proxied hosts are opened to the proxy; HTTPS
+        connections are tunneled through it to the host.
+
+        Parameters
+        ----------
+        scheme : str
+            URL scheme ('http' or 'https').
+        host : str
+            Host name, optionally including a port.
+
+        Returns
+        -------
+        connection : httplib.HTTPConnection
+            Connection to the host.
+        reused : bool
+            Whether the connection was taken from the pool.
+        """
+        with self.lock:
+            idle = self.connections.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+        proxy = self.get_proxy(scheme, host)
+        if proxy is None:
+            address = host
+        else:
+            address = proxy.netloc.rpartition('@')[2]
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(address,
+                                                 timeout=self.timeout)
+        else:
+            connection = httplib.HTTPConnection(address, timeout=self.timeout)
+        if proxy is not None and scheme == 'https':
+            connection.set_tunnel(host, headers=self.get_proxy_headers(proxy))
+        return connection, False
+
+    def release(self, scheme, host, connection):
+        """
+        Return a connection to the pool.
+
+        Parameters
+        ----------
+        scheme : str
+            URL scheme ('http' or 'https').
+        host : str
+            Host name, optionally including a port.
+        connection : httplib.HTTPConnection
+            Connection to return.
+        """
+        with self.lock:
+            idle = self.connections.setdefault((scheme, host), [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self.lock:
+            connections, self.connections = self.connections, {}
+        for idle in connections.itervalues():
+            for connection in idle:
+                connection.close()
+
+    def get_mirror_url(self, url):
+        """
+        Get the HTTP(S) mirror URL for an FTP URL, if the host is mirrored.
+
+        Parameters
+        ----------
+        url : str
+            URL.
+        """
+        parts = urlparse.urlsplit(url)
+        if parts.scheme != 'ftp' or parts.hostname not in self.ftp_mirrors:
+            return url
+        mirror = self.ftp_mirrors[parts.hostname].rstrip('/')
+        return mirror + urlparse.urlunsplit(('', '', parts.path or '/',
+                                             parts.query, ''))
+
+    def urlopen(self, url, data=None, headers=None):
+        """
+        Open a URL using a pooled connection.
+
+        FTP URLs are replaced with their HTTPS mirrors (see
+        `get_mirror_url`). Other URLs with schemes other than HTTP and HTTPS
+        are opened with urllib2.urlopen.
+
+        Parameters
+        ----------
+        url : str
+            URL to open.
+        data : str or file-like, optional
+            Request body. If provided, a POST request is sent. File-like
+            bodies (such as queries.QueryBody) must support len() and
+            seek(0), and are sent without reading them into memory.
+        headers : dict, optional
+            Additional request headers.
+
+        Returns
+        -------
+        response : PooledResponse
+            File-like response.
+        """
+        url = self.get_mirror_url(url)
+        for _ in xrange(self.max_redirects + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ['http', 'https']:
+                if hasattr(data, 'read'):
+                    data.seek(0)
+                    data = data.read()
+                request = urllib2.Request(url, data, headers or {})
+                start = time.time()
+                try:
+                    response = urllib2.urlopen(request)
+                except urllib2.URLError:
+                    if self.metrics is not None:
+                        self.metrics.add_request(url, time.time() - start,
+                                                 None)
+                    raise
+                if self.metrics is not None:
+                    self.metrics.add_request(url, time.time() - start,
+                                             response.getcode())
+                return response
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            request_headers = {}
+            if data is not None:
+                request_headers['Content-Type'] = (
+                    'application/x-www-form-urlencoded')
+            if hasattr(data, 'read'):
+                request_headers['Content-Length'] = str(len(data))
+            if headers is not None:
+                request_headers.update(headers)
+            start = time.time()
+            try:
+                response, connection = self.request(
+                    parts.scheme, parts.netloc, data, path, request_headers)
+            except (httplib.HTTPException, socket.error) as e:
+                if self.metrics is not None:
+                    self.metrics.add_request(url, time.time() - start, None)
+                raise urllib2.URLError(e)  # as with urllib2.urlopen
+            if self.metrics is not None:
+                self.metrics.add_request(url, time.time() - start,
+                                         response.status)
+            response = PooledResponse(
+                response, url, self, parts.scheme, parts.netloc, connection)
+            if response.code in [301, 302, 303, 307, 308]:
+                location = response.info().getheader('location')
+                response.read()
+                response.close()
+                url = urlparse.urljoin(url, location)
+                if response.code not in [307, 308]:
+                    data = None
+                continue
+            if response.code >= 400:
+                body = response.read()
+                response.close()
+                raise urllib2.HTTPError(url, response.code, response.reason,
+                                        response.info(), StringIO(body))
+            return response
+        raise urllib2.HTTPError(url, response.code, 'Too many redirects.',
+                                response.info(), None)
+
+    def request(self, scheme, host, data, path, headers):
+        """
+        Send a request, retrying if a pooled connection has gone stale.
+
+        Parameters
+        ----------
+        scheme : str
+            URL scheme ('http' or 'https').
+        host : str
+            Host name, optionally including a port.
+        data : str or file-like
+            Request body. If provided, a POST request is sent.
+        path : str
+            Request path, including the query string.
+        headers : dict
+            Request headers.
+        """
+        if data is None:
+            method = 'GET'
+        else:
+            method = 'POST'
+        proxy = self.get_proxy(scheme, host)
+        if proxy is not None and scheme == 'http':
+            path = 'http://' + host + path  # proxies expect absolute URIs
+            headers = dict(headers, **self.get_proxy_headers(proxy))
+        while True:
+            connection, reused = self.get_connection(scheme, host)
+            if hasattr(data, 'seek'):
+                data.seek(0)  # rewind bodies that were partly sent
+            try:
+                connection.request(method, path, data, headers)
+                return connection.getresponse(), connection
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if not reused:
+                    raise
+
+    def download(self, url, filename, max_attempts=5, n_segments=1):
+        """
+        Download a URL to a file, resuming after dropped connections.
+
+        Data is written to filename + '.part' and moved to filename once the
+        download is complete. Interrupted transfers are resumed with HTTP
+        Range requests, and a partial file left by an earlier call for the
+        same URL is resumed rather than downloaded again. Partial files are
+        discarded if the number of segments or the size of the download has
+        changed since they were written. FTP URLs with an
+        HTTPS mirror (see `get_mirror_url`) are downloaded from the mirror;
+        other non-HTTP URLs are copied without resuming.
+
+        Parameters
+        ----------
+        url : str
+            URL to download.
+        filename : str
+            Output filename.
+        max_attempts : int, optional (default 5)
+            Maximum number of consecutive failed attempts for each segment.
+        n_segments : int, optional (default 1)
+            Number of byte ranges to download in parallel. Ignored if the
+            server does not support range requests.
+        """
+        url = self.get_mirror_url(url)
+        partial = filename + '.part'
+        marker = partial + '.url'
+        http = urlparse.urlsplit(url).scheme in ['http', 'https']
+        size = None
+        if http and (n_segments > 1 or os.path.exists(marker)):
+            size = self.get_size(url)
+        if size is None or size < n_segments:
+            n_segments = 1
+        state = {'url': url, 'n_segments': n_segments, 'size': size}
+        if not self.check_marker(marker, state):
+            for name in [partial] + self.get_segment_files(partial):
+                if os.path.exists(name):
+                    os.remove(name)
+        with open(marker, 'wb') as f:
+            json.dump(state, f)
+        if not http:
+            response = self.urlopen(url)
+            with open(partial, 'wb') as f:
+                shutil.copyfileobj(response, f)
+            response.close()
+        elif n_segments > 1:
+            bounds = [size * i // n_segments for i in xrange(n_segments + 1)]
+            segments = [self.segment_filename(partial, i)
+                        for i in xrange(n_segments)]
+            Parallel(n_jobs=n_segments, backend='threading')(
+                delayed(_download_range)(self, url, segment, bounds[i],
+                                         bounds[i + 1] - 1, max_attempts)
+                for i, segment in enumerate(segments))
+            with open(partial, 'wb') as f:
+                for segment in segments:
+                    with open(segment, 'rb') as g:
+                        shutil.copyfileobj(g, f)
+            for segment in segments:
+                os.remove(segment)
+        else:
+            self.download_range(url, partial, max_attempts=max_attempts)
+        if size is not None and os.path.getsize(partial) != size:
+            raise IOError('Incomplete download: {}'.format(url))
+        os.rename(partial, filename)
+        os.remove(marker)
+        return filename
+
+    @staticmethod
+    def check_marker(marker, state):
+        """
+        Check whether partial downloads were started with the same URL and
+        segment layout.
+
+        Parameters
+        ----------
+        marker : str
+            Filename recording the URL, number of segments and total size
+            of partial downloads.
+        state : dict
+            URL ('url'), number of segments ('n_segments') and total size
+            ('size', or None if unknown) of this download.
+        """
+        if not os.path.exists(marker):
+            return False
+        with open(marker, 'rb') as f:
+            try:
+                previous = json.load(f)
+            except ValueError:
+                return False
+        if not isinstance(previous, dict):
+            return False
+        if (previous.get('url') != state['url'] or
+                previous.get('n_segments') != state['n_segments']):
+            return False
+        sizes = [previous.get('size'), state['size']]
+        return None in sizes or sizes[0] == sizes[1]
+
+    @staticmethod
+    def segment_filename(partial, index):
+        """
+        Get the filename for a download segment.
+
+        Parameters
+        ----------
+        partial : str
+            Partial download filename.
+        index : int
+            Segment index.
+        """
+        return '{}.{}'.format(partial, index)
+
+    @staticmethod
+    def get_segment_files(partial):
+        """
+        Get the filenames of all existing segments of a partial download.
+
+        Parameters
+        ----------
+        partial : str
+            Partial download filename.
+        """
+        directory = os.path.dirname(partial) or os.curdir
+        prefix = os.path.basename(partial) + '.'
+        return [os.path.join(os.path.dirname(partial), name)
+                for name in os.listdir(directory)
+                if name.startswith(prefix) and name[len(prefix):].isdigit()]
+
+    def get_size(self, url):
+        """
+        Get the size of a download if the server supports range requests.
+
+        Parameters
+        ----------
+        url : str
+            URL to download.
+
+        Returns
+        -------
+        size : int or None
+            Download size in bytes, or None if range requests are not
+            supported.
+        """
+        try:
+            response = self.urlopen(url, headers={'Range': 'bytes=0-0'})
+        except urllib2.HTTPError:
+            return None
+        content_range = response.info().getheader('content-range')
+        response.close()
+        if response.code != 206 or content_range is None:
+            return None
+        match = re.search(r'/(\d+)', content_range)
+        if match is None:
+            return None
+        return int(match.group(1))
+
+    def download_range(self, url, filename, start=0, end=None,
+                       max_attempts=5):
+        """
+        Download a byte range to a file, resuming from any data already in
+        the file.
+
+        Parameters
+        ----------
+        url : str
+            URL to download.
+        filename : str
+            Output filename.
+        start : int, optional (default 0)
+            First byte to download.
+        end : int, optional
+            Last byte to download (inclusive). If not provided, download to
+            the end.
+        max_attempts : int, optional (default 5)
+            Maximum number of consecutive failed attempts.
+        """
+        failures = 0
+        while True:
+            offset = 0
+            if os.path.exists(filename):
+                offset = os.path.getsize(filename)
+            if end is not None and start + offset > end:
+                return  # segment is complete
+            headers = {}
+            if start + offset > 0 or end is not None:
+                if end is None:
+                    headers['Range'] = 'bytes={}-'.format(start + offset)
+                else:
+                    headers['Range'] = 'bytes={}-{}'.format(start + offset,
+                                                            end)
+            written = 0
+            try:
+                response = self.urlopen(url, headers=headers)
+                if headers and response.code != 206:
+                    if start > 0 or end is not None:
+                        response.close()
+                        raise IOError(
+                            'Server does not support range requests.')
+                    mode = 'wb'  # server sent the whole file; start over
+                else:
+                    mode = 'ab'
+                length = response.info().getheader('content-length')
+                with open(filename, mode) as f:
+                    while True:
+                        data = response.read(65536)
+                        if not data:
+                            break
+                        f.write(data)
+                        written += len(data)
+                response.close()
+            except urllib2.HTTPError as e:
+                if e.code == 416 and end is None and offset > 0:
+                    return  # nothing left to download
+                failures += 1
+                if failures >= max_attempts:
+                    raise
+                continue
+            except (urllib2.URLError, httplib.HTTPException, socket.error):
+                failures += 1
+                if failures >= max_attempts:
+                    raise
+                continue
+            if length is None or written == int(length):
+                return
+            if written:
+                failures = 0  # resume from the new offset
+            else:
+                failures += 1
+            if failures >= max_attempts:
+                raise IOError('Incomplete download: {}'.format(url))
+
+
+class PooledResponse(DecompressingReader):
+    """
+    File-like HTTP response that returns its connection to the pool once
+    the response has been read.
+
+    Parameters
+    ----------
+    response : httplib.HTTPResponse
+        HTTP response.
+    url : str
+        Requested URL.
+    pool : ConnectionPool
+        Pool that owns the connection.
+    scheme : str
+        URL scheme ('http' or 'https').
+    host : str
+        Host name, optionally including a port.
+    connection : httplib.HTTPConnection
+        Connection used for the request.
+    """
+    def __init__(self, response, url, pool, scheme, host, connection):
+        super(PooledResponse, self).__init__(response)
+        self.url = url
+        self.code = response.status
+        self.reason = response.reason
+        self.pool = pool
+        self.scheme = scheme
+        self.host = host
+        self.connection = connection
+
+    def fill(self):
+        """
+        Read the next chunk of the response into the buffer.
+        """
+        filled = super(PooledResponse, self).fill()
+        if self.eof:
+            self.close()
+        return filled
+
+    def read(self, size=-1):
+        """
+        Read and return up to size bytes.
+
+        Parameters
+        ----------
+        size : int, optional
+            Maximum number of bytes to read. If negative, read until the end
+            of the response.
+        """
+        data = super(PooledResponse, self).read(size)
+        if self.eof:
+            self.close()
+        return data
+
+    def readlines(self):
+        """
+        Read and return all remaining lines.
+        """
+        return list(self)
+
+    def info(self):
+        """
+        Get the response headers.
+        """
+        return self.fileobj.msg
+
+    def getcode(self):
+        """
+        Get the HTTP status code.
+        """
+        return self.code
+
+    def geturl(self):
+        """
+        Get the requested URL.
+        """
+        return self.url
+
+    def close(self):
+        """
+        Close the response and release its connection.
+
+        The connection is returned to the pool if the response has been read
+        completely, and closed otherwise.
+        """
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        if self.fileobj.isclosed():
+            self.pool.release(self.scheme, self.host, connection)
+        else:
+            self.fileobj.close()
+            connection.close()
+
+
+def _download_range(pool, url, filename, start, end, max_attempts):
+    """
+    Parallel worker for ConnectionPool.download.
+
+    Parameters
+    ----------
+    pool : ConnectionPool
+        Connection pool.
+    url : str
+        URL to download.
+    filename : str
+        Output filename.
+    start : int
+        First byte to download.
+    end : int
+        Last byte to download (inclusive).
+    max_attempts : int
+        Maximum number of consecutive failed attempts.
+    """
+    return pool.download_range(url, filename, start, end, max_attempts)
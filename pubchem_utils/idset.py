@@ -0,0 +1,280 @@
+"""
+Compact sets of PubChem IDs.
+"""
+import numpy as np
+
+__author__ = "Steven Kearnes"
+__copyright__ = "Copyright 2014, Stanford University"
+__license__ = "3-clause BSD"
+
+
+class IDSet(object):
+    """
+    Immutable set of PubChem CIDs or SIDs stored as a sorted uint32 array.
+
+    IDs take four bytes each, and set operations are vectorized NumPy
+    operations on sorted arrays, so sets with millions of IDs can be
+    combined across many assays quickly and in little memory.
+
+    Parameters
+    ----------
+    ids : iterable, optional
+        Non-negative integer IDs. Duplicates are removed.
+    """
+    __hash__ = None  # equality is by value
+
+    def __init__(self, ids=()):
+        if not isinstance(ids, np.ndarray):
+            ids = np.fromiter(ids, dtype=np.int64)
+        if ids.size and ids.dtype != np.uint32:
+            if (not np.issubdtype(ids.dtype, np.integer) or ids.min() < 0 or
+                    ids.max() > np.iinfo(np.uint32).max):
+                raise ValueError('IDs must be non-negative 32-bit integers.')
+        self.ids = np.unique(ids.astype(np.uint32, copy=False))
+
+    @classmethod
+    def from_sorted(cls, ids):
+        """
+        Create a set from a sorted uint32 array of unique IDs without
+        checking or copying it.
+
+        Parameters
+        ----------
+        ids : ndarray
+            Sorted, unique uint32 IDs.
+        """
+        id_set = cls.__new__(cls)
+        id_set.ids = ids
+        return id_set
+
+    def __len__(self):
+        return self.ids.size
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.ids
+        return self.ids.astype(dtype)
+
+    def __repr__(self):
+        if len(self) > 6:
+            ids = '{}, ..., {}'.format(
+                ', '.join(str(uid) for uid in self.ids[:3]),
+                ', '.join(str(uid) for uid in self.ids[-3:]))
+        else:
+            ids = ', '.join(str(uid) for uid in self.ids)
+        return '{}([{}])'.format(self.__class__.__name__, ids)
+
+    def __eq__(self, other):
+        if not isinstance(other, IDSet):
+            return NotImplemented
+        return np.array_equal(self.ids, other.ids)
+
+    def __ne__(self, other):
+        if not isinstance(other, IDSet):
+            return NotImplemented
+        return not self == other
+
+    def __contains__(self, uid):
+        if uid < 0 or uid > np.iinfo(np.uint32).max:
+            return False
+        index = np.searchsorted(self.ids, uid)
+        return bool(index < self.ids.size and self.ids[index] == uid)
+
+    def contains(self, ids):
+        """
+        Test membership for many IDs at once.
+
+        Parameters
+        ----------
+        ids : array_like
+            IDs to test.
+
+        Returns
+        -------
+        mask : ndarray
+            Boolean array that is True where ids are in the set.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        index = np.searchsorted(self.ids, ids)
+        mask = index < self.ids.size
+        mask[mask] = self.ids[index[mask]] == ids[mask]
+        return mask
+
+    def union(self, *others):
+        """
+        Return the union of this set and others.
+
+        Parameters
+        ----------
+        others : IDSet
+            Other sets.
+        """
+        return self.union_all((self,) + others)
+
+    def intersection(self, *others):
+        """
+        Return the intersection of this set and others.
+
+        Parameters
+        ----------
+        others : IDSet
+            Other sets.
+        """
+        return self.intersection_all((self,) + others)
+
+    def difference(self, *others):
+        """
+        Return the IDs in this set that are not in any of the others.
+
+        Parameters
+        ----------
+        others : IDSet
+            Other sets.
+        """
+        ids = self.ids
+        for other in others:
+            if not ids.size:
+                break
+            ids = ids[~other.contains(ids)]
+        return self.from_sorted(ids)
+
+    def symmetric_difference(self, other):
+        """
+        Return the IDs in exactly one of this set and another.
+
+        Parameters
+        ----------
+        other : IDSet
+            Other set.
+        """
+        return self.from_sorted(np.setxor1d(self.ids, other.ids,
+                                            assume_unique=True))
+
+    def issubset(self, other):
+        """
+        Whether every ID in this set is in another.
+
+        Parameters
+        ----------
+        other : IDSet
+            Other set.
+        """
+        return bool(np.all(other.contains(self.ids)))
+
+    def issuperset(self, other):
+        """
+        Whether every ID in another set is in this set.
+
+        Parameters
+        ----------
+        other : IDSet
+            Other set.
+        """
+        return other.issubset(self)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+    __xor__ = symmetric_difference
+    __le__ = issubset
+    __ge__ = issuperset
+
+    @classmethod
+    def union_all(cls, sets):
+        """
+        Return the union of many sets.
+
+        Parameters
+        ----------
+        sets : iterable
+            IDSet objects.
+        """
+        ids, _ = cls.count_all(sets)
+        return ids
+
+    @classmethod
+    def intersection_all(cls, sets):
+        """
+        Return the intersection of many sets.
+
+        Sets are intersected from smallest to largest, so the working set
+        only shrinks.
+
+        Parameters
+        ----------
+        sets : iterable
+            IDSet objects.
+        """
+        sets = sorted(sets, key=len)
+        if not sets:
+            return cls()
+        ids = sets[0].ids
+        for other in sets[1:]:
+            if not ids.size:
+                break
+            ids = ids[other.contains(ids)]
+        return cls.from_sorted(ids)
+
+    @classmethod
+    def count_all(cls, sets):
+        """
+        Count the number of sets that contain each ID.
+
+        When the IDs are dense relative to their total number (as for
+        assays over the same compound library), the IDs are counted with
+        np.bincount instead of being sorted.
+
+        Parameters
+        ----------
+        sets : iterable
+            IDSet objects.
+
+        Returns
+        -------
+        ids : IDSet
+            Union of the sets.
+        counts : ndarray
+            Number of sets containing each ID in ids (in sorted order).
+        """
+        arrays = [id_set.ids for id_set in sets if len(id_set)]
+        if not arrays:
+            return cls(), np.zeros(0, dtype=np.int64)
+        all_ids = np.concatenate(arrays)
+        if all_ids.max() < 2 * all_ids.size:
+            tally = np.bincount(all_ids)
+            ids = np.flatnonzero(tally)
+            return cls.from_sorted(ids.astype(np.uint32)), tally[ids]
+        ids, counts = np.unique(all_ids, return_counts=True)
+        return cls.from_sorted(ids), counts
+
+    def save(self, filename):
+        """
+        Save the set in NumPy .npy format.
+
+        Parameters
+        ----------
+        filename : str
+            Output filename.
+        """
+        with open(filename, 'wb') as f:
+            np.save(f, self.ids)
+
+    @classmethod
+    def load(cls, filename, mmap=False):
+        """
+        Load a set saved with `save`.
+
+        Parameters
+        ----------
+        filename : str
+            Input filename.
+        mmap : bool, optional (default False)
+            Whether to memory-map the file instead of reading it.
+        """
+        ids = np.load(filename, mmap_mode='r' if mmap else None)
+        if ids.dtype != np.uint32 or ids.ndim != 1:
+            raise ValueError('{} does not contain an IDSet.'.format(filename))
+        return cls.from_sorted(ids)
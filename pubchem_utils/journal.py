@@ -0,0 +1,166 @@
+"""
+Persistent journal of submitted PUG queries.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+
+__author__ = "Steven Kearnes"
+__copyright__ = "Copyright 2014, Stanford University"
+__license__ = "3-clause BSD"
+
+
+class JobJournal(object):
+    """
+    SQLite journal of submitted PUG queries.
+
+    Each query is keyed by a hash of its XML and records the PUG request
+    ID, the last known status and the download URL once it is available.
+    Every change is committed immediately, so a process that is restarted
+    after a crash can reattach to running queries or fetch completed ones
+    instead of submitting them again. Entries are removed once their results
+    have been fetched. The journal can be shared between threads and
+    processes.
+
+    Parameters
+    ----------
+    filename : str
+        SQLite database filename. Use ':memory:' for a temporary journal.
+    max_age : float, optional
+        Maximum age of entries, in seconds since they were last updated.
+        Older entries are ignored and removed, since PubChem only keeps
+        results for a limited time.
+    """
+    def __init__(self, filename, max_age=None):
+        self.filename = filename
+        self.max_age = max_age
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.text_factory = str
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    query_hash TEXT PRIMARY KEY,
+                    reqid TEXT,
+                    status TEXT,
+                    download_url TEXT,
+                    updated REAL NOT NULL
+                )""")
+        self.expire()
+
+    def __len__(self):
+        with self.lock:
+            cursor = self.connection.execute('SELECT COUNT(*) FROM jobs')
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def hash_query(query, url=''):
+        """
+        Get the journal key for a query.
+
+        Parameters
+        ----------
+        query : str or QueryBody
+            PUG query XML.
+        url : str, optional
+            PUG URL the query is submitted to.
+        """
+        digest = hashlib.sha1(url)
+        if hasattr(query, 'iter_chunks'):
+            for chunk in query.iter_chunks():
+                digest.update(chunk)
+        else:
+            digest.update(query)
+        return digest.hexdigest()
+
+    def get(self, query_hash):
+        """
+        Get the journal entry for a query.
+
+        Parameters
+        ----------
+        query_hash : str
+            Query hash (see `hash_query`).
+
+        Returns
+        -------
+        entry : dict
+            Entry with 'reqid', 'status' and 'download_url' keys, or None if
+            the query is not in the journal.
+        """
+        with self.lock:
+            cursor = self.connection.execute(
+                'SELECT reqid, status, download_url FROM jobs '
+                'WHERE query_hash = ? AND updated >= ?',
+                (query_hash, self.get_cutoff()))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip(['reqid', 'status', 'download_url'], row))
+
+    def put(self, query_hash, reqid=None, status=None, download_url=None):
+        """
+        Add or update the journal entry for a query.
+
+        Parameters
+        ----------
+        query_hash : str
+            Query hash (see `hash_query`).
+        reqid : str, optional
+            PUG request ID.
+        status : str, optional
+            Last known query status.
+        download_url : str, optional
+            Download URL.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?)',
+                (query_hash, reqid, status, download_url, time.time()))
+
+    def remove(self, query_hash):
+        """
+        Remove the journal entry for a query.
+
+        Parameters
+        ----------
+        query_hash : str
+            Query hash (see `hash_query`).
+        """
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM jobs WHERE query_hash = ?',
+                                    (query_hash,))
+
+    def get_cutoff(self):
+        """
+        Get the update time of the oldest entries that have not expired.
+        """
+        if self.max_age is None:
+            return float('-inf')
+        return time.time() - self.max_age
+
+    def expire(self):
+        """
+        Remove entries older than max_age.
+        """
+        if self.max_age is None:
+            return
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM jobs WHERE updated < ?',
+                                    (self.get_cutoff(),))
+
+    def clear(self):
+        """
+        Remove all entries from the journal.
+        """
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM jobs')
+
+    def close(self):
+        """
+        Close the journal database.
+        """
+        with self.lock:
+            self.connection.close()
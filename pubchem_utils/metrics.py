@@ -0,0 +1,258 @@
+"""
+Timing and throughput metrics for PubChem requests.
+"""
+import collections
+import re
+import threading
+import urlparse
+
+__author__ = "Steven Kearnes"
+__copyright__ = "Copyright 2014, Stanford University"
+__license__ = "3-clause BSD"
+
+
+class QueryTiming(object):
+    """
+    Timing record for a single PUG query.
+
+    Times are Unix timestamps. Queue and run times are resolved only as
+    finely as the query is polled.
+
+    Attributes
+    ----------
+    reqid : str
+        PUG request ID, if the query was queued.
+    submitted : float
+        Time the query was submitted.
+    started : float
+        Time the query was first seen running.
+    completed : float
+        Time the download URL became available.
+    n_requests : int
+        Number of PUG requests (submission and status checks).
+    n_checks : int
+        Number of status checks.
+    request_time : float
+        Total number of seconds spent waiting for PUG responses.
+    bytes_downloaded : int
+        Number of (compressed) bytes downloaded.
+    download_time : float
+        Number of seconds spent downloading the result, including
+        decompression.
+    decompress_time : float
+        Number of seconds spent decompressing the result.
+    """
+    def __init__(self):
+        self.reqid = None
+        self.submitted = None
+        self.started = None
+        self.completed = None
+        self.n_requests = 0
+        self.n_checks = 0
+        self.request_time = 0.
+        self.bytes_downloaded = 0
+        self.download_time = 0.
+        self.decompress_time = 0.
+
+    def __repr__(self):
+        return '{}({})'.format(
+            self.__class__.__name__,
+            ', '.join('{}={!r}'.format(key, value)
+                      for key, value in sorted(self.as_dict().iteritems())))
+
+    @property
+    def queue_time(self):
+        """
+        Number of seconds between submission and the query starting to run
+        (or completing, if it was never seen running).
+        """
+        end = self.started if self.started is not None else self.completed
+        if self.submitted is None or end is None:
+            return None
+        return end - self.submitted
+
+    @property
+    def run_time(self):
+        """
+        Number of seconds the query was seen running on the server.
+        """
+        if self.completed is None:
+            return None
+        if self.started is None:
+            return 0.
+        return self.completed - self.started
+
+    @property
+    def total_time(self):
+        """
+        Number of seconds between submission and the download URL becoming
+        available.
+        """
+        if self.submitted is None or self.completed is None:
+            return None
+        return self.completed - self.submitted
+
+    def as_dict(self):
+        """
+        Get the timing record as a dict, for export.
+        """
+        record = self.__dict__.copy()
+        for key in ['queue_time', 'run_time', 'total_time']:
+            record[key] = getattr(self, key)
+        return record
+
+
+class Metrics(object):
+    """
+    Thread-safe aggregate metrics with optional hooks.
+
+    Every HTTP request sent through a ConnectionPool that uses this object
+    is counted by endpoint, and every fetched PUG query adds its
+    QueryTiming record. Hooks are called with an event name ('request' or
+    'query') and the corresponding record, so metrics can be exported to
+    other monitoring systems as they arrive.
+
+    Parameters
+    ----------
+    max_records : int, optional (default 1000)
+        Number of recent query timing records to keep.
+    """
+    def __init__(self, max_records=1000):
+        self.max_records = max_records
+
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.reset()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def reset(self):
+        """
+        Reset all counters and records. Hooks are kept.
+        """
+        with self.lock:
+            self.counters = collections.Counter()
+            self.endpoints = {}
+            self.records = collections.deque(maxlen=self.max_records)
+
+    def add_hook(self, hook):
+        """
+        Add a hook.
+
+        Parameters
+        ----------
+        hook : callable
+            Function called as hook(event, record) for each request ('request'
+            events, with a dict record) and each fetched PUG query ('query'
+            events, with a QueryTiming record). Hooks are called from the
+            thread that sent the request and should return quickly.
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """
+        Remove a hook.
+
+        Parameters
+        ----------
+        hook : callable
+            Hook to remove.
+        """
+        self.hooks.remove(hook)
+
+    @staticmethod
+    def get_endpoint(url):
+        """
+        Get the endpoint for a URL, replacing numeric path components (such
+        as AIDs and request IDs) with a placeholder.
+
+        Parameters
+        ----------
+        url : str
+            Request URL.
+        """
+        parts = urlparse.urlsplit(url)
+        path = re.sub(r'/\d+(?=/|$)', '/{id}', parts.path)
+        return parts.netloc + path
+
+    def add_request(self, url, elapsed, code):
+        """
+        Record an HTTP request.
+
+        Parameters
+        ----------
+        url : str
+            Request URL.
+        elapsed : float
+            Number of seconds until the response headers were received.
+        code : int
+            HTTP status code, or None if no response was received.
+        """
+        endpoint = self.get_endpoint(url)
+        with self.lock:
+            self.counters['requests'] += 1
+            if code is None or code >= 400:
+                self.counters['request_errors'] += 1
+            stats = self.endpoints.setdefault(
+                endpoint, {'requests': 0, 'errors': 0, 'time': 0.})
+            stats['requests'] += 1
+            stats['time'] += elapsed
+            if code is None or code >= 400:
+                stats['errors'] += 1
+        record = {'url': url, 'endpoint': endpoint, 'elapsed': elapsed,
+                  'code': code}
+        for hook in self.hooks:
+            hook('request', record)
+
+    def add_query(self, timing):
+        """
+        Record a fetched PUG query.
+
+        Parameters
+        ----------
+        timing : QueryTiming
+            Query timing record.
+        """
+        with self.lock:
+            self.counters['queries'] += 1
+            self.counters['status_checks'] += timing.n_checks
+            self.counters['bytes_downloaded'] += timing.bytes_downloaded
+            for key in ['queue_time', 'run_time', 'download_time',
+                        'decompress_time']:
+                value = getattr(timing, key)
+                if value is not None:
+                    self.counters[key] += value
+            self.records.append(timing)
+        for hook in self.hooks:
+            hook('query', timing)
+
+    def summary(self):
+        """
+        Get aggregate metrics.
+
+        Returns
+        -------
+        summary : dict
+            Counters (requests, request_errors, queries, status_checks,
+            bytes_downloaded and total queue, run, download and
+            decompression times), download throughput in bytes per second
+            and per-endpoint request counts, errors and mean latencies.
+        """
+        with self.lock:
+            summary = dict(self.counters)
+            endpoints = {}
+            for endpoint, stats in self.endpoints.iteritems():
+                endpoints[endpoint] = dict(
+                    stats, mean_time=stats['time'] / stats['requests'])
+        summary['endpoints'] = endpoints
+        if summary.get('download_time'):
+            summary['download_throughput'] = (
+                summary.get('bytes_downloaded', 0) / summary['download_time'])
+        return summary
@@ -6,13 +6,20 @@ https://pubchem.ncbi.nlm.nih.gov/pug/pug.xsd.
 
 See also https://pubchem.ncbi.nlm.nih.gov/pug/pughelp.html.
 """
-import gzip
+import os
+import random
 import re
-from StringIO import StringIO
+import sys
+import threading
 import time
-import urllib
 import urllib2
 import warnings
+from xml.etree import cElementTree
+
+from .connection import ConnectionPool
+from .metrics import QueryTiming
+from .queries import cancel_query, status_query
+from .streaming import DecompressingReader
 
 __author__ = "Steven Kearnes"
 __copyright__ = "Copyright 2014, Stanford University"
@@ -26,68 +33,79 @@ class PugQuery(object):
 
     Parameters
     ----------
-    query : str
+    query : str or QueryBody
         PUG query XML.
     submit : bool, optional (default True)
         Whether to automatically submit the query.
-    delay : int, optional (default 10)
-        Number of seconds to wait between status checks.
+    delay : int or PollingPolicy, optional (default 10)
+        Number of seconds to wait between status checks, or a policy that
+        chooses the wait before each status check.
     n_attempts : int, optional (default 3)
         Number of times to attempt query submission.
     verbose : bool, optional (default False)
         Whether to be verbose.
-    """
-    cancel_template = """
-    <PCT-Data>
-      <PCT-Data_input>
-        <PCT-InputData>
-          <PCT-InputData_request>
-            <PCT-Request>
-              <PCT-Request_reqid>%(id)s</PCT-Request_reqid>
-              <PCT-Request_type value="cancel"/>
-            </PCT-Request>
-          </PCT-InputData_request>
-        </PCT-InputData>
-      </PCT-Data_input>
-    </PCT-Data>
-    """
-    status_template = """
-    <PCT-Data>
-     <PCT-Data_input>
-      <PCT-InputData>
-       <PCT-InputData_request>
-        <PCT-Request>
-         <PCT-Request_reqid>%(id)s</PCT-Request_reqid>
-         <PCT-Request_type value="status"/>
-        </PCT-Request>
-       </PCT-InputData_request>
-      </PCT-InputData>
-     </PCT-Data_input>
-    </PCT-Data>
+    pool : ConnectionPool, optional
+        Connection pool used for PUG requests and downloads. If not
+        provided, a new pool is created for this query.
+    url : str, optional
+        PUG URL. Defaults to the PubChem PUG service.
+    journal : journal.JobJournal, optional
+        Journal of submitted queries. If provided, the request ID and
+        download URL are recorded as they become available, and a query
+        that is already in the journal reattaches to the recorded request
+        (or reuses its download URL) instead of being submitted again.
+        The entry is removed once the result has been fetched. Journaled
+        queries are not canceled when they are garbage collected.
+    metrics : metrics.Metrics, optional
+        Metrics that receive the timing record (see `timing`) of the query
+        when it is fetched.
+
+    Attributes
+    ----------
+    timing : metrics.QueryTiming
+        Submission, queue, run and download times, request and status check
+        counts and downloaded bytes for this query.
     """
     url = 'https://pubchem.ncbi.nlm.nih.gov/pug/pug.cgi'
 
     def __init__(self, query, submit=True, delay=10, n_attempts=3,
-                 verbose=False):
+                 verbose=False, pool=None, url=None, journal=None,
+                 metrics=None):
         self.query = query
         self.delay = delay
+        self.polling = get_polling_policy(delay)
+        self.n_checks = 0
         self.n_attemps = n_attempts
         self.verbose = verbose
+        if pool is None:
+            pool = ConnectionPool()
+        self.pool = pool
+        if url is not None:
+            self.url = url
+        self.journal = journal
+        self.query_hash = None
+        if journal is not None:
+            self.query_hash = journal.hash_query(query, self.url)
+        self.metrics = metrics
+        self.timing = QueryTiming()
 
         self.id = None
+        self.response = None
         self.download_url = None
         self.filename = None
         self.data = None
         self.alive = False
+        self.journaled_url = False
 
         if submit:
             self.submit()
 
     def __del__(self):
         """
-        Cancel uncompleted queries.
+        Cancel uncompleted queries that are not recorded in a journal.
         """
-        self.cancel()
+        if self.journal is None:
+            self.cancel()
 
     def request(self, query):
         """
@@ -96,45 +114,55 @@ class PugQuery(object):
 
         Parameters
         ----------
-        query : str
+        query : str or QueryBody
             PUG query XML.
         """
         q = None
+        start = time.time()
         for i in xrange(self.n_attemps):
             try:
-                q = urllib2.urlopen(self.url, query)
+                q = self.pool.urlopen(self.url, query)
                 break
-            except urllib2.HTTPError as e:
+            except urllib2.URLError as e:
                 if i + 1 < self.n_attemps:
                     continue
                 else:
                     raise e
-        response = q.read()
+        try:
+            response = parse_response(q)
+            response.throttling = parse_throttling(
+                q.info().getheader('X-Throttling-Control'))
+        finally:
+            q.close()
+        now = time.time()
+        response.elapsed = now - start
+        self.response = response
+        self.timing.n_requests += 1
+        self.timing.request_time += response.elapsed
+        if response.status == 'running' and self.timing.started is None:
+            self.timing.started = now
 
         # check for errors
-        status_re = re.search('<PCT-Status value="(.*?)"/>', response)
-        status = status_re.groups()[0]
-        if status not in ['success', 'queued', 'running', 'stopped']:
-            msg = 'Original Query:\n------\n{}\n'.format(
-                '\n'.join(self.query.splitlines()[:100]))
-            if query != self.query:
-                msg += 'Current Query:\n--------------\n{}\n'.format(
-                    '\n'.join(query.splitlines()[:100]))
-            msg += 'Response:\n---------\n{}'.format(response)
+        if response.status not in ['success', 'queued', 'running',
+                                   'stopped']:
+            msg = 'PUG request failed with status "{}"'.format(
+                response.status)
+            if response.messages:
+                msg += ': ' + ' '.join(response.messages)
+            msg += '\nQuery:\n------\n{}'.format(
+                _get_query_lines(query, 20))
             raise PUGError(msg)
 
         # check for a download URL
-        download_url_re = re.search(
-            '<PCT-Download-URL_url>\s*(.*?)\s*</PCT-Download-URL_url>',
-            response)
-        if download_url_re is not None:
-            self.download_url = download_url_re.groups()[0]
+        if response.download_url is not None:
+            self.download_url = response.download_url
+            if self.timing.completed is None:
+                self.timing.completed = now
 
         # otherwise, extract the request ID
         elif self.id is None:
-            reqid_re = re.search(
-                '<PCT-Waiting_reqid>\s*(.*?)\s*</PCT-Waiting_reqid>', response)
-            self.id = reqid_re.groups()[0]
+            self.id = response.reqid
+            self.timing.reqid = response.reqid
 
     def cancel(self):
         """
@@ -143,17 +171,70 @@ class PugQuery(object):
         if self.alive:
             assert self.id is not None
             warnings.warn('Canceling PUG request.')
-            query = self.cancel_template % {'id': self.id}
+            query = cancel_query(self.id)
             self.request(query)
             self.alive = False
+            if self.journal is not None:
+                self.journal.remove(self.query_hash)
+
+    def start(self):
+        """
+        Submit the query, or reattach to a request for the same query that
+        is recorded in the journal. Journal entries are removed when their
+        results are fetched, so only queries that were not fetched (for
+        example, because the process that submitted them exited) are
+        reattached.
+        """
+        if self.journal is not None:
+            entry = self.journal.get(self.query_hash)
+            if entry is not None and entry['download_url'] is not None:
+                self.download_url = entry['download_url']
+                self.journaled_url = True
+                return
+            if (entry is not None and entry['reqid'] is not None and
+                    entry['status'] != 'stopped'):
+                self.id = entry['reqid']
+                try:
+                    self.check_status()
+                except (PUGError, urllib2.HTTPError):
+                    pass  # the request has expired
+                else:
+                    if self.response.status != 'stopped':
+                        return
+                self.id = None
+                self.download_url = None
+            self.journal.remove(self.query_hash)
+        self.timing.submitted = time.time()
+        self.request(self.query)
+        self.record()
+
+    def record(self):
+        """
+        Record the state of the query in the journal.
+        """
+        if self.journal is not None:
+            self.journal.put(self.query_hash, self.id, self.response.status,
+                             self.download_url)
+
+    def forget(self):
+        """
+        Remove the query from the journal once its result has been fetched,
+        so later identical queries are submitted again instead of reusing
+        the old result.
+        """
+        if self.journal is not None:
+            self.journal.remove(self.query_hash)
 
     def check_status(self):
         """
         Check the status of the query.
         """
         assert self.id is not None
-        query = self.status_template % {'id': self.id}
+        query = status_query(self.id)
         self.request(query)
+        self.n_checks += 1
+        self.timing.n_checks += 1
+        self.record()
 
     def submit(self):
         """
@@ -163,15 +244,16 @@ class PugQuery(object):
             warnings.warn('This request is already active.')
             return
         self.alive = True
-        self.request(self.query)
+        self.start()
         if self.verbose:
             print self.id,
         while self.download_url is None:
-            time.sleep(self.delay)
+            time.sleep(self.polling.get_delay(self.n_checks))
             self.check_status()
         self.alive = False
 
-    def fetch(self, filename=None, compression=None):
+    def fetch(self, filename=None, compression=None, stream=False,
+              n_segments=1):
         """
         Fetch the result of the query.
 
@@ -179,29 +261,559 @@ class PugQuery(object):
         ----------
         filename : str, optional
             Output filename. If not provided, the data is read into memory.
+            Interrupted file downloads are resumed with range requests.
         compression : str, optional
             Compression type used to decode data.
+        stream : bool, optional (default False)
+            Whether to return a file-like object that downloads and
+            decompresses the data as it is read. Ignored if filename is
+            provided. The download is added to the metrics when the stream
+            is exhausted or closed, and its download time includes any time
+            spent between reads.
+        n_segments : int, optional (default 1)
+            Number of byte ranges to download in parallel when writing to
+            filename, if the server supports range requests.
         """
-        if not self.alive:
+        if self.download_url is None and not self.alive:
             self.submit()
         if self.download_url is None:
             raise PUGError('No download URL.')
+        if self.journaled_url:
+            try:
+                self.pool.urlopen(self.download_url,
+                                  headers={'Range': 'bytes=0-0'}).close()
+            except (urllib2.URLError, IOError):
+                # the download has expired; submit the query again
+                self.journal.remove(self.query_hash)
+                self.download_url = None
+                self.journaled_url = False
+                PugQuery.submit(self)
 
         # fetch
+        start = time.time()
         if filename is not None:
-            filename, _ = urllib.urlretrieve(self.download_url, filename)
+            self.pool.download(self.download_url, filename,
+                               n_segments=n_segments)
             self.filename = filename
+            self.timing.bytes_downloaded += os.path.getsize(filename)
+            self.timing.download_time += time.time() - start
+            self.report()
+            self.forget()
             return filename
+
+        def finish(reader):
+            self.timing.bytes_downloaded += reader.bytes_read
+            self.timing.decompress_time += reader.decompress_time
+            self.timing.download_time += time.time() - start
+            self.report()
+            self.forget()
+
+        reader = DecompressingReader(self.pool.urlopen(self.download_url),
+                                     compression, on_finish=finish)
+        if stream:
+            return reader  # reported when the stream is finished
+        with reader:
+            data = reader.read()
+        self.data = data
+        return data
+
+    def report(self):
+        """
+        Add the timing record of the query to the metrics.
+        """
+        if self.metrics is not None:
+            self.metrics.add_query(self.timing)
+
+
+class AsyncPugQuery(PugQuery):
+    """
+    Submit a PUG query without blocking while it is processed.
+
+    Submission returns as soon as PUG has accepted the query. Pending queries
+    can be monitored individually with `poll` or together from a single
+    thread with `wait`.
+
+    Parameters
+    ----------
+    query : str or QueryBody
+        PUG query XML.
+    submit : bool, optional (default True)
+        Whether to automatically submit the query.
+    delay : int or PollingPolicy, optional (default 10)
+        Number of seconds to wait between status checks, or a policy that
+        chooses the wait before each status check.
+    n_attempts : int, optional (default 3)
+        Number of times to attempt query submission.
+    verbose : bool, optional (default False)
+        Whether to be verbose.
+    pool : ConnectionPool, optional
+        Connection pool used for PUG requests and downloads. If not
+        provided, a new pool is created for this query.
+    url : str, optional
+        PUG URL. Defaults to the PubChem PUG service.
+    journal : journal.JobJournal, optional
+        Journal of submitted queries (see PugQuery).
+    metrics : metrics.Metrics, optional
+        Metrics that receive the timing record of the query when it is
+        fetched.
+    """
+    def __init__(self, query, submit=True, delay=10, n_attempts=3,
+                 verbose=False, pool=None, url=None, journal=None,
+                 metrics=None):
+        self.next_check = None
+        self.fetch_args = {}
+        super(AsyncPugQuery, self).__init__(
+            query, submit=submit, delay=delay, n_attempts=n_attempts,
+            verbose=verbose, pool=pool, url=url, journal=journal,
+            metrics=metrics)
+
+    def submit(self):
+        """
+        Submit the query without waiting for it to complete.
+        """
+        if self.alive:
+            warnings.warn('This request is already active.')
+            return
+        self.alive = True
+        self.start()
+        if self.verbose:
+            print self.id,
+        if self.done():
+            self.alive = False
         else:
-            data = urllib2.urlopen(self.download_url).read()
-            if compression is not None:
-                if compression == 'gzip':
-                    with gzip.GzipFile(fileobj=StringIO(data)) as f:
-                        data = f.read()
-                else:
-                    raise NotImplementedError(compression)
-            self.data = data
-            return data
+            delay = self.polling.get_delay(self.n_checks)
+            self.next_check = time.time() + delay
+
+    def done(self):
+        """
+        Whether the download URL is available.
+        """
+        return self.download_url is not None
+
+    def poll(self):
+        """
+        Check the status of the query once and return whether it is done.
+        """
+        if not self.done():
+            self.check_status()
+            if self.done():
+                self.alive = False
+            else:
+                delay = self.polling.get_delay(self.n_checks)
+                self.next_check = time.time() + delay
+        return self.done()
+
+    def fetch(self, filename=None, compression=None, stream=False,
+              n_segments=1):
+        """
+        Wait for the query to complete and fetch the result.
+
+        Parameters
+        ----------
+        filename : str, optional
+            Output filename. If not provided, the data is read into memory.
+        compression : str, optional
+            Compression type used to decode data.
+        stream : bool, optional (default False)
+            Whether to return a file-like object that downloads and
+            decompresses the data as it is read.
+        n_segments : int, optional (default 1)
+            Number of byte ranges to download in parallel when writing to
+            filename, if the server supports range requests.
+        """
+        wait([self])
+        return super(AsyncPugQuery, self).fetch(filename, compression,
+                                                stream, n_segments)
+
+    def result(self):
+        """
+        Fetch the result of the query using the stored fetch arguments.
+        """
+        return self.fetch(**self.fetch_args)
+
+
+class CompletedQuery(object):
+    """
+    Result that is already available, wrapped so it can be passed to `wait`
+    (and `AsyncPubChem.gather`) with pending queries.
+
+    Parameters
+    ----------
+    value : object
+        Query result.
+    """
+    alive = False
+    next_check = None
+
+    def __init__(self, value):
+        self.value = value
+
+    def done(self):
+        """
+        Whether the result is available (always True).
+        """
+        return True
+
+    def poll(self):
+        """
+        Return whether the result is available (always True).
+        """
+        return True
+
+    def result(self):
+        """
+        Return the result.
+        """
+        return self.value
+
+
+class AsyncCall(object):
+    """
+    Blocking call (such as a batch of PUG REST requests) run in a background
+    thread, so it can be passed to `wait` (and `AsyncPubChem.gather`) with
+    pending queries.
+
+    Parameters
+    ----------
+    function : callable
+        Function to call.
+    args : tuple, optional
+        Positional arguments for function.
+    kwargs : dict, optional
+        Keyword arguments for function.
+    submit : bool, optional (default True)
+        Whether to start the call immediately.
+    interval : float, optional (default 0.1)
+        Number of seconds between checks for completion.
+    """
+    def __init__(self, function, args=(), kwargs=None, submit=True,
+                 interval=0.1):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.interval = interval
+
+        self.thread = None
+        self.value = None
+        self.exc_info = None
+        self.finished = False
+        self.alive = False
+        self.next_check = None
+
+        if submit:
+            self.submit()
+
+    def run(self):
+        """
+        Call the function and store its result or exception.
+        """
+        try:
+            self.value = self.function(*self.args, **self.kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self.finished = True
+
+    def submit(self):
+        """
+        Start the call in a background thread.
+        """
+        if self.alive or self.finished:
+            warnings.warn('This call has already been started.')
+            return
+        self.alive = True
+        self.next_check = time.time() + self.interval
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def done(self):
+        """
+        Whether the call has returned.
+        """
+        return self.finished
+
+    def poll(self):
+        """
+        Check once whether the call has returned.
+        """
+        if self.finished:
+            self.alive = False
+        else:
+            self.next_check = time.time() + self.interval
+        return self.finished
+
+    def result(self):
+        """
+        Wait for the call to return and return its result, or raise its
+        exception.
+        """
+        wait([self])
+        self.thread.join()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+def wait(queries, timeout=None):
+    """
+    Wait for several asynchronous PUG queries from a single thread.
+
+    Unsubmitted queries are submitted first. Each pending query is then
+    polled when its own status check is due, so a single thread can monitor
+    any number of queries.
+
+    Parameters
+    ----------
+    queries : iterable
+        AsyncPugQuery objects, or other pending requests with the same
+        submit, done, poll and next_check interface (such as
+        AsyncStructureSearch).
+    timeout : float, optional
+        Maximum number of seconds to wait. If not provided, wait until all
+        queries are complete.
+
+    Returns
+    -------
+    done : bool
+        Whether all queries are complete.
+    """
+    start = time.time()
+    pending = []
+    for query in queries:
+        if not query.done() and not query.alive:
+            query.submit()
+        if not query.done():
+            pending.append(query)
+    while pending:
+        next_check = min(query.next_check for query in pending)
+        if timeout is not None and next_check - start > timeout:
+            break
+        now = time.time()
+        if next_check > now:
+            time.sleep(next_check - now)
+        now = time.time()
+        for query in pending:
+            if query.next_check <= now:
+                query.poll()
+        pending = [query for query in pending if not query.done()]
+    return not pending
+
+
+class PollingPolicy(object):
+    """
+    Choose how long to wait before each status check.
+    """
+    def get_delay(self, n_checks):
+        """
+        Get the number of seconds to wait before the next status check.
+
+        Parameters
+        ----------
+        n_checks : int
+            Number of status checks already performed.
+        """
+        raise NotImplementedError
+
+
+class FixedDelay(PollingPolicy):
+    """
+    Wait a fixed number of seconds between status checks.
+
+    Parameters
+    ----------
+    delay : float, optional (default 10)
+        Number of seconds to wait between status checks.
+    """
+    def __init__(self, delay=10):
+        self.delay = delay
+
+    def get_delay(self, n_checks):
+        """
+        Get the number of seconds to wait before the next status check.
+
+        Parameters
+        ----------
+        n_checks : int
+            Number of status checks already performed.
+        """
+        return self.delay
+
+
+class ExponentialBackoff(PollingPolicy):
+    """
+    Wait exponentially longer between successive status checks.
+
+    Small queries are picked up by the first, short checks, while long
+    queries are checked less and less often.
+
+    Parameters
+    ----------
+    initial : float, optional (default 1)
+        Number of seconds to wait before the first status check.
+    factor : float, optional (default 2)
+        Growth factor for successive waits.
+    max_delay : float, optional (default 60)
+        Maximum number of seconds to wait between status checks.
+    jitter : float, optional (default 0.1)
+        Fraction by which each wait is randomly perturbed, so that queries
+        submitted together do not check their status in lockstep.
+    """
+    def __init__(self, initial=1, factor=2, max_delay=60, jitter=0.1):
+        self.initial = initial
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def get_delay(self, n_checks):
+        """
+        Get the number of seconds to wait before the next status check.
+
+        Parameters
+        ----------
+        n_checks : int
+            Number of status checks already performed.
+        """
+        delay = min(self.initial * self.factor ** n_checks, self.max_delay)
+        if self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return delay
+
+
+def get_polling_policy(delay):
+    """
+    Get a polling policy.
+
+    Parameters
+    ----------
+    delay : float or PollingPolicy
+        Number of seconds to wait between status checks, or a polling
+        policy (returned unchanged).
+    """
+    if isinstance(delay, PollingPolicy):
+        return delay
+    return FixedDelay(delay)
+
+
+class PugResponse(object):
+    """
+    Fields of a PUG response.
+
+    Attributes
+    ----------
+    status : str
+        Request status, such as 'queued', 'running' or 'success'.
+    reqid : str
+        Request ID for requests that are still being processed.
+    download_url : str
+        Download URL for completed requests.
+    messages : list
+        Status messages from the server.
+    queue_position : int
+        Position in the PUG queue, if reported in a message.
+    throttling : dict
+        Server load reported in the X-Throttling-Control response header,
+        as (status, percent) tuples keyed by 'Request Count' and 'Request
+        Time' (the share of the per-client request count and server time
+        budgets used) and 'Service' (overall server load). Statuses are
+        'Green', 'Yellow', 'Red' or 'Black'. Empty if not reported.
+    elapsed : float
+        Number of seconds between sending the request and parsing the
+        response, measured by the client.
+    """
+    def __init__(self):
+        self.status = None
+        self.reqid = None
+        self.download_url = None
+        self.messages = []
+        self.queue_position = None
+        self.throttling = {}
+        self.elapsed = None
+
+
+def parse_response(f):
+    """
+    Parse a PUG response in one pass as it is read.
+
+    Parameters
+    ----------
+    f : file-like
+        PUG response stream.
+
+    Returns
+    -------
+    response : PugResponse
+        Response fields.
+    """
+    response = PugResponse()
+    try:
+        for _, elem in cElementTree.iterparse(f):
+            tag = elem.tag
+            if tag == 'PCT-Status':
+                response.status = elem.get('value')
+            elif tag == 'PCT-Waiting_reqid':
+                response.reqid = elem.text.strip()
+            elif tag == 'PCT-Download-URL_url':
+                response.download_url = elem.text.strip()
+            elif tag.endswith('_message') and elem.text:
+                message = elem.text.strip()
+                response.messages.append(message)
+                position = re.search(r'position\D{0,10}(\d+)', message,
+                                     re.IGNORECASE)
+                if position is not None:
+                    response.queue_position = int(position.group(1))
+            elif not len(elem):
+                continue
+            elem.clear()  # discard parsed subtrees
+    except SyntaxError as e:  # cElementTree.ParseError
+        raise PUGError('Could not parse PUG response: {}'.format(e))
+    if response.status is None:
+        raise PUGError('PUG response has no status.')
+    return response
+
+
+def parse_throttling(header):
+    """
+    Parse a PubChem X-Throttling-Control header, such as 'Request Count
+    status: Green (0%), Request Time status: Green (0%), Service status:
+    Yellow (60%)'.
+
+    Parameters
+    ----------
+    header : str
+        Header value. May be None.
+
+    Returns
+    -------
+    throttling : dict
+        (status, percent) tuples keyed by the name of each budget.
+    """
+    throttling = {}
+    if header is None:
+        return throttling
+    for name, status, percent in re.findall(
+            r'([\w ]+?) status: (\w+) \((\d+)%\)', header):
+        throttling[name.strip()] = (status, int(percent))
+    return throttling
+
+
+def _get_query_lines(query, n_lines=100):
+    """
+    Get the first lines of a query for error messages.
+
+    Parameters
+    ----------
+    query : str or QueryBody
+        PUG query XML.
+    n_lines : int, optional (default 100)
+        Maximum number of lines.
+    """
+    if hasattr(query, 'read'):
+        query.seek(0)
+        text = query.read(65536)
+        query.seek(0)
+    else:
+        text = query
+    return '\n'.join(text.splitlines()[:n_lines])
 
 
 class PUGError(Exception):
@@ -0,0 +1,440 @@
+"""
+Construct PUG query XML.
+
+ID lists are serialized in linear time, in chunks, so queries for millions
+of IDs can be built quickly or streamed as a request body (see QueryBody)
+without holding the complete query in memory.
+"""
+import numpy as np
+
+__author__ = "Steven Kearnes"
+__copyright__ = "Copyright 2014, Stanford University"
+__license__ = "3-clause BSD"
+
+DOWNLOAD_FORMATS = ['text-asn', 'binary-asn', 'xml', 'sdf', 'image',
+                    'image-small', 'smiles', 'inchi']
+COMPRESSIONS = ['none', 'gzip', 'bzip2']
+
+DOWNLOAD_TEMPLATE = """
+        <PCT-Data>
+         <PCT-Data_input>
+          <PCT-InputData>
+           <PCT-InputData_download>
+            <PCT-Download>
+             <PCT-Download_uids>
+              <PCT-QueryUids>
+               <PCT-QueryUids_ids>
+                <PCT-ID-List>
+                 <PCT-ID-List_db>%(database)s</PCT-ID-List_db>
+                 <PCT-ID-List_uids>
+                  %(ids)s
+                 </PCT-ID-List_uids>
+                </PCT-ID-List>
+               </PCT-QueryUids_ids>
+              </PCT-QueryUids>
+             </PCT-Download_uids>
+             <PCT-Download_format value="%(download_format)s"/>
+             <PCT-Download_compression value="%(compression)s"/>
+             <PCT-Download_use-3d value="%(use_3d)s"/>
+             <PCT-Download_n-3d-conformers>
+              %(n_conformers)s
+             </PCT-Download_n-3d-conformers>
+            </PCT-Download>
+           </PCT-InputData_download>
+          </PCT-InputData>
+         </PCT-Data_input>
+        </PCT-Data>
+        """
+
+ASSAY_DATA_TEMPLATE = """
+<PCT-Data>
+  <PCT-Data_input>
+    <PCT-InputData>
+      <PCT-InputData_query>
+        <PCT-Query>
+          <PCT-Query_type>
+            <PCT-QueryType>
+              <PCT-QueryType_bas>
+                <PCT-QueryAssayData>
+    <PCT-QueryAssayData_output value="csv">4</PCT-QueryAssayData_output>
+                  <PCT-QueryAssayData_aids>
+                    <PCT-QueryUids>
+                      <PCT-QueryUids_ids>
+                        <PCT-ID-List>
+                          <PCT-ID-List_db>pcassay</PCT-ID-List_db>
+                          <PCT-ID-List_uids>
+                            %(ids)s
+                          </PCT-ID-List_uids>
+                        </PCT-ID-List>
+                      </PCT-QueryUids_ids>
+                    </PCT-QueryUids>
+                  </PCT-QueryAssayData_aids>
+                    %(dataset)s
+                  <PCT-QueryAssayData_focus>
+                    <PCT-Assay-FocusOption>
+                    %(group_by)s
+                    </PCT-Assay-FocusOption>
+                  </PCT-QueryAssayData_focus>
+                  <PCT-QueryAssayData_compression value="%(compression)s"/>
+                </PCT-QueryAssayData>
+              </PCT-QueryType_bas>
+            </PCT-QueryType>
+          </PCT-Query_type>
+        </PCT-Query>
+      </PCT-InputData_query>
+    </PCT-InputData>
+  </PCT-Data_input>
+</PCT-Data>
+"""
+
+ID_EXCHANGE_TEMPLATE = """
+<PCT-Data>
+  <PCT-Data_input>
+    <PCT-InputData>
+      <PCT-InputData_query>
+        <PCT-Query>
+          <PCT-Query_type>
+            <PCT-QueryType>
+              <PCT-QueryType_id-exchange>
+                <PCT-QueryIDExchange>
+                  <PCT-QueryIDExchange_input>
+                    <PCT-QueryUids>
+                      <PCT-QueryUids_source-ids>
+                        <PCT-RegistryIDs>
+        <PCT-RegistryIDs_source-name>%(source)s</PCT-RegistryIDs_source-name>
+                          <PCT-RegistryIDs_source-ids>
+                            %(ids)s
+                          </PCT-RegistryIDs_source-ids>
+                        </PCT-RegistryIDs>
+                      </PCT-QueryUids_source-ids>
+                    </PCT-QueryUids>
+                  </PCT-QueryIDExchange_input>
+                  <PCT-QueryIDExchange_operation-type
+                    value="%(operation_type)s"/>
+                  <PCT-QueryIDExchange_output-type value="%(output_type)s"/>
+                  <PCT-QueryIDExchange_output-method value="file-pair"/>
+                  <PCT-QueryIDExchange_compression value="%(compression)s"/>
+                </PCT-QueryIDExchange>
+              </PCT-QueryType_id-exchange>
+            </PCT-QueryType>
+          </PCT-Query_type>
+        </PCT-Query>
+      </PCT-InputData_query>
+    </PCT-InputData>
+  </PCT-Data_input>
+</PCT-Data>
+"""
+
+REQUEST_TEMPLATE = """
+    <PCT-Data>
+      <PCT-Data_input>
+        <PCT-InputData>
+          <PCT-InputData_request>
+            <PCT-Request>
+              <PCT-Request_reqid>%(id)s</PCT-Request_reqid>
+              <PCT-Request_type value="%(request_type)s"/>
+            </PCT-Request>
+          </PCT-InputData_request>
+        </PCT-InputData>
+      </PCT-Data_input>
+    </PCT-Data>
+    """
+
+
+class QueryBody(object):
+    """
+    PUG query XML that is generated as it is read.
+
+    QueryBody objects can be used as request bodies with
+    ConnectionPool.urlopen: the length is known in advance, so the query is
+    sent with a Content-Length header but is never held in memory as a
+    whole. Use str() to get the complete query.
+
+    Parameters
+    ----------
+    head : str
+        Query XML preceding the ID list.
+    ids : list or ndarray
+        IDs.
+    tag : str
+        XML element name for each ID.
+    tail : str
+        Query XML following the ID list.
+    chunk_size : int, optional (default 65536)
+        Number of IDs serialized at a time.
+    """
+    def __init__(self, head, ids, tag, tail, chunk_size=65536):
+        self.head = head
+        self.ids = ids
+        self.tag = tag
+        self.tail = tail
+        self.chunk_size = chunk_size
+
+        self.length = (len(head) + len(tail) +
+                       get_id_elements_length(ids, tag))
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return ''.join(self.iter_chunks())
+
+    def iter_chunks(self):
+        """
+        Iterate over the query XML in chunks.
+        """
+        yield self.head
+        for chunk in iter_id_elements(self.ids, self.tag, self.chunk_size):
+            yield chunk
+        yield self.tail
+
+    def read(self, size=-1):
+        """
+        Read and return up to size bytes of the query.
+
+        Parameters
+        ----------
+        size : int, optional
+            Maximum number of bytes to read. If negative, read until the end
+            of the query.
+        """
+        if size is None or size < 0:
+            data = self.buffer[self.pos:] + ''.join(self.chunks)
+            self.buffer, self.pos = '', 0
+            return data
+        while len(self.buffer) - self.pos < size:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                break
+            self.buffer = self.buffer[self.pos:] + chunk
+            self.pos = 0
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        """
+        Return to the start of the query so it can be sent again.
+
+        Parameters
+        ----------
+        offset : int
+            Must be 0.
+        whence : int, optional (default 0)
+            Must be 0.
+        """
+        if offset != 0 or whence != 0:
+            raise NotImplementedError('Only seek(0) is supported.')
+        self.chunks = self.iter_chunks()
+        self.buffer = ''
+        self.pos = 0
+
+
+def iter_id_elements(ids, tag, chunk_size=65536):
+    """
+    Serialize IDs as XML elements, in chunks.
+
+    Parameters
+    ----------
+    ids : list or ndarray
+        IDs.
+    tag : str
+        XML element name.
+    chunk_size : int, optional (default 65536)
+        Number of IDs per chunk.
+    """
+    start_tag = '<{}>'.format(tag)
+    end_tag = '</{}>\n'.format(tag)
+    sep = end_tag + start_tag
+    for i in xrange(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        if isinstance(chunk, np.ndarray):
+            chunk = chunk.tolist()  # Python scalars serialize faster
+        yield start_tag + sep.join(map(str, chunk)) + end_tag
+
+
+def get_id_elements_length(ids, tag):
+    """
+    Get the length of IDs serialized with `iter_id_elements` without
+    serializing them.
+
+    Parameters
+    ----------
+    ids : list or ndarray
+        IDs.
+    tag : str
+        XML element name.
+    """
+    length = len(ids) * (2 * len(tag) + 6)  # tags and newlines
+    array = np.asarray(ids)
+    if array.dtype.kind in 'iu' and not (array < 0).any():
+        n_digits = np.ones(array.shape, dtype=np.int64)
+        power = 10
+        while array.size and power <= array.max():
+            n_digits += array >= power
+            power *= 10
+        length += int(n_digits.sum())
+    else:
+        length += sum(len(str(uid)) for uid in ids)
+    return length
+
+
+def _build(template, mapping, ids, tag, stream=False):
+    """
+    Build a query from a template containing an ID list.
+
+    Parameters
+    ----------
+    template : str
+        Query template with an '%(ids)s' placeholder for the ID list.
+    mapping : dict
+        Values for the other template placeholders.
+    ids : iterable
+        IDs.
+    tag : str
+        XML element name for each ID.
+    stream : bool, optional (default False)
+        Whether to return a QueryBody instead of a str.
+    """
+    if not isinstance(ids, np.ndarray):
+        ids = list(ids)
+    head, tail = template.split('%(ids)s')
+    head, tail = head % mapping, tail % mapping
+    if stream:
+        return QueryBody(head, ids, tag, tail)
+    return ''.join([head] + list(iter_id_elements(ids, tag)) + [tail])
+
+
+def download_query(ids, sids=False, download_format='sdf',
+                   compression='gzip', use_3d=False, n_conformers=1,
+                   stream=False):
+    """
+    Construct a PUG download query for substances or compounds.
+
+    Parameters
+    ----------
+    ids : iterable
+        PubChem substance or compound IDs.
+    sids : bool, optional (default False)
+        Whether ids are SIDs. If False, IDs are assumed to be CIDs.
+    download_format : str, optional (default 'sdf')
+        Download file format.
+    compression : str, optional (default 'gzip')
+        Compression type for downloaded structures.
+    use_3d : bool, optional (default False)
+        Whether to query 3D information. If False, 2D information is
+        retrieved.
+    n_conformers : int, optional (default 1)
+        Number of conformers to download if retrieving 3D structures.
+    stream : bool, optional (default False)
+        Whether to return a QueryBody instead of a str.
+    """
+    assert download_format in DOWNLOAD_FORMATS, (
+        'download_format must be one of ' + str(DOWNLOAD_FORMATS))
+    if compression is None:
+        compression = 'none'
+    assert compression in COMPRESSIONS, (
+        'compression must be one of ' + str(COMPRESSIONS))
+    mapping = {'download_format': download_format,
+               'compression': compression,
+               'n_conformers': n_conformers}
+    if sids:
+        mapping['database'] = 'pcsubstance'
+    else:
+        mapping['database'] = 'pccompound'
+    if use_3d:
+        mapping['use_3d'] = 'true'
+    else:
+        mapping['use_3d'] = 'false'
+    return _build(DOWNLOAD_TEMPLATE, mapping, ids, 'PCT-ID-List_uids_E',
+                  stream)
+
+
+def assay_data_query(aids, substance_view=True, concise=False,
+                     compression='gzip', stream=False):
+    """
+    Construct a PUG query for PubChem BioAssay data tables.
+
+    Parameters
+    ----------
+    aids : array_like
+        PubChem BioAssay IDs (AIDs).
+    substance_view : bool, optional (default True)
+        Whether to group results by substance. If False, results will be
+        grouped by compound.
+    concise : bool, optional (default False)
+        Whether to return the concise data table. If False, the complete
+        data table is retrieved.
+    compression : str, optional (default 'gzip')
+        Compression type for assay data.
+    stream : bool, optional (default False)
+        Whether to return a QueryBody instead of a str.
+    """
+    group_by = ('<PCT-Assay-FocusOption_group-results-by value="{}">{}' +
+                '</PCT-Assay-FocusOption_group-results-by>')
+    if substance_view:
+        group_by = group_by.format('substance', 4)
+    else:
+        group_by = group_by.format('compound', 0)
+    dataset = ('<PCT-QueryAssayData_dataset value="{}">{}' +
+               '</PCT-QueryAssayData_dataset>')
+    if concise:
+        dataset = dataset.format('concise', 1)
+    else:
+        dataset = dataset.format('complete', 0)
+    mapping = {'group_by': group_by, 'dataset': dataset,
+               'compression': compression}
+    return _build(ASSAY_DATA_TEMPLATE, mapping, np.atleast_1d(aids),
+                  'PCT-ID-List_uids_E', stream)
+
+
+def id_exchange_query(source_ids, source, operation_type='same',
+                      output_type='cid', compression='gzip', stream=False):
+    """
+    Construct a PUG identifier exchange query for registry IDs.
+
+    Parameters
+    ----------
+    source_ids : iterable
+        Input identifiers.
+    source : str
+        Input source, such as 'ChEMBL'.
+    operation_type : str, optional (default 'same')
+        Operation type.
+    output_type : str, optional (default 'cid')
+        Output type.
+    compression : str, optional (default 'gzip')
+        Compression type for results.
+    stream : bool, optional (default False)
+        Whether to return a QueryBody instead of a str.
+    """
+    mapping = {'source': source, 'operation_type': operation_type,
+               'output_type': output_type, 'compression': compression}
+    return _build(ID_EXCHANGE_TEMPLATE, mapping, source_ids,
+                  'PCT-RegistryIDs_source-ids_E', stream)
+
+
+def status_query(reqid):
+    """
+    Construct a PUG status request.
+
+    Parameters
+    ----------
+    reqid : str
+        Request ID.
+    """
+    return REQUEST_TEMPLATE % {'id': reqid, 'request_type': 'status'}
+
+
+def cancel_query(reqid):
+    """
+    Construct a PUG cancel request.
+
+    Parameters
+    ----------
+    reqid : str
+        Request ID.
+    """
+    return REQUEST_TEMPLATE % {'id': reqid, 'request_type': 'cancel'}
@@ -0,0 +1,161 @@
+"""
+Client-side rate limiting for PubChem requests.
+
+PubChem asks clients to send no more than 5 requests per second (and 400
+per minute) and throttles clients that exceed this policy. A limiter passed
+to PubChem (or ConnectionPool) is consulted before every outgoing request,
+so any number of worker threads can share one request budget.
+"""
+import fcntl
+import os
+import threading
+import time
+
+__author__ = "Steven Kearnes"
+__copyright__ = "Copyright 2014, Stanford University"
+__license__ = "3-clause BSD"
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limiter shared by threads.
+
+    Tokens accumulate at `rate` per second up to `burst`. Each request
+    takes one token; requests that find the bucket empty reserve a future
+    token and sleep until it is available, so waiting threads are served in
+    the order they arrive.
+
+    Parameters
+    ----------
+    rate : float
+        Sustained number of requests per second.
+    burst : float, optional
+        Maximum number of requests that can be sent at once after the
+        limiter has been idle. Defaults to max(1, rate).
+    """
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError('rate must be positive.')
+        if burst is None:
+            burst = max(1., rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens, updated, n_tokens=1):
+        """
+        Take tokens from a bucket.
+
+        Parameters
+        ----------
+        tokens : float
+            Number of tokens in the bucket when it was last updated. Negative
+            values are tokens reserved by waiting requests.
+        updated : float
+            Time of the last update.
+        n_tokens : int, optional (default 1)
+            Number of tokens to take.
+
+        Returns
+        -------
+        tokens : float
+            Number of tokens left in the bucket.
+        updated : float
+            Time of this update.
+        wait : float
+            Number of seconds to wait before the tokens are available.
+        """
+        now = time.time()
+        tokens = min(self.burst, tokens + max(0., now - updated) * self.rate)
+        tokens -= n_tokens
+        wait = max(0., -tokens / self.rate)
+        return tokens, now, wait
+
+    def acquire(self, n_tokens=1):
+        """
+        Block until tokens are available.
+
+        Parameters
+        ----------
+        n_tokens : int, optional (default 1)
+            Number of tokens to take.
+
+        Returns
+        -------
+        wait : float
+            Number of seconds spent waiting.
+        """
+        with self.lock:
+            self.tokens, self.updated, wait = self.reserve(
+                self.tokens, self.updated, n_tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class FileRateLimiter(RateLimiter):
+    """
+    Token bucket rate limiter shared by processes on one host.
+
+    The bucket is stored in a small file that is updated under an exclusive
+    lock, so every process (and thread) that uses the same file shares one
+    request budget. Limiters can be pickled and sent to worker processes.
+
+    Parameters
+    ----------
+    filename : str
+        Bucket filename. The file is created if it does not exist.
+    rate : float
+        Sustained number of requests per second.
+    burst : float, optional
+        Maximum number of requests that can be sent at once after the
+        limiter has been idle. Defaults to max(1, rate).
+    """
+    def __init__(self, filename, rate, burst=None):
+        super(FileRateLimiter, self).__init__(rate, burst)
+        self.filename = filename
+        del self.tokens, self.updated  # stored in the file
+
+    def acquire(self, n_tokens=1):
+        """
+        Block until tokens are available.
+
+        Parameters
+        ----------
+        n_tokens : int, optional (default 1)
+            Number of tokens to take.
+
+        Returns
+        -------
+        wait : float
+            Number of seconds spent waiting.
+        """
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            state = os.read(fd, 64).split()
+            if len(state) == 2:
+                tokens, updated = float(state[0]), float(state[1])
+            else:
+                tokens, updated = self.burst, 0.
+            tokens, updated, wait = self.reserve(tokens, updated, n_tokens)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, '{!r} {!r}'.format(tokens, updated))
+        finally:
+            os.close(fd)  # releases the lock
+        if wait > 0:
+            time.sleep(wait)
+        return wait
@@ -1,26 +1,85 @@
 """
 Scripting utilities.
 """
-import gzip
+import mmap
+import numpy as np
+import os
+
+from pubchem_utils.streaming import open_compressed, read_int_array
 
 __author__ = "Steven Kearnes"
 __copyright__ = "Copyright 2014, Stanford University"
 __license__ = "3-clause BSD"
 
 
-def read_ids(filename):
+def read_ids(filename, numeric=False, dtype=np.uint32, unique=False,
+             sort=False):
     """
     Read record IDs from a file.
 
     Parameters
     ----------
     filename : str
-        Filename containing record IDs.
+        Filename containing record IDs, one per line. Files ending in '.gz',
+        '.bz2' or '.xz' are decompressed as they are read.
+    numeric : bool, optional (default False)
+        Whether IDs are integers (such as CIDs or SIDs). Numeric IDs are
+        parsed directly into an array without creating per-line Python
+        objects, and uncompressed files are read through a memory map. If
+        False, IDs are returned as a list of strings (such as ChEMBL IDs).
+    dtype : dtype, optional (default np.uint32)
+        Integer data type for numeric IDs. The default fits all current
+        PubChem CIDs and SIDs in four bytes per ID.
+    unique : bool, optional (default False)
+        Whether to remove duplicate IDs. Unique IDs are returned in sorted
+        order.
+    sort : bool, optional (default False)
+        Whether to sort IDs.
+
+    Returns
+    -------
+    ids : list or ndarray
+        Record IDs.
     """
-    if filename.endswith('.gz'):
-        f = gzip.open(filename)
+    if not numeric:
+        ids = list(iter_ids(filename))
+        if unique:
+            ids = sorted(set(ids))
+        elif sort:
+            ids.sort()
+        return ids
+    if filename.endswith(('.gz', '.bz2', '.xz')):
+        with open_compressed(filename) as f:
+            ids = read_int_array(f, dtype)
+    elif os.path.getsize(filename) == 0:
+        ids = np.zeros(0, dtype=dtype)
     else:
-        f = open(filename)
-    ids = [line.strip() for line in f]
-    f.close()
+        with open(filename, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                ids = read_int_array(data, dtype)
+            finally:
+                data.close()
+    if unique:
+        ids = np.unique(ids)
+    elif sort:
+        ids.sort()
     return ids
+
+
+def iter_ids(filename):
+    """
+    Iterate over record IDs in a file without reading the whole file into
+    memory. Blank lines are skipped.
+
+    Parameters
+    ----------
+    filename : str
+        Filename containing record IDs. Files ending in '.gz', '.bz2' or
+        '.xz' are decompressed as they are read.
+    """
+    with open_compressed(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
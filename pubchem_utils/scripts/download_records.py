@@ -1,7 +1,17 @@
 """
 Download records from PubChem by ID.
+
+With --shard-size, IDs are split into numbered output shards that are
+downloaded concurrently (--jobs). Each completed shard is recorded in a
+manifest next to the output, so an interrupted run can be restarted with
+the same arguments and only the missing shards are downloaded.
 """
 import argparse
+import json
+import os
+import threading
+
+from joblib import delayed, Parallel
 
 from pubchem_utils import PubChem
 from pubchem_utils.scripts import read_ids
@@ -40,12 +50,194 @@ def parse_args(input_args=None):
     parser.add_argument('-d', '--delay', type=int, default=10,
                         help='Number of seconds to wait between status ' +
                              'checks.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of PUG queries to run concurrently.')
+    parser.add_argument('--chunk-size', type=int,
+                        help='Maximum number of IDs per PUG query.')
+    parser.add_argument('--shard-size', type=int,
+                        help='Number of IDs per output shard. If provided, ' +
+                             'numbered shards are written instead of a ' +
+                             'single output file and completed shards are ' +
+                             'skipped when the script is rerun.')
+    parser.add_argument('--manifest',
+                        help='Manifest filename for sharded downloads. ' +
+                             'Defaults to the output filename with a ' +
+                             '.manifest suffix.')
     rval = parser.parse_args(input_args)
     return rval
 
 
+def get_shard_filename(filename, index):
+    """
+    Get the filename for an output shard.
+
+    If filename contains a format field (such as 'records-{:05d}.sdf.gz'),
+    it is formatted with the shard index. Otherwise the zero-padded index is
+    inserted before the file extensions ('records.sdf.gz' becomes
+    'records-00000.sdf.gz').
+
+    Parameters
+    ----------
+    filename : str
+        Output filename.
+    index : int
+        Shard index.
+    """
+    if '{' in filename:
+        return filename.format(index)
+    dirname, basename = os.path.split(filename)
+    if '.' in basename:
+        root, ext = basename.split('.', 1)
+        ext = '.' + ext
+    else:
+        root, ext = basename, ''
+    return os.path.join(dirname, '{}-{:05d}{}'.format(root, index, ext))
+
+
+class Manifest(object):
+    """
+    Append-only record of completed output shards.
+
+    Each line is a JSON object describing one shard: its index, the range
+    of input positions it covers, its first and last IDs and its filename.
+    Lines are flushed to disk as shards complete, so the manifest is valid
+    after an interruption.
+
+    Parameters
+    ----------
+    filename : str
+        Manifest filename.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Read completed shards, keyed by shard index. Incomplete trailing
+        lines (from an interrupted write) are ignored.
+        """
+        shards = {}
+        if not os.path.exists(self.filename):
+            return shards
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    shard = json.loads(line)
+                except ValueError:
+                    continue
+                shards[shard['index']] = shard
+        return shards
+
+    def add(self, shard):
+        """
+        Record a completed shard.
+
+        Parameters
+        ----------
+        shard : dict
+            Shard description.
+        """
+        with self.lock:
+            with open(self.filename, 'ab') as f:
+                f.write(json.dumps(shard, sort_keys=True) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def get_shards(ids, filename, shard_size):
+    """
+    Split IDs into output shards.
+
+    Parameters
+    ----------
+    ids : list
+        PubChem substance or compound IDs.
+    filename : str
+        Output filename (see `get_shard_filename`).
+    shard_size : int
+        Number of IDs per shard.
+
+    Returns
+    -------
+    shards : list
+        Shard descriptions.
+    """
+    shards = []
+    for index, start in enumerate(xrange(0, len(ids), shard_size)):
+        stop = min(start + shard_size, len(ids))
+        shards.append({'index': index, 'start': start, 'stop': stop,
+                       'first_id': str(ids[start]),
+                       'last_id': str(ids[stop - 1]),
+                       'filename': get_shard_filename(filename, index)})
+    return shards
+
+
+def download_shards(engine, ids, filename, shard_size, manifest=None,
+                    sids=False, download_format='sdf', compression='gzip',
+                    use_3d=False, n_conformers=1, jobs=1, chunk_size=None):
+    """
+    Download records into numbered output shards, skipping shards that are
+    recorded as complete in the manifest.
+
+    Shards are written to a temporary file that is renamed once the
+    download completes, so a shard file that exists is always complete.
+
+    Parameters
+    ----------
+    engine : PubChem
+        PubChem instance used for downloads.
+    ids : list
+        PubChem substance or compound IDs.
+    filename : str
+        Output filename (see `get_shard_filename`).
+    shard_size : int
+        Number of IDs per shard.
+    manifest : str, optional
+        Manifest filename. Defaults to filename with a '.manifest' suffix.
+    sids : bool, optional (default False)
+        Whether ids are SIDs. If False, IDs are assumed to be CIDs.
+    download_format : str, optional (default 'sdf')
+        Download file format.
+    compression : str, optional (default 'gzip')
+        Compression type for downloaded structures.
+    use_3d : bool, optional (default False)
+        Whether to query 3D information.
+    n_conformers : int, optional (default 1)
+        Number of conformers to download if retrieving 3D structures.
+    jobs : int, optional (default 1)
+        Number of shards to download concurrently.
+    chunk_size : int, optional
+        Maximum number of IDs per PUG query.
+
+    Returns
+    -------
+    filenames : list
+        Shard filenames, in order.
+    """
+    if manifest is None:
+        manifest = filename.replace('{', '').replace('}', '') + '.manifest'
+    manifest = Manifest(manifest)
+    done = manifest.load()
+    shards = get_shards(ids, filename, shard_size)
+    pending = []
+    for shard in shards:
+        if (done.get(shard['index']) == shard and
+                os.path.exists(shard['filename'])):
+            continue
+        pending.append(shard)
+    Parallel(n_jobs=max(1, min(jobs, len(pending))), backend='threading')(
+        delayed(_download_shard)(
+            engine, ids[shard['start']:shard['stop']], shard, manifest,
+            sids, download_format, compression, use_3d, n_conformers,
+            chunk_size)
+        for shard in pending)
+    return [shard['filename'] for shard in shards]
+
+
 def main(ids, filename=None, sids=False, download_format='sdf',
-         compression='gzip', use_3d=False, n_conformers=1, delay=10):
+         compression='gzip', use_3d=False, n_conformers=1, delay=10, jobs=1,
+         chunk_size=None, shard_size=None, manifest=None):
     """
     Download records from PubChem by ID.
 
@@ -68,13 +260,63 @@ def main(ids, filename=None, sids=False, download_format='sdf',
         Number of conformers to download if retrieving 3D structures.
     delay : int, optional (default 10)
         Number of seconds to wait between status checks.
+    jobs : int, optional (default 1)
+        Number of PUG queries to run concurrently.
+    chunk_size : int, optional
+        Maximum number of IDs per PUG query.
+    shard_size : int, optional
+        Number of IDs per output shard. If provided, numbered shards are
+        written instead of a single output file (see `download_shards`).
+    manifest : str, optional
+        Manifest filename for sharded downloads.
     """
     engine = PubChem(delay=delay)
+    if shard_size is not None:
+        return download_shards(engine, ids, filename, shard_size, manifest,
+                               sids, download_format, compression, use_3d,
+                               n_conformers, jobs, chunk_size)
     engine.get_records(ids, filename, sids, download_format, compression,
-                       use_3d, n_conformers)
+                       use_3d, n_conformers, chunk_size, max_in_flight=jobs)
+
+
+def _download_shard(engine, ids, shard, manifest, sids=False,
+                    download_format='sdf', compression='gzip', use_3d=False,
+                    n_conformers=1, chunk_size=None):
+    """
+    Download a single output shard and record it in the manifest.
+
+    Parameters
+    ----------
+    engine : PubChem
+        PubChem instance used for downloads.
+    ids : list
+        IDs in this shard.
+    shard : dict
+        Shard description.
+    manifest : Manifest
+        Manifest of completed shards.
+    sids : bool, optional (default False)
+        Whether ids are SIDs. If False, IDs are assumed to be CIDs.
+    download_format : str, optional (default 'sdf')
+        Download file format.
+    compression : str, optional (default 'gzip')
+        Compression type for downloaded structures.
+    use_3d : bool, optional (default False)
+        Whether to query 3D information.
+    n_conformers : int, optional (default 1)
+        Number of conformers to download if retrieving 3D structures.
+    chunk_size : int, optional
+        Maximum number of IDs per PUG query.
+    """
+    temp_filename = shard['filename'] + '.part'
+    engine.get_records(ids, temp_filename, sids, download_format,
+                       compression, use_3d, n_conformers, chunk_size)
+    os.rename(temp_filename, shard['filename'])
+    manifest.add(shard)
 
 if __name__ == '__main__':
     args = parse_args()
-    record_ids = read_ids(args.input)
+    record_ids = read_ids(args.input, numeric=True)
     main(record_ids, args.output, args.sids, args.download_format,
-         args.compression, args.use_3d, args.n_conformers, args.delay)
+         args.compression, args.use_3d, args.n_conformers, args.delay,
+         args.jobs, args.chunk_size, args.shard_size, args.manifest)
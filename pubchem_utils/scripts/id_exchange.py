@@ -1,12 +1,20 @@
 #!/usr/bin/env python
 """
 Use the PubChem Identifier Exchange service.
+
+With --batch-size, IDs are read from the input file incrementally and
+resolved in batches of bounded size. Results are appended to the output
+files as each batch completes, so arbitrarily large inputs run in fixed
+memory.
 """
 import argparse
+import itertools
 import numpy as np
+import sys
+import time
 
 from pubchem_utils import PubChem
-from pubchem_utils.scripts import read_ids
+from pubchem_utils.scripts import iter_ids, read_ids
 
 __author__ = "Steven Kearnes"
 __copyright__ = "Copyright 2014, Stanford University"
@@ -39,12 +47,131 @@ def parse_args(input_args=None):
     parser.add_argument('-d', '--delay', type=int, default=10,
                         help='Number of seconds to wait between status ' +
                              'checks.')
+    parser.add_argument('-b', '--batch-size', type=int,
+                        help='Stream IDs from the input file and resolve ' +
+                             'them in batches of this size. Duplicate IDs ' +
+                             'are only removed within each batch.')
+    parser.add_argument('--chunk-size', type=int,
+                        help='Maximum number of IDs per PUG query.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of PUG queries to run concurrently.')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='Do not report progress.')
     return parser.parse_args(input_args)
 
 
-def main(ids, source=None, prefix=None, sids=False, mapping=False, delay=10):
+def iter_batches(ids, batch_size):
     """
-    Download records from PubChem by ID.
+    Split an iterable of IDs into lists of unique IDs.
+
+    Parameters
+    ----------
+    ids : iterable
+        Source IDs.
+    batch_size : int
+        Maximum number of IDs per batch (before removing duplicates).
+    """
+    ids = iter(ids)
+    while True:
+        batch = list(itertools.islice(ids, batch_size))
+        if not batch:
+            break
+        seen = set()
+        unique = []
+        for source_id in batch:
+            if source_id not in seen:
+                seen.add(source_id)
+                unique.append(source_id)
+        yield unique
+
+
+def exchange_batches(engine, batches, prefix=None, source=None,
+                     output_type='cid', mapping=False, chunk_size=None,
+                     jobs=1, progress=None):
+    """
+    Resolve batches of IDs and write results as each batch completes.
+
+    Matched IDs (or the ID mapping) are written to <prefix>-matched.txt (or
+    <prefix>-mapping.txt), and unmatched IDs to <prefix>-unmatched.txt if
+    there are any.
+
+    Parameters
+    ----------
+    engine : PubChem
+        PubChem instance used for queries.
+    batches : iterable
+        Lists of unique source IDs.
+    prefix : str, optional
+        Prefix for output files.
+    source : str, optional
+        Input source. If None, it is inferred from the first ID in each
+        batch (if possible).
+    output_type : str, optional (default 'cid')
+        Output type.
+    mapping : bool, optional (default False)
+        Whether to write the ID mapping instead of only matched IDs.
+    chunk_size : int, optional
+        Maximum number of IDs per PUG query.
+    jobs : int, optional (default 1)
+        Number of PUG queries to run concurrently.
+    progress : file-like, optional
+        Stream for progress and throughput reports after each batch.
+
+    Returns
+    -------
+    n_ids : int
+        Number of IDs resolved.
+    n_matched : int
+        Number of matched IDs.
+    """
+    if mapping:
+        matched_filename = '{}-mapping.txt'.format(prefix)
+    else:
+        matched_filename = '{}-matched.txt'.format(prefix)
+    unmatched_filename = '{}-unmatched.txt'.format(prefix)
+    n_ids = n_matched = 0
+    start = time.time()
+    unmatched_file = None
+    with open(matched_filename, 'wb') as matched_file:
+        try:
+            for batch in batches:
+                id_map = engine.id_exchange(
+                    batch, source, output_type=output_type,
+                    chunk_size=chunk_size, max_in_flight=jobs)
+                for source_id in batch:
+                    value = id_map[source_id]
+                    if value is None:
+                        if unmatched_file is None:
+                            unmatched_file = open(unmatched_filename, 'wb')
+                        unmatched_file.write('{}\n'.format(source_id))
+                        continue
+                    n_matched += 1
+                    if mapping:
+                        line = '{}\t{}\n'.format(source_id, value)
+                    else:
+                        line = '{}\n'.format(value)
+                    matched_file.write(line)
+                matched_file.flush()
+                if unmatched_file is not None:
+                    unmatched_file.flush()
+                n_ids += len(batch)
+                if progress is not None:
+                    elapsed = time.time() - start
+                    rate = n_ids / max(elapsed, 1e-6)
+                    progress.write('{} IDs ({} matched) in {:.1f}s, '
+                                   '{:.0f} IDs/s\n'.format(
+                                       n_ids, n_matched, elapsed, rate))
+                    progress.flush()
+        finally:
+            if unmatched_file is not None:
+                unmatched_file.close()
+    return n_ids, n_matched
+
+
+def main(ids, source=None, prefix=None, sids=False, mapping=False, delay=10,
+         batch_size=None, chunk_size=None, jobs=1, progress=None):
+    """
+    Map source IDs to PubChem IDs.
 
     Parameters
     ----------
@@ -57,31 +184,38 @@ def main(ids, source=None, prefix=None, sids=False, mapping=False, delay=10):
     sids : bool, optional (default False)
         Whether ids are SIDs. If False, IDs are assumed to be CIDs.
     mapping : bool, optional (default False)
+        Whether to write the ID mapping instead of only matched IDs.
     delay : int, optional (default 10)
         Number of seconds to wait between status checks.
+    batch_size : int, optional
+        Maximum number of IDs to resolve at a time. If provided, ids can be
+        an iterator and only one batch is held in memory. Otherwise all IDs
+        are resolved at once, after removing duplicates.
+    chunk_size : int, optional
+        Maximum number of IDs per PUG query.
+    jobs : int, optional (default 1)
+        Number of PUG queries to run concurrently.
+    progress : file-like, optional
+        Stream for progress and throughput reports.
     """
     engine = PubChem(delay=delay)
     if sids:
         output_type = 'sid'
     else:
         output_type = 'cid'
-    matched, unmatched = engine.id_exchange(np.unique(ids), source,
-                                            output_type=output_type)
-    if mapping:
-        with open('{}-mapping.txt'.format(prefix), 'wb') as f:
-            for key, value in matched.items():
-                f.write('{}\t{}\n'.format(key, value))
+    if batch_size is None:
+        batches = [np.unique(ids).tolist()]
     else:
-        with open('{}-matched.txt'.format(prefix), 'wb') as f:
-            for value in matched.values():
-                f.write('{}\n'.format(value))
-    if len(unmatched):
-        with open('{}-unmatched.txt'.format(prefix), 'wb') as f:
-            for value in unmatched:
-                f.write('{}\n'.format(value))
+        batches = iter_batches(ids, batch_size)
+    return exchange_batches(engine, batches, prefix, source, output_type,
+                            mapping, chunk_size, jobs, progress)
 
 if __name__ == '__main__':
     args = parse_args()
-    record_ids = read_ids(args.input)
+    if args.batch_size is None:
+        record_ids = read_ids(args.input)
+    else:
+        record_ids = iter_ids(args.input)
     main(record_ids, args.source, args.prefix, args.sids, args.mapping,
-         args.delay)
+         args.delay, args.batch_size, args.chunk_size, args.jobs,
+         None if args.quiet else sys.stderr)
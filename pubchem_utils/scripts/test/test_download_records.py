@@ -1,13 +1,19 @@
 """
 Tests for download_records.py.
 """
+import bz2
+import gzip
 import numpy as np
+import os
 import shutil
 import tempfile
 import unittest
 
+from ... import PubChem
+from ...test.server import PubChemServer
 from .. import read_ids
-from ..download_records import main, parse_args
+from ..download_records import (download_shards, get_shard_filename, main,
+                                parse_args)
 
 
 class TestDownloadIds(unittest.TestCase):
@@ -65,3 +71,143 @@ class TestDownloadIds(unittest.TestCase):
         ids = read_ids(self.cid_filename)
         args = parse_args([self.cid_filename, self.filename])
         self.run_script(ids, args)
+
+
+class TestReadIds(unittest.TestCase):
+    """
+    Tests for read_ids.
+    """
+    def setUp(self):
+        """
+        Set up tests.
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        self.ids = np.asarray([2244, 3672, 1983, 2244, 4294967295],
+                              dtype=np.uint32)
+        self.data = ''.join('{}\n'.format(uid) for uid in self.ids)
+
+    def tearDown(self):
+        """
+        Clean up tests.
+        """
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name, data):
+        """
+        Write an ID file.
+
+        Parameters
+        ----------
+        name : str
+            Filename, relative to the temporary directory.
+        data : str
+            File contents.
+        """
+        filename = os.path.join(self.temp_dir, name)
+        if name.endswith('.gz'):
+            f = gzip.open(filename, 'wb')
+        elif name.endswith('.bz2'):
+            f = bz2.BZ2File(filename, 'wb')
+        else:
+            f = open(filename, 'wb')
+        f.write(data)
+        f.close()
+        return filename
+
+    def test_numeric(self):
+        """
+        Test reading numeric IDs from plain and compressed files.
+        """
+        for name in ['ids.txt', 'ids.txt.gz', 'ids.txt.bz2']:
+            ids = read_ids(self.write(name, self.data), numeric=True)
+            assert ids.dtype == np.uint32
+            assert np.array_equal(ids, self.ids)
+
+    def test_unique_sort(self):
+        """
+        Test removing duplicates and sorting.
+        """
+        filename = self.write('ids.txt', self.data)
+        ids = read_ids(filename, numeric=True, unique=True)
+        assert np.array_equal(ids, np.unique(self.ids))
+        ids = read_ids(filename, numeric=True, dtype=np.int64, sort=True)
+        assert np.array_equal(ids, np.sort(self.ids))
+        assert read_ids(filename, sort=True)[:2] == ['1983', '2244']
+        assert read_ids(filename, unique=True) == ['1983', '2244', '3672',
+                                                   '4294967295']
+
+    def test_empty(self):
+        """
+        Test an empty file.
+        """
+        assert read_ids(self.write('ids.txt', ''), numeric=True).size == 0
+
+    def test_invalid(self):
+        """
+        Test that non-numeric and out-of-range IDs raise ValueError.
+        """
+        with self.assertRaises(ValueError):
+            read_ids(self.write('ids.txt', '1\nCHEMBL25\n'), numeric=True)
+        with self.assertRaises(ValueError):
+            read_ids(self.write('ids.txt', '4294967296\n'), numeric=True)
+
+
+class TestDownloadShards(unittest.TestCase):
+    """
+    Tests for sharded downloads using PubChemServer.
+    """
+    def setUp(self):
+        """
+        Set up tests.
+        """
+        self.server = PubChemServer(seed=0)
+        self.server.start()
+        self.engine = PubChem(delay=0.01, pug_url=self.server.pug_url,
+                              rest_url=self.server.rest_url)
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'records.sdf.gz')
+        self.ids = np.arange(1, 24, dtype=np.uint32)
+
+    def tearDown(self):
+        """
+        Clean up tests.
+        """
+        shutil.rmtree(self.temp_dir)
+        self.server.stop()
+
+    def download(self):
+        """
+        Download shards and check their contents.
+        """
+        filenames = download_shards(self.engine, self.ids, self.filename,
+                                    shard_size=5, jobs=3, chunk_size=2)
+        assert len(filenames) == 5
+        data = []
+        for filename in filenames:
+            with gzip.open(filename) as f:
+                data.append(f.read())
+        assert ''.join(data) == ''.join(
+            self.server.record(int(cid)) for cid in self.ids)
+        return filenames
+
+    def test_get_shard_filename(self):
+        """
+        Test get_shard_filename.
+        """
+        assert get_shard_filename('a/records.sdf.gz', 3) == (
+            'a/records-00003.sdf.gz')
+        assert get_shard_filename('records', 3) == 'records-00003'
+        assert get_shard_filename('part{:02d}.sdf', 3) == 'part03.sdf'
+
+    def test_download_shards(self):
+        """
+        Test download_shards, including resuming an interrupted run.
+        """
+        filenames = self.download()
+        n_jobs = len(self.server.jobs)
+        assert n_jobs == 14  # four shards of 5 IDs and one of 3
+        self.download()
+        assert len(self.server.jobs) == n_jobs  # all shards skipped
+        os.remove(filenames[1])
+        self.download()
+        assert len(self.server.jobs) == n_jobs + 3  # one shard downloaded
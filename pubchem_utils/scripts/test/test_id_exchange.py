@@ -0,0 +1,93 @@
+"""
+Tests for id_exchange.py.
+"""
+import bz2
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+import unittest
+
+from ... import PubChem
+from ...test.server import PubChemServer
+from .. import iter_ids
+from ..id_exchange import exchange_batches, iter_batches
+
+
+class TestIdExchange(unittest.TestCase):
+    """
+    Tests for id_exchange.py using PubChemServer.
+    """
+    def setUp(self):
+        """
+        Set up tests.
+        """
+        self.server = PubChemServer(seed=0)
+        self.server.start()
+        self.engine = PubChem(delay=0.01, pug_url=self.server.pug_url,
+                              rest_url=self.server.rest_url)
+        self.temp_dir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.temp_dir, 'chembl')
+        self.ids = ['CHEMBL{}'.format(i) for i in xrange(1, 31)]
+
+    def tearDown(self):
+        """
+        Clean up tests.
+        """
+        shutil.rmtree(self.temp_dir)
+        self.server.stop()
+
+    def read(self, suffix):
+        """
+        Read lines from an output file.
+
+        Parameters
+        ----------
+        suffix : str
+            Output file suffix, such as 'matched'.
+        """
+        with open('{}-{}.txt'.format(self.prefix, suffix)) as f:
+            return f.read().splitlines()
+
+    def test_iter_ids(self):
+        """
+        Test iter_ids with a compressed file.
+        """
+        filename = os.path.join(self.temp_dir, 'ids.txt.bz2')
+        f = bz2.BZ2File(filename, 'wb')
+        f.write('\n'.join(self.ids) + '\n\n')
+        f.close()
+        assert list(iter_ids(filename)) == self.ids
+
+    def test_iter_batches(self):
+        """
+        Test iter_batches.
+        """
+        batches = list(iter_batches(['a', 'b', 'a', 'c', 'c'], 2))
+        assert batches == [['a', 'b'], ['a', 'c'], ['c']]
+
+    def test_exchange_batches(self):
+        """
+        Test streaming ID exchange.
+        """
+        progress = StringIO()
+        batches = iter_batches(iter(self.ids + self.ids[:3]), 7)
+        n_ids, n_matched = exchange_batches(
+            self.engine, batches, self.prefix, chunk_size=3, jobs=2,
+            progress=progress)
+        assert (n_ids, n_matched) == (33, 30)
+        assert len(progress.getvalue().splitlines()) == 5
+        expected = [self.server.exchange(source_id)
+                    for source_id in self.ids + self.ids[:3]]
+        assert self.read('matched') == [
+            str(value) for value in expected if value is not None]
+        assert self.read('unmatched') == ['CHEMBL10', 'CHEMBL20', 'CHEMBL30']
+
+    def test_exchange_batches_mapping(self):
+        """
+        Test writing ID mappings.
+        """
+        exchange_batches(self.engine, [self.ids[:5]], self.prefix,
+                         mapping=True)
+        assert self.read('mapping')[0] == 'CHEMBL1\t1'
+        assert not os.path.exists(self.prefix + '-unmatched.txt')
@@ -0,0 +1,643 @@
+"""
+Utilities for streaming PubChem downloads.
+"""
+import bz2
+import csv
+import numpy as np
+import re
+import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+__author__ = "Steven Kearnes"
+__copyright__ = "Copyright 2014, Stanford University"
+__license__ = "3-clause BSD"
+
+ASSAY_COLUMNS = ['PUBCHEM_SID', 'PUBCHEM_CID', 'PUBCHEM_ACTIVITY_OUTCOME',
+                 'PUBCHEM_ACTIVITY_SCORE']
+ASSAY_COLUMN_TYPES = {'PUBCHEM_RESULT_TAG': np.int64,
+                      'PUBCHEM_SID': np.int64,
+                      'PUBCHEM_CID': np.int64,
+                      'PUBCHEM_ACTIVITY_OUTCOME': np.int8,
+                      'PUBCHEM_ACTIVITY_SCORE': np.float64}
+ACTIVITY_OUTCOMES = {'inactive': 1, 'active': 2, 'inconclusive': 3,
+                     'unspecified': 4, 'probe': 5}
+RESULT_TYPES = {'FLOAT': np.float64, 'INTEGER': np.int64}
+
+# characters other than digits, whitespace and leading minus signs
+_NON_INTEGER = re.compile(r'[^\d\s-]|(?<=\S)-|-(?!\d)')
+
+
+class DecompressingReader(object):
+    """
+    File-like object that decompresses a stream as it is read.
+
+    Only the compressed bytes needed to satisfy each read are pulled from
+    the underlying stream, so arbitrarily large downloads are processed in
+    constant memory. Concatenated gzip members and bzip2 streams are
+    decompressed in sequence.
+
+    Parameters
+    ----------
+    fileobj : file-like
+        Compressed input stream.
+    compression : str, optional
+        Compression type ('gzip', 'bzip2' or 'xz'). If None or 'none', data
+        is passed through unchanged. xz requires the lzma module (available
+        for Python 2 as backports.lzma).
+    chunk_size : int, optional (default 65536)
+        Number of compressed bytes to read from the input stream at a time.
+    on_finish : callable, optional
+        Function called as on_finish(reader) once, when the end of the input
+        stream is reached or the reader is closed (whichever comes first).
+    """
+    def __init__(self, fileobj, compression=None, chunk_size=65536,
+                 on_finish=None):
+        self.fileobj = fileobj
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.on_finish = on_finish
+
+        self.decompressor = self.get_decompressor()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.bytes_read = 0  # compressed bytes
+        self.decompress_time = 0.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """
+        Return the next line.
+        """
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def get_decompressor(self):
+        """
+        Create a decompressor for the configured compression type.
+        """
+        if self.compression is None or self.compression == 'none':
+            return None
+        elif self.compression == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.compression == 'bzip2':
+            return bz2.BZ2Decompressor()
+        elif self.compression == 'xz':
+            if lzma is None:
+                raise ImportError('xz decompression requires lzma ' +
+                                  '(backports.lzma for Python 2).')
+            return lzma.LZMADecompressor()
+        else:
+            raise NotImplementedError(self.compression)
+
+    def decompress(self, data):
+        """
+        Decompress data, starting a new decompressor at member boundaries.
+
+        Parameters
+        ----------
+        data : str
+            Compressed data.
+        """
+        self.bytes_read += len(data)
+        if self.decompressor is None:
+            return data
+        start = time.time()
+        chunks = []
+        while data:
+            try:
+                chunks.append(self.decompressor.decompress(data))
+            except EOFError:  # bzip2 or xz stream is complete
+                self.decompressor = self.get_decompressor()
+                continue
+            data = self.decompressor.unused_data
+            if data:
+                self.decompressor = self.get_decompressor()
+        self.decompress_time += time.time() - start
+        return ''.join(chunks)
+
+    def fill(self):
+        """
+        Decompress the next chunk of the input stream into the buffer.
+
+        Returns
+        -------
+        filled : bool
+            False if the input stream is exhausted.
+        """
+        if self.eof:
+            return False
+        data = self.fileobj.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            self.finish()
+            return False
+        self.buffer = self.buffer[self.pos:] + self.decompress(data)
+        self.pos = 0
+        return True
+
+    def read(self, size=-1):
+        """
+        Read and return up to size decompressed bytes.
+
+        Parameters
+        ----------
+        size : int, optional
+            Maximum number of bytes to read. If negative, read until the end
+            of the stream.
+        """
+        if size is None:
+            size = -1
+        chunks = [self.buffer[self.pos:]]
+        n_bytes = len(chunks[0])
+        self.buffer = ''
+        self.pos = 0
+        while (size < 0 or n_bytes < size) and not self.eof:
+            data = self.fileobj.read(self.chunk_size)
+            if not data:
+                self.eof = True
+                self.finish()
+                break
+            data = self.decompress(data)
+            chunks.append(data)
+            n_bytes += len(data)
+        data = ''.join(chunks)
+        if 0 <= size < len(data):
+            data, self.buffer = data[:size], data[size:]
+        return data
+
+    def readline(self):
+        """
+        Read and return one line of decompressed data.
+        """
+        index = self.buffer.find('\n', self.pos)
+        while index < 0:
+            searched = len(self.buffer) - self.pos
+            if not self.fill():
+                break
+            index = self.buffer.find('\n', searched)
+        if index < 0:
+            index = len(self.buffer)
+        else:
+            index += 1
+        line = self.buffer[self.pos:index]
+        self.pos = index
+        return line
+
+    def iter_chunks(self, size=65536):
+        """
+        Iterate over decompressed data in chunks.
+
+        Parameters
+        ----------
+        size : int, optional (default 65536)
+            Maximum number of bytes per chunk.
+        """
+        while True:
+            data = self.read(size)
+            if not data:
+                break
+            yield data
+
+    def finish(self):
+        """
+        Call on_finish, if it has not already been called.
+        """
+        on_finish, self.on_finish = self.on_finish, None
+        if on_finish is not None:
+            on_finish(self)
+
+    def close(self):
+        """
+        Close the input stream.
+        """
+        self.fileobj.close()
+        self.finish()
+
+
+class ChainedReader(object):
+    """
+    File-like object that reads a sequence of streams one after another.
+
+    Each stream is taken from `readers` only when the previous one has been
+    read to the end (and closed), so streams can be opened lazily.
+
+    Parameters
+    ----------
+    readers : iterable
+        File-like objects to read in order.
+    """
+    def __init__(self, readers):
+        self.readers = iter(readers)
+        self.current = None
+        self.eof = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """
+        Return the next line.
+        """
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def advance(self):
+        """
+        Close the current stream and open the next one.
+
+        Returns
+        -------
+        advanced : bool
+            Whether another stream was opened.
+        """
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+        if self.eof:
+            return False
+        try:
+            self.current = next(self.readers)
+        except StopIteration:
+            self.eof = True
+            return False
+        return True
+
+    def read(self, size=-1):
+        """
+        Read and return up to size bytes.
+
+        Parameters
+        ----------
+        size : int, optional
+            Maximum number of bytes to read. If negative, read until the end
+            of the last stream.
+        """
+        if size is None:
+            size = -1
+        chunks = []
+        n_bytes = 0
+        while size < 0 or n_bytes < size:
+            if self.current is None and not self.advance():
+                break
+            data = self.current.read(size - n_bytes if size >= 0 else -1)
+            if not data:
+                self.advance()
+                continue
+            chunks.append(data)
+            n_bytes += len(data)
+        return ''.join(chunks)
+
+    def readline(self):
+        """
+        Read and return one line. Lines are not joined across streams.
+        """
+        while self.current is not None or self.advance():
+            line = self.current.readline()
+            if line:
+                return line
+            self.advance()
+        return ''
+
+    def iter_chunks(self, size=65536):
+        """
+        Iterate over data in chunks.
+
+        Parameters
+        ----------
+        size : int, optional (default 65536)
+            Maximum number of bytes per chunk.
+        """
+        while True:
+            data = self.read(size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        """
+        Close the current stream. Streams that have not been opened are
+        skipped.
+        """
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+        self.eof = True
+        if hasattr(self.readers, 'close'):
+            self.readers.close()
+
+
+def iter_sdf_records(f, sids=False):
+    """
+    Iterate over records in an SDF stream.
+
+    Parameters
+    ----------
+    f : iterable
+        SDF lines, such as a file or DecompressingReader.
+    sids : bool, optional (default False)
+        Whether records are substances. If False, records are assumed to be
+        compounds.
+
+    Yields
+    ------
+    uid : int
+        PubChem substance or compound ID, taken from the PUBCHEM_SUBSTANCE_ID
+        or PUBCHEM_COMPOUND_CID data field if present and the record title
+        otherwise.
+    record : str
+        SDF record, including the terminating '$$$$' line.
+    """
+    if sids:
+        field = '<PUBCHEM_SUBSTANCE_ID>'
+    else:
+        field = '<PUBCHEM_COMPOUND_CID>'
+    lines = []
+    uid = None
+    in_field = False
+    for line in f:
+        if not lines:
+            uid = line.strip()
+        lines.append(line)
+        if in_field:
+            uid = line.strip()
+            in_field = False
+        elif line.startswith('>') and field in line:
+            in_field = True
+        elif line.startswith('$$$$'):
+            yield int(uid), ''.join(lines)
+            lines = []
+    if ''.join(lines).strip():
+        yield int(uid), ''.join(lines)
+
+
+def read_sdf_records(filename, sids=False):
+    """
+    Iterate over records in an SDF file.
+
+    Parameters
+    ----------
+    filename : str
+        SDF filename. Files ending in '.gz' or '.bz2' are decompressed as
+        they are read.
+    sids : bool, optional (default False)
+        Whether records are substances. If False, records are assumed to be
+        compounds.
+
+    Yields
+    ------
+    uid : int
+        PubChem substance or compound ID.
+    record : str
+        SDF record.
+    """
+    with open_compressed(filename) as f:
+        for uid, record in iter_sdf_records(f, sids):
+            yield uid, record
+
+
+def open_compressed(filename):
+    """
+    Open a file for reading, decompressing it if its name ends in '.gz',
+    '.bz2' or '.xz'.
+
+    Parameters
+    ----------
+    filename : str
+        Filename.
+    """
+    compression = None
+    if filename.endswith('.gz'):
+        compression = 'gzip'
+    elif filename.endswith('.bz2'):
+        compression = 'bzip2'
+    elif filename.endswith('.xz'):
+        compression = 'xz'
+    return DecompressingReader(open(filename, 'rb'), compression)
+
+
+def iter_assay_table(f, columns=None, chunk_size=100000):
+    """
+    Iterate over a PubChem BioAssay CSV data table in typed, columnar
+    chunks.
+
+    The SID, CID and result tag columns are parsed as int64 (0 if missing),
+    PUBCHEM_ACTIVITY_OUTCOME as int8 codes (see ACTIVITY_OUTCOMES; 0 if
+    missing) and PUBCHEM_ACTIVITY_SCORE as float64 (NaN if missing). Other
+    columns are typed according to the RESULT_TYPE row of the table, with
+    STRING and untyped columns returned as objects. Descriptive rows (such
+    as RESULT_TYPE and RESULT_UNIT) are skipped.
+
+    Parameters
+    ----------
+    f : iterable
+        CSV lines, such as a file or DecompressingReader.
+    columns : list, optional
+        Columns to read. Defaults to the columns in ASSAY_COLUMNS that are
+        present in the table.
+    chunk_size : int, optional (default 100000)
+        Maximum number of rows per chunk.
+
+    Yields
+    ------
+    chunk : ndarray
+        Structured array with a field for each column. At least one
+        (possibly empty) chunk is yielded for a table with a header.
+    """
+    reader = csv.reader(f)
+    try:
+        header = reader.next()
+    except StopIteration:
+        return
+    if columns is None:
+        columns = [name for name in ASSAY_COLUMNS if name in header]
+    indices = []
+    for name in columns:
+        if name not in header:
+            raise ValueError('Unknown column "{}".'.format(name))
+        indices.append(header.index(name))
+    tag = None
+    if 'PUBCHEM_RESULT_TAG' in header:
+        tag = header.index('PUBCHEM_RESULT_TAG')
+    types = dict((name, ASSAY_COLUMN_TYPES.get(name)) for name in columns)
+    rows = []
+    n_chunks = 0
+    for row in reader:
+        if not row:
+            continue
+        if tag is not None and row[tag].startswith('RESULT_'):
+            if row[tag] == 'RESULT_TYPE':
+                for name, i in zip(columns, indices):
+                    if i < len(row) and row[i] in RESULT_TYPES:
+                        types[name] = RESULT_TYPES[row[i]]
+            continue
+        rows.append([row[i] if i < len(row) else '' for i in indices])
+        if len(rows) >= chunk_size:
+            yield _get_assay_chunk(columns, types, rows)
+            n_chunks += 1
+            rows = []
+    if rows or not n_chunks:
+        yield _get_assay_chunk(columns, types, rows)
+
+
+def read_assay_table(filename, columns=None, chunk_size=100000):
+    """
+    Iterate over a PubChem BioAssay CSV data table file in typed, columnar
+    chunks (see `iter_assay_table`).
+
+    Parameters
+    ----------
+    filename : str
+        CSV filename. Files ending in '.gz' or '.bz2' are decompressed as
+        they are read.
+    columns : list, optional
+        Columns to read.
+    chunk_size : int, optional (default 100000)
+        Maximum number of rows per chunk.
+    """
+    with open_compressed(filename) as f:
+        for chunk in iter_assay_table(f, columns, chunk_size):
+            yield chunk
+
+
+def _get_assay_chunk(columns, types, rows):
+    """
+    Convert rows of an assay data table to a structured array.
+
+    Parameters
+    ----------
+    columns : list
+        Column names.
+    types : dict
+        Maps column names to data types (None for objects).
+    rows : list
+        Rows of string values.
+    """
+    dtype = [(name, types[name] or object) for name in columns]
+    chunk = np.zeros(len(rows), dtype=dtype)
+    if not rows:
+        return chunk
+    for name, values in zip(columns, zip(*rows)):
+        values = np.asarray(values)
+        if name == 'PUBCHEM_ACTIVITY_OUTCOME':
+            outcomes, inverse = np.unique(values, return_inverse=True)
+            codes = [ACTIVITY_OUTCOMES.get(outcome.lower(), 0)
+                     if not outcome.isdigit() else int(outcome)
+                     for outcome in outcomes]
+            chunk[name] = np.asarray(codes, dtype=np.int8)[inverse]
+        elif types[name] is None:
+            chunk[name] = values.astype(object)
+        elif np.issubdtype(types[name], np.floating):
+            chunk[name] = np.where(values == '', 'nan', values).astype(
+                types[name])
+        else:
+            chunk[name] = np.where(values == '', '0', values).astype(
+                types[name])
+    return chunk
+
+
+def read_int_array(f, dtype=np.int64, chunk_size=1048576):
+    """
+    Parse whitespace-separated integers from a stream into an array.
+
+    The stream is read in chunks and each chunk is parsed by NumPy, so no
+    per-line Python objects are created. Each chunk is parsed as int64 and
+    then converted to dtype, so only the output array is held at the
+    requested width.
+
+    Parameters
+    ----------
+    f : file-like
+        Input stream, such as a file, mmap or DecompressingReader.
+    dtype : dtype, optional (default np.int64)
+        Integer array data type.
+    chunk_size : int, optional (default 1048576)
+        Number of bytes to read at a time.
+
+    Raises
+    ------
+    ValueError
+        If the stream contains anything other than integers and whitespace,
+        or values that do not fit in dtype.
+    """
+    chunks = []
+    tail = ''
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        data = tail + data
+        end = max(data.rfind('\n'), data.rfind(' ')) + 1
+        tail = data[end:]  # hold back a partial number
+        if end:
+            chunks.append(_parse_int_chunk(data[:end], dtype))
+    if tail.strip():
+        chunks.append(_parse_int_chunk(tail, dtype))
+    if not chunks:
+        return np.zeros(0, dtype=dtype)
+    if len(chunks) == 1:
+        return chunks[0]
+    return np.concatenate(chunks)
+
+
+def _parse_int_chunk(data, dtype):
+    """
+    Parse whitespace-separated integers and convert them to dtype.
+
+    Parameters
+    ----------
+    data : str
+        Integers separated by whitespace.
+    dtype : dtype
+        Integer array data type.
+    """
+    match = _NON_INTEGER.search(data)
+    if match is not None:
+        start = match.start()
+        while start and not data[start - 1].isspace():
+            start -= 1
+        raise ValueError('Invalid integer data: {!r}'.format(
+            data[start:match.start() + 20].split()[0]))
+    values = np.fromstring(data, dtype=np.int64, sep=' ')
+
+    # np.fromstring clamps out-of-range values to the int64 limits
+    limits = np.iinfo(np.int64)
+    clamped = np.flatnonzero((values == limits.max) | (values == limits.min))
+    if clamped.size:
+        tokens = data.split()
+        for i in clamped:
+            if int(tokens[i]) != int(values[i]):
+                raise ValueError('Value does not fit in int64: {}'.format(
+                    tokens[i]))
+    if np.dtype(dtype) == values.dtype or not values.size:
+        return values.astype(dtype, copy=False)
+    info = np.iinfo(dtype)
+    if values.min() < info.min or values.max() > info.max:
+        raise ValueError('Values do not fit in {}.'.format(np.dtype(dtype)))
+    return values.astype(dtype)
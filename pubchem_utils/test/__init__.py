@@ -7,7 +7,42 @@ import unittest
 import urllib2
 import tempfile
 
-from .. import PubChem
+from .. import AsyncPubChem, PubChem
+from ..cache import RecordCache
+
+
+def identical_sdf(a, b):
+    """
+    Compare SDF records.
+
+    SDF records downloaded from PubChem have a timestamp in the second line
+    of each record that should not be considered in the comparison.
+
+    Parameters
+    ----------
+    a, b : str
+        SDF records to compare.
+    """
+    if a == b:  # sometimes the timestamps match
+        return True
+    a_records = a.split('$$$$\n')
+    b_records = b.split('$$$$\n')
+    if len(a_records) != len(b_records):
+        return False
+    for a_record, b_record in zip(a_records, b_records):
+        a_lines = a_record.split('\n')
+        b_lines = b_record.split('\n')
+        if len(a_lines) != len(b_lines):
+            return False
+        for i in xrange(len(a_lines)):
+            if i == 1:
+                if not (a_lines[i].strip().startswith('-OEChem') and
+                        b_lines[i].strip().startswith('-OEChem')):
+                    return False
+                continue
+            if a_lines[i] != b_lines[i]:
+                return False
+    return True
 
 
 class TestPubChem(unittest.TestCase):
@@ -24,35 +59,6 @@ class TestPubChem(unittest.TestCase):
         self.engine = PubChem(delay=3)  # shorten delay for tests
         self.rest_url = 'http://pubchem.ncbi.nlm.nih.gov/rest/pug'
 
-    def identical_sdf(self, a, b):
-        """
-        Compare SDF records.
-
-        SDF records downloaded from PubChem have a timestamp that should not be
-        considered in the comparison.
-
-        Parameters
-        ----------
-        a, b : str
-            SDF records to compare.
-        """
-        if a == b:  # sometimes the timestamps match
-            return True
-
-        try:
-            a_lines = a.split('\n')
-            b_lines = b.split('\n')
-            assert len(a_lines) == len(b_lines)
-            for i in xrange(len(a_lines)):
-                if i == 1:
-                    assert a_lines[i].strip().startswith('-OEChem')
-                    assert b_lines[i].strip().startswith('-OEChem')
-                    continue
-                assert a_lines[i] == b_lines[i]
-            return True
-        except AssertionError:
-            return False
-
     def test_get_records_cid(self):
         """
         2D CID request with get_records().
@@ -60,7 +66,7 @@ class TestPubChem(unittest.TestCase):
         url = os.path.join(self.rest_url, 'compound/cid/2244/SDF')
         ref = urllib2.urlopen(url).read()
         data = self.engine.get_records([2244])
-        assert self.identical_sdf(data, ref)
+        assert identical_sdf(data, ref)
 
     def test_get_record_cid(self):
         """
@@ -69,7 +75,66 @@ class TestPubChem(unittest.TestCase):
         url = os.path.join(self.rest_url, 'compound/cid/2244/SDF')
         ref = urllib2.urlopen(url).read()
         data = self.engine.get_record(2244)
-        assert self.identical_sdf(data, ref)
+        assert identical_sdf(data, ref)
+
+    def test_async_get_records(self):
+        """
+        Concurrent CID requests with AsyncPubChem.
+        """
+        engine = AsyncPubChem(delay=3)
+        queries = [engine.get_records([cid]) for cid in [2244, 3672]]
+        data = engine.gather(queries)
+        assert identical_sdf(data[0], self.engine.get_record(2244))
+        assert identical_sdf(data[1], self.engine.get_record(3672))
+
+    def test_get_records_stream(self):
+        """
+        Streaming CID request with get_records().
+        """
+        ref = self.engine.get_records([2244])
+        with self.engine.get_records([2244], stream=True) as f:
+            data = ''.join(f)
+        assert identical_sdf(data, ref)
+
+    def test_get_records_bzip2(self):
+        """
+        CID request with get_records() and bzip2 compression.
+        """
+        ref = self.engine.get_records([2244])
+        data = self.engine.get_records([2244], compression='bzip2')
+        assert identical_sdf(data, ref)
+
+    def test_iter_records(self):
+        """
+        Iterate over CID records with iter_records().
+        """
+        records = list(self.engine.iter_records([2244, 3672, 1983],
+                                                chunk_size=2, max_in_flight=2))
+        assert [cid for cid, _ in records] == [2244, 3672, 1983]
+        assert identical_sdf(records[0][1], self.engine.get_record(2244))
+
+    def test_get_records_cache(self):
+        """
+        CID requests with get_records() and a record cache.
+        """
+        engine = PubChem(delay=3, cache=RecordCache(':memory:'))
+        ref = self.engine.get_records([2244, 3672])
+        assert identical_sdf(engine.get_records([2244]),
+                             self.engine.get_record(2244))
+        assert len(engine.cache) == 1
+        data = engine.get_records([2244, 3672])
+        assert len(engine.cache) == 2
+        assert identical_sdf(data, ref)
+
+    def test_get_records_rest(self):
+        """
+        Batched CID request with get_records_rest().
+        """
+        ref = ''.join(self.engine.get_record(cid)
+                      for cid in [2244, 3672, 1983])
+        data = self.engine.get_records_rest([2244, 3672, 1983], batch_size=2,
+                                            n_jobs=2)
+        assert identical_sdf(data, ref)
 
     def test_get_records_sid(self):
         """
@@ -78,7 +143,7 @@ class TestPubChem(unittest.TestCase):
         url = os.path.join(self.rest_url, 'substance/sid/179038559/SDF')
         ref = urllib2.urlopen(url).read()
         data = self.engine.get_records([179038559], sids=True)
-        assert self.identical_sdf(data, ref)
+        assert identical_sdf(data, ref)
 
     def test_get_record_sid(self):
         """
@@ -87,7 +152,7 @@ class TestPubChem(unittest.TestCase):
         url = os.path.join(self.rest_url, 'substance/sid/179038559/SDF')
         ref = urllib2.urlopen(url).read()
         data = self.engine.get_record(179038559, sid=True)
-        assert self.identical_sdf(data, ref)
+        assert identical_sdf(data, ref)
 
     def test_get_records_3d(self):
         """
@@ -97,7 +162,7 @@ class TestPubChem(unittest.TestCase):
                            'compound/cid/2244/SDF?record_type=3d')
         ref = urllib2.urlopen(url).read()
         data = self.engine.get_records([2244], use_3d=True)
-        assert self.identical_sdf(data, ref)
+        assert identical_sdf(data, ref)
 
     def test_get_record_3d(self):
         """
@@ -107,7 +172,7 @@ class TestPubChem(unittest.TestCase):
                            'compound/cid/2244/SDF?record_type=3d')
         ref = urllib2.urlopen(url).read()
         data = self.engine.get_record(2244, use_3d=True)
-        assert self.identical_sdf(data, ref)
+        assert identical_sdf(data, ref)
 
     def test_aid_cids(self):
         """
@@ -240,7 +305,7 @@ class TestPubChem(unittest.TestCase):
             self.engine.get_record(2244, filename=fn)
             with open(fn) as f:
                 data = f.read()
-            assert self.identical_sdf(data, ref)
+            assert identical_sdf(data, ref)
         finally:
             os.close(fd)
             os.unlink(fn)
@@ -0,0 +1,729 @@
+"""
+Offline stand-in for the PubChem PUG and PUG REST services.
+
+The server answers the PUG (pug.cgi) and PUG REST requests made by this
+package with synthetic records, so tests and benchmarks can run without
+network access. PUG queries move through queued, running and success
+states, and latency and failures can be injected.
+"""
+import BaseHTTPServer
+import bz2
+import gzip
+import json
+import random
+import re
+import socket
+import SocketServer
+import sys
+from StringIO import StringIO
+import threading
+import time
+import urlparse
+
+__author__ = "Steven Kearnes"
+__copyright__ = "Copyright 2014, Stanford University"
+__license__ = "3-clause BSD"
+
+
+class PubChemServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local stand-in for PubChem.
+
+    Parameters
+    ----------
+    latency : float, optional (default 0)
+        Number of seconds to wait before answering each request.
+    job_time : float, optional (default 0)
+        Number of seconds before a PUG query completes. Queries are reported
+        as queued for the first half of this time and running for the
+        second half.
+    failure_rate : float, optional (default 0)
+        Fraction of requests answered with HTTP 503.
+    drop_rate : float, optional (default 0)
+        Fraction of requests whose connection is closed without a response.
+    failure_path : str, optional
+        If provided, failures are only injected into requests whose path
+        starts with this prefix.
+    timestamps : bool, optional (default False)
+        Whether to give SDF records a different timestamp (header line 1)
+        in each response, like PubChem.
+    max_batch_size : int, optional (default 1000)
+        Maximum number of IDs accepted by PUG REST requests. Larger requests
+        are answered with HTTP 400.
+    n_assay_ids : int, optional (default 100)
+        Number of substances and compounds tested in each assay.
+    seed : int, optional
+        Random seed for failure injection.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0, job_time=0, failure_rate=0,
+                 max_batch_size=1000, n_assay_ids=100, seed=None,
+                 drop_rate=0, failure_path=None, timestamps=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.latency = latency
+        self.job_time = job_time
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.failure_path = failure_path
+        self.timestamps = timestamps
+        self.max_batch_size = max_batch_size
+        self.n_assay_ids = n_assay_ids
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.n_requests = 0
+        self.n_stamps = 0
+        self.thread = None
+        self.requests = set()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def url(self):
+        """
+        Base URL for the server.
+        """
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+    @property
+    def pug_url(self):
+        """
+        PUG URL.
+        """
+        return self.url + '/pug/pug.cgi'
+
+    @property
+    def rest_url(self):
+        """
+        Base URL for PUG REST requests.
+        """
+        return self.url + '/rest/pug'
+
+    def start(self):
+        """
+        Start serving requests in a background thread.
+        """
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the server and close open connections.
+        """
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            requests, self.requests = self.requests, set()
+        for request in requests:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def process_request_thread(self, request, client_address):
+        """
+        Handle a connection, tracking it so it can be closed by `stop`.
+        """
+        with self.lock:
+            self.requests.add(request)
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        finally:
+            with self.lock:
+                self.requests.discard(request)
+
+    def handle_error(self, request, client_address):
+        """
+        Ignore connections closed by clients.
+        """
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+    def should_fail(self, path):
+        """
+        Decide whether to inject a failure into the current request.
+
+        Parameters
+        ----------
+        path : str
+            Request path.
+        """
+        with self.lock:
+            self.n_requests += 1
+            if (self.failure_path is not None and
+                    not path.startswith(self.failure_path)):
+                return False
+            return self.random.random() < self.failure_rate
+
+    def should_drop(self):
+        """
+        Decide whether to close the connection of the current request
+        without responding.
+        """
+        with self.lock:
+            return self.random.random() < self.drop_rate
+
+    def add_job(self, data, compression):
+        """
+        Store the result of a PUG query.
+
+        Parameters
+        ----------
+        data : str
+            Uncompressed query result.
+        compression : str
+            Compression type.
+
+        Returns
+        -------
+        reqid : str
+            Request ID.
+        """
+        with self.lock:
+            reqid = str(len(self.jobs) + 1)
+            self.jobs[reqid] = {'data': compress(data, compression),
+                                'submitted': time.time(),
+                                'canceled': False}
+        return reqid
+
+    def get_status(self, reqid):
+        """
+        Get the status of a PUG query.
+
+        Parameters
+        ----------
+        reqid : str
+            Request ID.
+        """
+        job = self.jobs[reqid]
+        if job['canceled']:
+            return 'stopped'
+        elapsed = time.time() - job['submitted']
+        if elapsed >= self.job_time:
+            return 'success'
+        elif elapsed >= self.job_time / 2.:
+            return 'running'
+        return 'queued'
+
+    def get_queue_position(self, reqid):
+        """
+        Get the number of queued PUG queries submitted before a query.
+
+        Parameters
+        ----------
+        reqid : str
+            Request ID.
+        """
+        with self.lock:
+            jobs = self.jobs.items()
+        return sum(1 for other, job in jobs
+                   if int(other) < int(reqid) and not job['canceled'] and
+                   self.get_status(other) == 'queued')
+
+    def get_throttling(self):
+        """
+        Get the X-Throttling-Control header reported with PUG responses.
+        The service load is 10% for each unfinished query.
+        """
+        with self.lock:
+            jobs = self.jobs.keys()
+        load = min(100, 10 * sum(1 for reqid in jobs
+                                 if self.get_status(reqid) != 'success'))
+        color = 'Green' if load < 50 else 'Yellow' if load < 75 else 'Red'
+        return ('Request Count status: Green (0%), Request Time status: '
+                'Green (0%), Service status: {} ({}%)'.format(color, load))
+
+    @staticmethod
+    def record(uid, sids=False):
+        """
+        Get a synthetic SDF record.
+
+        Parameters
+        ----------
+        uid : int
+            Substance or compound ID.
+        sids : bool, optional (default False)
+            Whether uid is a SID.
+        """
+        if sids:
+            field = 'PUBCHEM_SUBSTANCE_ID'
+        else:
+            field = 'PUBCHEM_COMPOUND_CID'
+        return ('{0}\n  -OEChem-01011500002D\n\n'
+                '  1  0  0     0  0  0  0  0  0999 V2000\n'
+                '    0.0000    0.0000    0.0000 C   0  0  0  0  0  0  0  0'
+                '  0  0  0  0\n'
+                'M  END\n> <{1}>\n{0}\n\n$$$$\n').format(uid, field)
+
+    def stamp(self, data):
+        """
+        Replace the timestamps of the SDF records in a response.
+
+        Parameters
+        ----------
+        data : str
+            SDF records.
+        """
+        if not self.timestamps:
+            return data
+        with self.lock:
+            self.n_stamps += 1
+            stamp = self.n_stamps
+        return data.replace('-OEChem-01011500002D',
+                            '-OEChem-{:010d}2D'.format(stamp))
+
+    @staticmethod
+    def parent(cid):
+        """
+        Get the synthetic parent of a compound (0 if none).
+
+        Parameters
+        ----------
+        cid : int
+            Compound ID.
+        """
+        if cid % 3 == 0:
+            return 0
+        return cid - cid % 3
+
+    @classmethod
+    def parents(cls, cid):
+        """
+        Get the synthetic parents of a compound. Compounds with CIDs above
+        10 ** 8 are mixtures with two parents.
+
+        Parameters
+        ----------
+        cid : int
+            Compound ID.
+        """
+        if cid > 10 ** 8:
+            return [cid - 1, cid - 2]
+        parent = cls.parent(cid)
+        if parent:
+            return [parent]
+        return []
+
+    @staticmethod
+    def exchange(source_id):
+        """
+        Get the synthetic PubChem ID for a registry ID (None if unmatched).
+
+        Parameters
+        ----------
+        source_id : str
+            Registry ID, such as 'CHEMBL25'.
+        """
+        match = re.search(r'(\d+)$', source_id)
+        if match is None or int(match.group(1)) % 10 == 0:
+            return None
+        return int(match.group(1))
+
+    def assay_ids(self, aid, sids=False, activity_outcome=None):
+        """
+        Get synthetic IDs tested in an assay.
+
+        Every fifth ID is active.
+
+        Parameters
+        ----------
+        aid : int
+            Assay ID.
+        sids : bool, optional (default False)
+            Whether to return SIDs.
+        activity_outcome : str, optional
+            Only return IDs with this outcome ('active' or 'inactive').
+        """
+        offset = aid * 1000000
+        if sids:
+            offset += 500000
+        ids = []
+        for i in xrange(self.n_assay_ids):
+            active = i % 5 == 0
+            if activity_outcome == 'active' and not active:
+                continue
+            if activity_outcome == 'inactive' and active:
+                continue
+            ids.append(offset + i + 1)
+        return ids
+
+    def assay_table(self, aid):
+        """
+        Get a synthetic assay data table in CSV format.
+
+        Parameters
+        ----------
+        aid : int
+            Assay ID.
+        """
+        lines = ['PUBCHEM_RESULT_TAG,PUBCHEM_SID,PUBCHEM_CID,'
+                 'PUBCHEM_ACTIVITY_OUTCOME,PUBCHEM_ACTIVITY_SCORE,'
+                 'PUBCHEM_ACTIVITY_URL,PUBCHEM_ASSAYDATA_COMMENT,Potency,'
+                 'Phenotype',
+                 'RESULT_TYPE,,,,,,,FLOAT,STRING',
+                 'RESULT_UNIT,,,,,,,MICROMOLAR,']
+        sids = self.assay_ids(aid, sids=True)
+        cids = self.assay_ids(aid)
+        for i, (sid, cid) in enumerate(zip(sids, cids)):
+            if i % 5 == 0:
+                outcome, score = 'Active', 80 + i % 20
+                potency, phenotype = 0.1 * (i % 7 + 1), '"Inhibitor, weak"'
+            else:
+                outcome, score = 'Inactive', i % 20
+                potency, phenotype = '', 'Inactive'
+            lines.append('{},{},{},{},{},,,{},{}'.format(
+                i + 1, sid, cid, outcome, score, potency, phenotype))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def structure_cid(structure):
+        """
+        Get the synthetic CID matching a structure.
+
+        Parameters
+        ----------
+        structure : str
+            SMILES or SDF query. Structures containing wildcard atoms ('*')
+            do not match any CID.
+        """
+        if '*' in structure:
+            return None
+        return sum(ord(c) for c in structure) % 100000 + 1
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Request handler for PubChemServer.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        """
+        Silence request logging.
+        """
+        pass
+
+    def do_GET(self):
+        """
+        Respond to GET requests.
+        """
+        self.handle_request(None)
+
+    def do_POST(self):
+        """
+        Respond to POST requests.
+        """
+        length = int(self.headers.getheader('content-length') or 0)
+        self.handle_request(self.rfile.read(length))
+
+    def handle_request(self, body):
+        """
+        Dispatch a request.
+
+        Parameters
+        ----------
+        body : str
+            Request body, or None for GET requests.
+        """
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.should_drop():
+            self.close_connection = 1
+            return
+        if self.server.should_fail(self.path):
+            self.respond('Service unavailable.', code=503)
+            return
+        parts = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(parts.query))
+        if body is not None and parts.path.startswith('/rest/'):
+            params.update(urlparse.parse_qsl(body))
+        if parts.path == '/pug/pug.cgi':
+            self.pug(body)
+        elif parts.path.startswith('/download/'):
+            self.download(parts.path.split('/')[-1])
+        elif parts.path.startswith('/rest/pug/'):
+            self.rest(parts.path[len('/rest/pug/'):].split('/'), params)
+        else:
+            self.respond('Not found.', code=404)
+
+    def respond(self, body, code=200, headers=None):
+        """
+        Send a response.
+
+        Parameters
+        ----------
+        body : str
+            Response body.
+        code : int, optional (default 200)
+            HTTP status code.
+        headers : dict, optional
+            Additional response headers.
+        """
+        if self.path == '/pug/pug.cgi' and code == 200:
+            headers = dict(headers or {})
+            headers['X-Throttling-Control'] = self.server.get_throttling()
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def pug(self, query):
+        """
+        Answer a PUG request.
+
+        Parameters
+        ----------
+        query : str
+            PUG query XML.
+        """
+        reqid = re.search(r'<PCT-Request_reqid>\s*(\S+?)\s*<', query)
+        if reqid is not None:
+            reqid = reqid.group(1)
+            if reqid not in self.server.jobs:
+                self.respond(pug_response('server-error',
+                                          message='Unknown request.'))
+                return
+            if 'value="cancel"' in query:
+                self.server.jobs[reqid]['canceled'] = True
+        else:
+            try:
+                data, compression = self.run_query(query)
+            except ValueError as e:
+                self.respond(pug_response('input-error', message=str(e)))
+                return
+            reqid = self.server.add_job(data, compression)
+        status = self.server.get_status(reqid)
+        if status == 'success':
+            self.respond(pug_response(
+                status, download_url='{}/download/{}'.format(
+                    self.server.url, reqid)))
+        elif status == 'queued':
+            self.respond(pug_response(
+                status, reqid=reqid,
+                message='Your request is queued at position {}.'.format(
+                    self.server.get_queue_position(reqid))))
+        else:
+            self.respond(pug_response(status, reqid=reqid))
+
+    def run_query(self, query):
+        """
+        Compute the result of a PUG query.
+
+        Parameters
+        ----------
+        query : str
+            PUG query XML.
+
+        Returns
+        -------
+        data : str
+            Uncompressed query result.
+        compression : str
+            Compression type.
+        """
+        compression = re.search(r'_compression value="(.*?)"', query)
+        compression = compression.group(1) if compression else 'none'
+        uids = re.findall(r'<PCT-ID-List_uids_E>\s*(\d+)', query)
+        if '<PCT-Download>' in query:
+            sids = '>pcsubstance<' in query
+            download_format = re.search(r'<PCT-Download_format value="(.*?)"',
+                                        query).group(1)
+            if download_format == 'sdf':
+                data = self.server.stamp(''.join(
+                    self.server.record(int(uid), sids) for uid in uids))
+            elif download_format == 'smiles':
+                data = ''.join('{}\tC\n'.format(uid) for uid in uids)
+            else:
+                raise ValueError('Unsupported format.')
+        elif '<PCT-QueryAssayData>' in query:
+            tables = [self.server.assay_table(int(aid)) for aid in uids]
+            data = tables[0] + ''.join(
+                table.split('\n', 1)[1] for table in tables[1:])
+        elif '<PCT-QueryIDExchange>' in query:
+            source_ids = re.findall(
+                r'<PCT-RegistryIDs_source-ids_E>\s*(\S+?)\s*<', query)
+            lines = []
+            for source_id in source_ids:
+                uid = self.server.exchange(source_id)
+                if uid is not None:
+                    lines.append('{}\t{}\n'.format(source_id, uid))
+            data = ''.join(lines)
+        else:
+            raise ValueError('Unsupported query.')
+        return data, compression
+
+    def download(self, reqid):
+        """
+        Send the result of a PUG query, honoring range requests.
+
+        Parameters
+        ----------
+        reqid : str
+            Request ID.
+        """
+        if reqid not in self.server.jobs:
+            self.respond('Not found.', code=404)
+            return
+        data = self.server.jobs[reqid]['data']
+        range_header = self.headers.getheader('range')
+        if range_header is None:
+            self.respond(data, headers={'Accept-Ranges': 'bytes'})
+            return
+        first, last = range_header.split('=')[1].split('-')
+        start = int(first)
+        end = int(last) if last else len(data) - 1
+        if start >= len(data):
+            self.respond('', code=416)
+            return
+        self.respond(data[start:end + 1], code=206, headers={
+            'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(data))})
+
+    def rest(self, path, params):
+        """
+        Answer a PUG REST request.
+
+        Parameters
+        ----------
+        path : list
+            Path components following /rest/pug/.
+        params : dict
+            Query string and form parameters.
+        """
+        server = self.server
+        if path[0] in ['compound', 'substance'] and path[1] in ['cid', 'sid']:
+            sids = path[1] == 'sid'
+            if path[1] in params:  # IDs in POST body
+                ids = params[path[1]]
+                output = path[2:]
+            else:
+                ids = path[2]
+                output = path[3:]
+            ids = [int(uid) for uid in ids.split(',') if uid]
+            if len(ids) > server.max_batch_size:
+                self.respond('Too many IDs.', code=400)
+            elif output == ['SDF']:
+                self.respond(server.stamp(''.join(server.record(uid, sids)
+                                                  for uid in ids)))
+            elif output == ['cids', 'JSON']:
+                # like PubChem, one group per unique input CID, in no
+                # particular order; groups without parents have no list
+                ids = sorted(set(ids))
+                random.Random(len(ids)).shuffle(ids)
+                info = []
+                for uid in ids:
+                    group = {'CID': uid}
+                    if server.parents(uid):
+                        group['ParentCID'] = server.parents(uid)
+                    info.append(group)
+                self.respond(json.dumps(
+                    {'InformationList': {'Information': info}}))
+            else:
+                self.respond('Not found.', code=404)
+        elif path[0] == 'assay' and path[3] == 'description':
+            aids = [int(aid) for aid in path[2].split(',')]
+            if len(aids) > server.max_batch_size:
+                self.respond('Too many IDs.', code=400)
+                return
+            container = [{'assay': {'descr': {
+                'aid': {'id': aid}, 'name': 'Assay {}'.format(aid)}}}
+                for aid in aids]
+            self.respond(json.dumps({'PC_AssayContainer': container}))
+        elif path[0] == 'assay':
+            sids = path[3] == 'sids'
+            outcome = params.get('{}_type'.format(path[3]))
+            ids = server.assay_ids(int(path[2]), sids, outcome)
+            self.respond(''.join('{}\n'.format(uid) for uid in ids))
+        elif path[:2] == ['compound', 'identity']:
+            structure = params[path[2]]
+            reqid = server.add_job(str(server.structure_cid(structure)),
+                                   'none')
+            self.respond(
+                '<Waiting>\n<ListKey>{}</ListKey>\n</Waiting>\n'.format(reqid))
+        elif path[:2] == ['compound', 'listkey']:
+            if path[2] not in server.jobs:
+                self.respond('Not found.', code=404)
+            elif server.get_status(path[2]) != 'success':
+                self.respond('<Waiting>\n<ListKey>{}</ListKey>\n'
+                             '</Waiting>\n'.format(path[2]), code=202)
+            elif server.jobs[path[2]]['data'] == 'None':
+                self.respond('No CIDs found.', code=404)
+            else:
+                self.respond('<IdentifierList>\n<CID>{}</CID>\n'
+                             '</IdentifierList>\n'.format(
+                                 server.jobs[path[2]]['data']))
+        else:
+            self.respond('Not found.', code=404)
+
+
+def compress(data, compression):
+    """
+    Compress data.
+
+    Parameters
+    ----------
+    data : str
+        Data to compress.
+    compression : str
+        Compression type ('gzip', 'bzip2' or 'none').
+    """
+    if compression == 'gzip':
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(data)
+        return buf.getvalue()
+    elif compression == 'bzip2':
+        return bz2.compress(data)
+    return data
+
+
+def pug_response(status, reqid=None, download_url=None, message=None):
+    """
+    Construct a PUG response.
+
+    Parameters
+    ----------
+    status : str
+        Query status.
+    reqid : str, optional
+        Request ID for queries that are still being processed.
+    download_url : str, optional
+        Download URL for completed queries.
+    message : str, optional
+        Status message.
+    """
+    output = ''
+    if reqid is not None:
+        output = ('<PCT-OutputData_output><PCT-OutputData_output_waiting>'
+                  '<PCT-Waiting><PCT-Waiting_reqid>{}</PCT-Waiting_reqid>'
+                  '</PCT-Waiting></PCT-OutputData_output_waiting>'
+                  '</PCT-OutputData_output>').format(reqid)
+    elif download_url is not None:
+        output = ('<PCT-OutputData_output>'
+                  '<PCT-OutputData_output_download-url><PCT-Download-URL>'
+                  '<PCT-Download-URL_url>{}</PCT-Download-URL_url>'
+                  '</PCT-Download-URL></PCT-OutputData_output_download-url>'
+                  '</PCT-OutputData_output>').format(download_url)
+    if message is not None:
+        message = ('<PCT-Status-Message_message>{}'
+                   '</PCT-Status-Message_message>').format(message)
+    return ('<?xml version="1.0"?>\n<PCT-Data><PCT-Data_output>'
+            '<PCT-OutputData><PCT-OutputData_status><PCT-Status-Message>'
+            '<PCT-Status-Message_status><PCT-Status value="{}"/>'
+            '</PCT-Status-Message_status>{}</PCT-Status-Message>'
+            '</PCT-OutputData_status>{}</PCT-OutputData>'
+            '</PCT-Data_output></PCT-Data>\n').format(
+                status, message or '', output)
@@ -0,0 +1,51 @@
+"""
+Tests for batching.py.
+"""
+import unittest
+
+from ..batching import BatchQueue
+
+
+class TestBatchQueue(unittest.TestCase):
+    """
+    Tests for BatchQueue.
+    """
+    def test_batches(self):
+        """
+        Test that batches cover all items.
+        """
+        queue = BatchQueue(10, 4)
+        batches = []
+        while True:
+            batch = queue.get()
+            if batch is None:
+                break
+            batches.append(batch)
+            queue.done(batch)
+        assert batches == [(0, 4, 0), (4, 8, 0), (8, 10, 0)]
+
+    def test_failure(self):
+        """
+        Test that failed batches are split and the batch size adapts.
+        """
+        queue = BatchQueue(20, 8, patience=2)
+        batch = queue.get()
+        queue.failed(batch, ValueError())
+        assert queue.batch_size == 4
+        assert queue.get() == (0, 4, 1)
+        queue.done((0, 4, 1))
+        assert queue.get() == (4, 8, 1)
+        queue.done((4, 8, 1))
+        assert queue.batch_size == 8  # grows back after two successes
+        assert queue.get() == (8, 16, 0)
+
+    def test_max_attempts(self):
+        """
+        Test that repeated failures stop the queue.
+        """
+        queue = BatchQueue(1, 1, max_attempts=2)
+        error = ValueError()
+        queue.failed(queue.get(), error)
+        queue.failed(queue.get(), error)
+        assert queue.get() is None
+        assert queue.error is error
@@ -0,0 +1,116 @@
+"""
+Tests for cache.py.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..cache import MappingStore, RecordCache
+
+
+class TestRecordCache(unittest.TestCase):
+    """
+    Tests for RecordCache.
+    """
+    def setUp(self):
+        """
+        Set up tests.
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'cache.db')
+        self.cache = RecordCache(self.filename)
+
+    def tearDown(self):
+        """
+        Clean up tests.
+        """
+        self.cache.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_get_put(self):
+        """
+        Test RecordCache.get and RecordCache.put.
+        """
+        self.cache.put('pccompound', {2244: 'aspirin', 3672: 'ibuprofen'})
+        records = self.cache.get('pccompound', [2244, 3672, 1983])
+        assert records == {2244: 'aspirin', 3672: 'ibuprofen'}
+
+    def test_keys(self):
+        """
+        Test that records are keyed by database, format and 3D options.
+        """
+        self.cache.put('pccompound', {2244: '2d'})
+        self.cache.put('pccompound', {2244: '3d'}, use_3d=True)
+        self.cache.put('pccompound', {2244: '3d-10'}, use_3d=True,
+                       n_conformers=10)
+        assert self.cache.get('pcsubstance', [2244]) == {}
+        assert self.cache.get('pccompound', [2244], 'smiles') == {}
+        assert self.cache.get('pccompound', [2244]) == {2244: '2d'}
+        assert self.cache.get('pccompound', [2244], use_3d=True) == {
+            2244: '3d'}
+        assert self.cache.get('pccompound', [2244], use_3d=True,
+                              n_conformers=10) == {2244: '3d-10'}
+
+    def test_persistence(self):
+        """
+        Test that records persist when the cache is reopened.
+        """
+        self.cache.put('pccompound', {2244: 'aspirin'})
+        self.cache.close()
+        self.cache = RecordCache(self.filename)
+        assert self.cache.get('pccompound', [2244]) == {2244: 'aspirin'}
+
+    def test_evict(self):
+        """
+        Test least recently used eviction.
+        """
+        self.cache.max_size = 20
+        self.cache.put('pccompound', {1: 'a' * 10})
+        self.cache.put('pccompound', {2: 'b' * 10})
+        self.cache.get('pccompound', [1])  # 2 is now least recently used
+        self.cache.put('pccompound', {3: 'c' * 10})
+        assert sorted(self.cache.get('pccompound', [1, 2, 3])) == [1, 3]
+        assert len(self.cache) == 2
+
+
+class TestMappingStore(unittest.TestCase):
+    """
+    Tests for MappingStore.
+    """
+    def setUp(self):
+        """
+        Set up tests.
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'mappings.db')
+        self.store = MappingStore(self.filename)
+
+    def tearDown(self):
+        """
+        Clean up tests.
+        """
+        self.store.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_get_put(self):
+        """
+        Test MappingStore.get and MappingStore.put.
+        """
+        self.store.put('ChEMBL', {'CHEMBL25': 2244, 'CHEMBL10': None})
+        assert len(self.store) == 1
+        assert self.store.get('ChEMBL', ['CHEMBL25', 'CHEMBL10']) == {
+            'CHEMBL25': 2244}
+        assert self.store.get('ChEMBL', ['CHEMBL25'], 'parent') == {}
+        assert self.store.get('ChEMBL', ['CHEMBL25'], output_type='sid') == {}
+
+    def test_persistence(self):
+        """
+        Test that mappings persist when the store is reopened.
+        """
+        self.store.put('ChEMBL', {'CHEMBL25': 2244},
+                       output_type='inchikey')
+        self.store.close()
+        self.store = MappingStore(self.filename)
+        assert self.store.get('ChEMBL', ['CHEMBL25'],
+                              output_type='inchikey') == {'CHEMBL25': 2244}
@@ -0,0 +1,94 @@
+"""
+Tests for idset.py.
+"""
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..idset import IDSet
+
+
+class TestIDSet(unittest.TestCase):
+    """
+    Tests for IDSet.
+    """
+    def setUp(self):
+        """
+        Set up tests.
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        self.a = IDSet([5, 1, 3, 3, 9])
+        self.b = IDSet(np.asarray([3, 4, 5], dtype=np.int64))
+        self.c = IDSet([5, 9, 100])
+
+    def tearDown(self):
+        """
+        Clean up tests.
+        """
+        shutil.rmtree(self.temp_dir)
+
+    def test_init(self):
+        """
+        Test construction.
+        """
+        assert self.a.ids.dtype == np.uint32
+        assert list(self.a) == [1, 3, 5, 9]
+        assert len(IDSet()) == 0
+        assert IDSet(set([2, 1])) == IDSet([1, 2])
+        for ids in [[-1], [2 ** 32], np.asarray([1.5])]:
+            with self.assertRaises(ValueError):
+                IDSet(ids)
+
+    def test_membership(self):
+        """
+        Test scalar and vectorized membership tests.
+        """
+        assert 3 in self.a
+        assert 4 not in self.a
+        assert -1 not in self.a
+        assert 10 not in self.a
+        assert np.array_equal(self.a.contains([0, 1, 2, 9, 10, -5]),
+                              [False, True, False, True, False, False])
+        assert not IDSet().contains([1]).any()
+
+    def test_operations(self):
+        """
+        Test set operations against Python sets.
+        """
+        sets = [set(id_set) for id_set in [self.a, self.b, self.c]]
+        assert set(self.a | self.b) == sets[0] | sets[1]
+        assert set(self.a & self.b) == sets[0] & sets[1]
+        assert set(self.a - self.b) == sets[0] - sets[1]
+        assert set(self.a ^ self.b) == sets[0] ^ sets[1]
+        assert set(self.a.union(self.b, self.c)) == set.union(*sets)
+        assert set(self.a.intersection(self.b, self.c)) == set.intersection(
+            *sets)
+        assert set(self.a.difference(self.b, self.c)) == (
+            sets[0] - sets[1] - sets[2])
+        assert IDSet([3, 5]) <= self.a
+        assert not self.a <= self.b
+        assert self.a >= IDSet([1])
+
+    def test_count_all(self):
+        """
+        Test IDSet.count_all.
+        """
+        ids, counts = IDSet.count_all([self.a, self.b, self.c])
+        assert list(ids) == [1, 3, 4, 5, 9, 100]
+        assert np.array_equal(counts, [1, 2, 1, 3, 2, 1])
+        assert len(IDSet.union_all([])) == 0
+        assert len(IDSet.intersection_all([])) == 0
+
+    def test_save_load(self):
+        """
+        Test IDSet.save and IDSet.load.
+        """
+        filename = os.path.join(self.temp_dir, 'ids.npy')
+        self.a.save(filename)
+        assert IDSet.load(filename) == self.a
+        assert IDSet.load(filename, mmap=True) == self.a
+        np.save(filename, np.arange(3))
+        with self.assertRaises(ValueError):
+            IDSet.load(filename)
@@ -0,0 +1,92 @@
+"""
+Tests for journal.py.
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ..journal import JobJournal
+from ..queries import download_query
+
+
+class TestJobJournal(unittest.TestCase):
+    """
+    Tests for JobJournal.
+    """
+    def setUp(self):
+        """
+        Set up tests.
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'journal.db')
+        self.journal = JobJournal(self.filename)
+
+    def tearDown(self):
+        """
+        Clean up tests.
+        """
+        self.journal.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_hash_query(self):
+        """
+        Test JobJournal.hash_query with string and streamed queries.
+        """
+        ids = range(1, 101)
+        query = download_query(ids)
+        body = download_query(ids, stream=True)
+        assert JobJournal.hash_query(query) == JobJournal.hash_query(body)
+        assert (JobJournal.hash_query(query, 'a') !=
+                JobJournal.hash_query(query, 'b'))
+        assert (JobJournal.hash_query(query) !=
+                JobJournal.hash_query(download_query(ids[1:])))
+
+    def test_get_put(self):
+        """
+        Test JobJournal.get and JobJournal.put.
+        """
+        assert self.journal.get('abc') is None
+        self.journal.put('abc', '123', 'queued')
+        assert self.journal.get('abc') == {
+            'reqid': '123', 'status': 'queued', 'download_url': None}
+        self.journal.put('abc', '123', 'success', 'http://example.com/1')
+        assert self.journal.get('abc')['download_url'] == (
+            'http://example.com/1')
+        assert len(self.journal) == 1
+
+    def test_persistence(self):
+        """
+        Test that entries survive reopening the journal.
+        """
+        self.journal.put('abc', '123', 'running')
+        self.journal.close()
+        self.journal = JobJournal(self.filename)
+        assert self.journal.get('abc')['reqid'] == '123'
+
+    def test_remove_clear(self):
+        """
+        Test JobJournal.remove and JobJournal.clear.
+        """
+        self.journal.put('abc', '123')
+        self.journal.put('def', '456')
+        self.journal.remove('abc')
+        assert self.journal.get('abc') is None
+        assert len(self.journal) == 1
+        self.journal.clear()
+        assert len(self.journal) == 0
+
+    def test_max_age(self):
+        """
+        Test that old entries expire.
+        """
+        self.journal.put('abc', '123', 'running')
+        self.journal.close()
+        self.journal = JobJournal(self.filename, max_age=60)
+        assert self.journal.get('abc')['reqid'] == '123'
+        self.journal.max_age = 0
+        time.sleep(0.01)
+        assert self.journal.get('abc') is None
+        self.journal.expire()
+        assert len(self.journal) == 0
@@ -0,0 +1,85 @@
+"""
+Tests for metrics.py.
+"""
+import unittest
+
+from ..metrics import Metrics, QueryTiming
+
+
+class TestQueryTiming(unittest.TestCase):
+    """
+    Tests for QueryTiming.
+    """
+    def test_times(self):
+        """
+        Test derived times.
+        """
+        timing = QueryTiming()
+        assert timing.queue_time is None
+        assert timing.total_time is None
+        timing.submitted, timing.started, timing.completed = 10., 12., 15.
+        assert timing.queue_time == 2
+        assert timing.run_time == 3
+        assert timing.total_time == 5
+        timing.started = None
+        assert timing.queue_time == 5
+        assert timing.run_time == 0
+        assert timing.as_dict()['total_time'] == 5
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Tests for Metrics.
+    """
+    def setUp(self):
+        """
+        Set up tests.
+        """
+        self.metrics = Metrics(max_records=2)
+        self.events = []
+        self.metrics.add_hook(lambda event, record: self.events.append(
+            (event, record)))
+
+    def test_get_endpoint(self):
+        """
+        Test Metrics.get_endpoint.
+        """
+        endpoint = Metrics.get_endpoint(
+            'https://pubchem.ncbi.nlm.nih.gov/rest/pug/assay/aid/466/cids/txt'
+            '?cids_type=active')
+        assert endpoint == (
+            'pubchem.ncbi.nlm.nih.gov/rest/pug/assay/aid/{id}/cids/txt')
+
+    def test_add_request(self):
+        """
+        Test Metrics.add_request.
+        """
+        self.metrics.add_request('http://a/rest/1', 0.5, 200)
+        self.metrics.add_request('http://a/rest/2', 1.5, 503)
+        summary = self.metrics.summary()
+        assert summary['requests'] == 2
+        assert summary['request_errors'] == 1
+        assert summary['endpoints']['a/rest/{id}'] == {
+            'requests': 2, 'errors': 1, 'time': 2., 'mean_time': 1.}
+        assert [event for event, _ in self.events] == ['request'] * 2
+
+    def test_add_query(self):
+        """
+        Test Metrics.add_query.
+        """
+        for _ in xrange(3):
+            timing = QueryTiming()
+            timing.submitted, timing.completed = 0., 1.
+            timing.n_checks = 2
+            timing.bytes_downloaded = 100
+            timing.download_time = 0.5
+            self.metrics.add_query(timing)
+        summary = self.metrics.summary()
+        assert summary['queries'] == 3
+        assert summary['status_checks'] == 6
+        assert summary['queue_time'] == 3
+        assert summary['download_throughput'] == 200
+        assert len(self.metrics.records) == 2
+        assert self.events[-1] == ('query', timing)
+        self.metrics.reset()
+        assert self.metrics.summary() == {'endpoints': {}}
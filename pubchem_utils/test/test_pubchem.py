@@ -0,0 +1,581 @@
+"""
+Offline tests for PubChem using a local stand-in server.
+"""
+import gzip
+import numpy as np
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+import urllib2
+
+from .. import AsyncPubChem, PubChem
+from ..cache import MappingStore, RecordCache
+from ..idset import IDSet
+from ..journal import JobJournal
+from ..pug import ExponentialBackoff, PUGError, wait
+from . import identical_sdf
+from .server import PubChemServer
+
+
+class TestPubChemOffline(unittest.TestCase):
+    """
+    Tests for PubChem using PubChemServer.
+    """
+    def setUp(self):
+        """
+        Set up tests.
+        """
+        self.server = PubChemServer(seed=0)
+        self.server.start()
+        self.engine = self.get_engine()
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Clean up tests.
+        """
+        shutil.rmtree(self.temp_dir)
+        self.server.stop()
+
+    def get_engine(self, cls=PubChem, **kwargs):
+        """
+        Get a PubChem instance that uses the stand-in server.
+
+        Parameters
+        ----------
+        cls : type, optional (default PubChem)
+            PubChem class.
+        kwargs : dict, optional
+            Keyword arguments for cls.
+        """
+        kwargs.setdefault('delay', 0.01)
+        kwargs.setdefault('pug_url', self.server.pug_url)
+        kwargs.setdefault('rest_url', self.server.rest_url)
+        return cls(**kwargs)
+
+    def records(self, ids, sids=False):
+        """
+        Get reference SDF records.
+
+        Parameters
+        ----------
+        ids : iterable
+            Substance or compound IDs.
+        sids : bool, optional (default False)
+            Whether ids are SIDs.
+        """
+        return ''.join(self.server.record(uid, sids) for uid in ids)
+
+    def test_get_records(self):
+        """
+        Test get_records.
+        """
+        assert self.engine.get_records([2244, 3672]) == self.records(
+            [2244, 3672])
+        assert self.engine.get_records([1, 2], sids=True) == self.records(
+            [1, 2], sids=True)
+
+    def test_get_records_compression(self):
+        """
+        Test get_records with different compression types.
+        """
+        for compression in [None, 'none', 'bzip2']:
+            data = self.engine.get_records([2244], compression=compression)
+            assert data == self.records([2244])
+
+    def test_get_records_queued(self):
+        """
+        Test get_records with queries that take time to complete.
+        """
+        self.server.job_time = 0.1
+        engine = self.get_engine(delay=ExponentialBackoff(initial=0.01))
+        assert engine.get_records([2244]) == self.records([2244])
+        query = engine.get_query(engine._get_records_queries([2244])[0])
+        assert query.response.status == 'success'
+        assert query.response.elapsed > 0
+        assert query.response.throttling['Service'] == ('Green', 0)
+
+    def test_metrics(self):
+        """
+        Test query timing records and aggregate metrics.
+        """
+        self.server.job_time = 0.1
+        events = []
+        self.engine.metrics.add_hook(
+            lambda event, record: events.append(event))
+        assert self.engine.get_records(
+            [2244], compression='gzip') == self.records([2244])
+        timing = self.engine.metrics.records[-1]
+        assert timing.total_time >= 0.1
+        assert timing.n_checks > 0
+        assert timing.n_requests == timing.n_checks + 1
+        assert timing.bytes_downloaded > 0
+        summary = self.engine.metrics.summary()
+        assert summary['queries'] == 1
+        assert summary['requests'] == timing.n_requests + 1  # download
+        assert events.count('query') == 1
+        assert events.count('request') == summary['requests']
+
+    def test_metrics_stream(self):
+        """
+        Test that streamed downloads are added to the metrics when the
+        stream is finished.
+        """
+        ids = range(1, 11)
+        records = list(self.engine.iter_records(ids, chunk_size=4))
+        assert ''.join(record for _, record in records) == self.records(ids)
+        summary = self.engine.metrics.summary()
+        assert summary['queries'] == 3
+        assert summary['bytes_downloaded'] > 0
+
+    def test_get_records_failures(self):
+        """
+        Test get_records with injected failures.
+        """
+        self.server.failure_rate = 0.2
+        for _ in xrange(5):
+            assert self.engine.get_records([2244]) == self.records([2244])
+
+    def test_streamed_queries(self):
+        """
+        Test PUG queries with streamed request bodies.
+        """
+        self.server.failure_rate = 0.2
+        self.engine.stream_threshold = 1
+        ids = range(1, 51)
+        assert self.engine.get_records(ids) == self.records(ids)
+        id_map = self.engine.id_exchange(['CHEMBL25', 'CHEMBL10'])
+        assert id_map == {'CHEMBL25': 25, 'CHEMBL10': None}
+
+    def test_journal_reattach(self):
+        """
+        Test reattaching to a journaled query after the submitting engine
+        is discarded.
+        """
+        self.server.job_time = 0.2
+        journal = JobJournal(':memory:')
+        engine = self.get_engine(AsyncPubChem, journal=journal)
+        query = engine.get_records([2244, 3672])
+        assert not query.done()
+        del query, engine  # journaled queries are not canceled
+        n_jobs = len(self.server.jobs)
+        engine = self.get_engine(journal=journal)
+        data = engine.get_records([2244, 3672])
+        assert data == self.records([2244, 3672])
+        assert len(self.server.jobs) == n_jobs  # reattached
+        assert len(journal) == 0  # removed after fetch
+
+    def submit_unfetched(self, journal, ids):
+        """
+        Run a journaled query to completion without fetching the result.
+        """
+        engine = self.get_engine(AsyncPubChem, journal=journal)
+        query = engine.get_records(ids)
+        wait([query])
+        assert journal.get(query.query_hash)['download_url'] is not None
+
+    def test_journal_reuse(self):
+        """
+        Test reusing and expiring journaled download URLs.
+        """
+        journal = JobJournal(':memory:')
+        engine = self.get_engine(journal=journal)
+        self.submit_unfetched(journal, [2244])
+        n_jobs = len(self.server.jobs)
+        assert engine.get_records([2244]) == self.records([2244])
+        assert len(self.server.jobs) == n_jobs  # reused download URL
+        assert len(journal) == 0
+        assert engine.get_records([2244]) == self.records([2244])
+        assert len(self.server.jobs) == n_jobs + 1  # not reused after fetch
+        self.submit_unfetched(journal, [2244])
+        self.server.jobs.clear()  # expire downloads
+        assert engine.get_records([2244]) == self.records([2244])
+        assert len(self.server.jobs) == 1  # submitted again
+
+    def test_get_records_segments(self):
+        """
+        Test get_records with parallel range downloads.
+        """
+        ids = range(1, 101)
+        filename = os.path.join(self.temp_dir, 'records.sdf.gz')
+        self.engine.get_records(ids, filename, n_segments=3)
+        with gzip.open(filename) as f:
+            assert f.read() == self.records(ids)
+
+    def test_get_records_chunks(self):
+        """
+        Test chunked get_records.
+        """
+        ids = range(1, 11)
+        data = self.engine.get_records(ids, chunk_size=3, max_in_flight=2)
+        assert data == self.records(ids)
+        filename = os.path.join(self.temp_dir, 'records.sdf.gz')
+        self.engine.get_records(ids, filename, chunk_size=3, max_in_flight=2)
+        with gzip.open(filename) as f:
+            assert f.read() == self.records(ids)
+
+    def test_get_records_chunks_timestamps(self):
+        """
+        Test chunked get_records when each response has its own record
+        timestamps.
+        """
+        self.server.timestamps = True
+        ids = range(1, 11)
+        ref = self.records(ids)
+        data = self.engine.get_records(ids, chunk_size=3, max_in_flight=2)
+        assert data != ref
+        assert identical_sdf(data, ref)
+        filename = os.path.join(self.temp_dir, 'records.sdf.gz')
+        self.engine.get_records(ids, filename, chunk_size=3, max_in_flight=2)
+        with gzip.open(filename) as f:
+            assert identical_sdf(f.read(), ref)
+        engine = self.get_engine(AsyncPubChem)
+        data = engine.gather([engine.get_records([cid]) for cid in ids[:2]])
+        assert identical_sdf(''.join(data), self.records(ids[:2]))
+        assert not identical_sdf(data[0], self.records([3]))
+
+    def test_get_records_stream(self):
+        """
+        Test get_records with stream=True.
+        """
+        with self.engine.get_records([2244, 3672], stream=True) as f:
+            assert ''.join(f) == self.records([2244, 3672])
+
+    def test_get_records_stream_chunks(self):
+        """
+        Test get_records with stream=True and chunk_size.
+        """
+        ids = range(1, 11)
+        with self.engine.get_records(ids, chunk_size=3, max_in_flight=2,
+                                     stream=True) as f:
+            assert f.read(10) == self.records(ids)[:10]
+            assert f.read() == self.records(ids)[10:]
+
+    def test_iter_records(self):
+        """
+        Test iter_records.
+        """
+        ids = range(1, 11)
+        records = list(self.engine.iter_records(ids, chunk_size=4,
+                                                max_in_flight=2))
+        assert [uid for uid, _ in records] == ids
+        assert ''.join(record for _, record in records) == self.records(ids)
+
+    def test_get_records_cache(self):
+        """
+        Test get_records with a record cache.
+        """
+        engine = self.get_engine(cache=RecordCache(':memory:'))
+        assert engine.get_records([1, 2]) == self.records([1, 2])
+        n_jobs = len(self.server.jobs)
+        assert engine.get_records([2, 1]) == self.records([2, 1])
+        assert len(self.server.jobs) == n_jobs  # no new PUG queries
+        assert engine.get_records([3, 1]) == self.records([3, 1])
+        assert len(engine.cache) == 3
+        assert engine.get_record(3) == self.records([3])
+
+    def test_async_gather_cache(self):
+        """
+        Test AsyncPubChem.gather with cached and chunked records.
+        """
+        engine = self.get_engine(AsyncPubChem, cache=RecordCache(':memory:'))
+        engine.gather([engine.get_records([1, 2])])
+        queries = [engine.get_records([2, 1]), engine.get_records([3])]
+        assert engine.gather(queries) == [self.records([2, 1]),
+                                          self.records([3])]
+        engine = self.get_engine(AsyncPubChem)
+        query = engine.get_records(range(1, 6), chunk_size=2)
+        assert engine.gather([query]) == [self.records(range(1, 6))]
+
+    def test_async_chunks(self):
+        """
+        Test that chunked AsyncPubChem downloads do not block and can be
+        gathered with other pending requests.
+        """
+        self.server.job_time = 0.5
+        engine = self.get_engine(AsyncPubChem)
+        ids = range(1, 11)
+        filename = os.path.join(self.temp_dir, 'records.sdf.gz')
+        start = time.time()
+        queries = [
+            engine.get_records(ids, chunk_size=3, max_in_flight=2),
+            engine.get_records(ids, filename, chunk_size=4, max_in_flight=4),
+            engine.get_records(ids, chunk_size=5, stream=True),
+            engine.get_parent_cids([4, 5, 7]),
+            engine.get_ids_from_assays([1, 2])]
+        assert time.time() - start < 0.4  # submission does not block
+        assert not queries[0].done()
+        results = engine.gather(queries)
+        assert results[0] == self.records(ids)
+        assert results[1] == filename
+        with gzip.open(filename) as f:
+            assert f.read() == self.records(ids)
+        with results[2] as f:
+            assert f.read() == self.records(ids)
+        assert results[3] == {3, 6}
+        expected = self.engine.get_ids_from_assays([1, 2])
+        assert sorted(results[4]) == [1, 2]
+        for aid in [1, 2]:
+            assert np.array_equal(results[4][aid], expected[aid])
+
+    def test_async_rest(self):
+        """
+        Test that AsyncPubChem REST lookups run in the background.
+        """
+        self.server.latency = 0.3
+        engine = self.get_engine(AsyncPubChem)
+        start = time.time()
+        call = engine.get_parent_cids([4, 5])
+        assert time.time() - start < 0.2
+        assert not call.done()
+        assert call.result() == {3}
+        call = engine.get_parent_cids([-1])
+        with self.assertRaises(ValueError):
+            call.result()
+
+    def test_get_record(self):
+        """
+        Test get_record.
+        """
+        assert self.engine.get_record(2244) == self.records([2244])
+        filename = os.path.join(self.temp_dir, 'record.sdf')
+        self.engine.get_record(2244, filename=filename)
+        with open(filename) as f:
+            assert f.read() == self.records([2244])
+
+    def test_get_records_rest(self):
+        """
+        Test get_records_rest, including batch size reduction.
+        """
+        self.server.max_batch_size = 4
+        ids = range(1, 21)
+        data = self.engine.get_records_rest(ids, batch_size=8, n_jobs=2)
+        assert data == self.records(ids)
+
+    def test_async_gather(self):
+        """
+        Test AsyncPubChem.gather.
+        """
+        self.server.job_time = 0.05
+        engine = self.get_engine(AsyncPubChem)
+        queries = [engine.get_records([uid]) for uid in xrange(1, 6)]
+        data = engine.gather(queries)
+        assert data == [self.records([uid]) for uid in xrange(1, 6)]
+
+    def test_get_parent_cids(self):
+        """
+        Test get_parent_cids.
+        """
+        parents = self.engine.get_parent_cids([4, 5, 6])
+        assert parents == {3}
+        assert self.engine.get_parent_cids(set([4, 5, 7])) == {3, 6}
+        assert self.engine.get_parent_cids(
+            cid for cid in [10 ** 8 + 3]) == {10 ** 8 + 1, 10 ** 8 + 2}
+        parents = self.engine.get_parent_cids([4, 5, 6], id_set=True)
+        assert parents == IDSet([3])
+        for cids in [[4, -1], [4, 2 ** 32], np.array([1.5])]:
+            with self.assertRaises(ValueError):
+                self.engine.get_parent_cids(cids)
+
+    def test_get_parent_cids_ordered(self):
+        """
+        Test get_parent_cids with aligned output and concurrent batches.
+        """
+        self.server.failure_rate = 0.1
+        cids = np.arange(1, 5001)[::-1]
+        parents = self.engine.get_parent_cids(cids, ordered=True,
+                                              batch_size=300, n_jobs=4,
+                                              max_attempts=10)
+        assert parents.dtype == np.uint32
+        assert np.array_equal(
+            parents, [self.server.parent(cid) for cid in cids])
+        assert self.engine.get_parent_cids([], ordered=True).size == 0
+        parents = self.engine.get_parent_cids([7, 6, 7, 4], ordered=True)
+        assert np.array_equal(parents, [6, 0, 6, 3])
+        with self.assertRaises(PUGError):
+            self.engine.get_parent_cids([4, 10 ** 8 + 3], ordered=True)
+
+    def test_get_ids_from_assay(self):
+        """
+        Test get_ids_from_assay.
+        """
+        for sids in [False, True]:
+            for outcome in [None, 'active', 'inactive']:
+                ids = self.engine.get_ids_from_assay(466, sids, outcome)
+                ref = self.server.assay_ids(466, sids, outcome)
+                assert np.array_equal(ids, ref)
+
+    def test_get_ids_from_assays(self):
+        """
+        Test get_ids_from_assays.
+        """
+        aids = [466, 467, 468, 469]
+        ids = self.engine.get_ids_from_assays(aids, activity_outcome='active',
+                                              n_jobs=2)
+        assert sorted(ids) == aids
+        for aid in aids:
+            ref = self.server.assay_ids(aid, False, 'active')
+            assert ids[aid].dtype == np.int64
+            assert np.array_equal(ids[aid], ref)
+        id_sets = self.engine.get_ids_from_assays(aids, n_jobs=2, id_set=True)
+        for aid in aids:
+            assert id_sets[aid] == IDSet(self.server.assay_ids(aid))
+        active = self.engine.get_ids_from_assay(466, activity_outcome='active',
+                                                id_set=True)
+        assert active.issubset(id_sets[466])
+
+    def test_get_assay_data(self):
+        """
+        Test get_assay_data.
+        """
+        data = self.engine.get_assay_data(466)
+        assert data == self.server.assay_table(466)
+
+    def test_iter_assay_data(self):
+        """
+        Test iter_assay_data and get_assay_table.
+        """
+        chunks = list(self.engine.iter_assay_data(466, chunk_size=30))
+        assert [len(chunk) for chunk in chunks] == [30, 30, 30, 10]
+        table = self.engine.get_assay_table(466, ['PUBCHEM_SID', 'Potency'])
+        assert np.array_equal(np.concatenate(chunks)['PUBCHEM_SID'],
+                              table['PUBCHEM_SID'])
+        assert np.array_equal(table['PUBCHEM_SID'],
+                              self.server.assay_ids(466, sids=True))
+        assert np.isnan(table['Potency'][1])
+
+    def test_get_assay_descriptions(self):
+        """
+        Test get_assay_descriptions, including batch size reduction.
+        """
+        self.server.max_batch_size = 2
+        aids = [490, 466, 9, 548, 851]
+        data = self.engine.get_assay_descriptions(aids, batch_size=4)
+        assert [desc['aid']['id'] for desc in data] == aids
+
+    def test_get_assay_descriptions_threads(self):
+        """
+        Test get_assay_descriptions with concurrent requests and failures.
+        """
+        self.server.max_batch_size = 30
+        self.server.failure_rate = 0.1
+        aids = range(1000, 0, -1)
+        data = self.engine.get_assay_descriptions(aids, batch_size=50,
+                                                  n_jobs=4, max_attempts=10)
+        assert [desc['aid']['id'] for desc in data] == aids
+
+    def test_dropped_connections(self):
+        """
+        Test that REST requests are retried after network errors.
+        """
+        self.server.drop_rate = 0.2
+        ids = range(1, 21)
+        data = self.engine.get_records_rest(ids, batch_size=2, n_jobs=2,
+                                            max_attempts=10)
+        assert data == self.records(ids)
+        parents = self.engine.get_parent_cids(range(4, 14), batch_size=2,
+                                              max_attempts=10)
+        assert parents == {3, 6, 9, 12}
+        aids = range(1, 41)
+        data = self.engine.get_assay_descriptions(aids, batch_size=2,
+                                                  n_jobs=2, max_attempts=10)
+        assert [desc['aid']['id'] for desc in data] == aids
+
+    def test_closed_port(self):
+        """
+        Test that requests to a closed port raise urllib2.URLError.
+        """
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        engine = self.get_engine(
+            rest_url='http://127.0.0.1:{}/rest/pug'.format(port))
+        with self.assertRaises(urllib2.URLError):
+            engine.get_record(2244)
+        with self.assertRaises(urllib2.URLError):
+            engine.get_parent_cids([4, 5])
+
+    def test_id_exchange(self):
+        """
+        Test id_exchange.
+        """
+        id_map = self.engine.id_exchange(['CHEMBL25', 'CHEMBL10'])
+        assert id_map == {'CHEMBL25': 25, 'CHEMBL10': None}
+
+    def test_id_exchange_chunks(self):
+        """
+        Test id_exchange with concurrent chunked queries and a mapping
+        store.
+        """
+        store = MappingStore(':memory:')
+        engine = self.get_engine(mapping_store=store)
+        ids = ['CHEMBL{}'.format(i) for i in xrange(1, 51)]
+        id_map = engine.id_exchange(ids, chunk_size=7, max_in_flight=3)
+        expected = dict((source_id, self.server.exchange(source_id))
+                        for source_id in ids)
+        assert id_map == expected
+        assert len(store) == 45  # unmatched IDs are not stored
+        n_jobs = len(self.server.jobs)
+        id_map = engine.id_exchange(ids[:20], chunk_size=7)
+        assert id_map == dict((source_id, expected[source_id])
+                              for source_id in ids[:20])
+        assert len(self.server.jobs) == n_jobs + 1  # only unmatched IDs
+
+    def test_structure_search(self):
+        """
+        Test structure_search.
+        """
+        self.server.job_time = 0.05
+        smiles = 'CC(=O)OC1=CC=CC=C1C(=O)O'
+        cid = self.engine.structure_search(smiles)
+        assert cid == self.server.structure_cid(smiles)
+
+    def test_async_structure_search(self):
+        """
+        Test AsyncPubChem.structure_search with gather.
+        """
+        self.server.job_time = 0.1
+        engine = self.get_engine(AsyncPubChem)
+        smiles = ['C', 'CC', 'C*']
+        start = time.time()
+        searches = [engine.structure_search(structure) for structure in smiles]
+        assert time.time() - start < 0.1  # submission does not block
+        queries = searches + [engine.get_records([2244])]
+        results = engine.gather(queries)
+        assert results[:3] == [self.server.structure_cid(structure)
+                               for structure in smiles]
+        assert results[3] == self.records([2244])
+
+    def test_structure_search_many(self):
+        """
+        Test structure_search_many.
+        """
+        self.server.job_time = 0.05
+        self.server.failure_rate = 0.1
+        structures = ['C' * i for i in xrange(1, 21)] + ['C*']
+        engine = self.get_engine(delay=ExponentialBackoff(0.01))
+        cids = engine.structure_search_many(structures, max_in_flight=5,
+                                            n_jobs=3, max_attempts=10)
+        assert cids == [self.server.structure_cid(structure)
+                        for structure in structures]
+        assert cids[-1] is None
+
+    def test_structure_search_server_errors(self):
+        """
+        Test that status checks that keep failing raise an error instead of
+        polling forever.
+        """
+        self.server.job_time = 0.05
+        self.server.failure_rate = 1
+        self.server.failure_path = '/rest/pug/compound/listkey/'
+        engine = self.get_engine(delay=ExponentialBackoff(0.01))
+        self.assertRaises(urllib2.HTTPError, engine.structure_search_many,
+                          ['C', 'CC'])
+        self.assertRaises(urllib2.HTTPError, engine.structure_search, 'C')
+        engine = self.get_engine(AsyncPubChem, delay=ExponentialBackoff(0.01))
+        search = engine.structure_search('C')
+        self.assertRaises(urllib2.HTTPError, engine.gather, [search])
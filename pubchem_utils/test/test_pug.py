@@ -0,0 +1,90 @@
+"""
+Tests for pug.py.
+"""
+from StringIO import StringIO
+import unittest
+
+from ..pug import (ExponentialBackoff, FixedDelay, get_polling_policy,
+                   parse_response, parse_throttling, PUGError)
+from .server import pug_response
+
+
+class TestPollingPolicy(unittest.TestCase):
+    """
+    Tests for PUG polling policies.
+    """
+    def test_fixed_delay(self):
+        """
+        Test FixedDelay.
+        """
+        policy = get_polling_policy(3)
+        assert isinstance(policy, FixedDelay)
+        assert policy.get_delay(0) == policy.get_delay(10) == 3
+
+    def test_exponential_backoff(self):
+        """
+        Test ExponentialBackoff without jitter.
+        """
+        policy = ExponentialBackoff(initial=1, factor=2, max_delay=10,
+                                    jitter=0)
+        assert get_polling_policy(policy) is policy
+        delays = [policy.get_delay(i) for i in range(6)]
+        assert delays == [1, 2, 4, 8, 10, 10], delays
+
+    def test_exponential_backoff_jitter(self):
+        """
+        Test ExponentialBackoff with jitter.
+        """
+        policy = ExponentialBackoff(initial=4, jitter=0.25)
+        for _ in range(100):
+            assert 3 <= policy.get_delay(0) <= 5
+
+
+class TestParseResponse(unittest.TestCase):
+    """
+    Tests for parse_response.
+    """
+    def test_waiting(self):
+        """
+        Test a response for a queued request.
+        """
+        response = parse_response(StringIO(pug_response(
+            'queued', reqid='123',
+            message='Your request is queued at position 7.')))
+        assert response.status == 'queued'
+        assert response.reqid == '123'
+        assert response.download_url is None
+        assert response.messages == ['Your request is queued at position 7.']
+        assert response.queue_position == 7
+
+    def test_download_url(self):
+        """
+        Test a response for a completed request.
+        """
+        response = parse_response(StringIO(pug_response(
+            'success', download_url='ftp://example.com/1.sdf.gz')))
+        assert response.status == 'success'
+        assert response.download_url == 'ftp://example.com/1.sdf.gz'
+        assert response.reqid is None
+        assert response.queue_position is None
+
+    def test_invalid(self):
+        """
+        Test responses that cannot be parsed.
+        """
+        with self.assertRaises(PUGError):
+            parse_response(StringIO('<html>Service unavailable'))
+        with self.assertRaises(PUGError):
+            parse_response(StringIO('<PCT-Data></PCT-Data>'))
+
+    def test_throttling(self):
+        """
+        Test parse_throttling.
+        """
+        throttling = parse_throttling(
+            'Request Count status: Green (0%), Request Time status: '
+            'Yellow (55%), Service status: Red (80%)')
+        assert throttling == {'Request Count': ('Green', 0),
+                              'Request Time': ('Yellow', 55),
+                              'Service': ('Red', 80)}
+        assert parse_throttling(None) == {}
@@ -0,0 +1,76 @@
+"""
+Tests for queries.py.
+"""
+import numpy as np
+import unittest
+
+from ..queries import (assay_data_query, cancel_query, download_query,
+                       get_id_elements_length, id_exchange_query,
+                       iter_id_elements, status_query)
+
+
+class TestQueries(unittest.TestCase):
+    """
+    Tests for PUG query construction.
+    """
+    def test_iter_id_elements(self):
+        """
+        Test iter_id_elements and get_id_elements_length.
+        """
+        ids = [1, 22, 333, 1000, 99999, 1000000000]
+        ref = ''.join('<E>{}</E>\n'.format(uid) for uid in ids)
+        for chunk_size in [1, 4, 100]:
+            assert ''.join(iter_id_elements(ids, 'E', chunk_size)) == ref
+        assert get_id_elements_length(ids, 'E') == len(ref)
+        assert get_id_elements_length(np.asarray(ids), 'E') == len(ref)
+        names = ['CHEMBL25', 'CHEMBL1']
+        assert get_id_elements_length(names, 'E') == len(
+            ''.join(iter_id_elements(names, 'E')))
+        assert get_id_elements_length([], 'E') == 0
+
+    def test_download_query(self):
+        """
+        Test download_query.
+        """
+        query = download_query(np.arange(1, 4), sids=True, use_3d=True,
+                               n_conformers=5)
+        assert '<PCT-ID-List_db>pcsubstance</PCT-ID-List_db>' in query
+        assert ('<PCT-ID-List_uids_E>2</PCT-ID-List_uids_E>\n'
+                '<PCT-ID-List_uids_E>3</PCT-ID-List_uids_E>') in query
+        assert '<PCT-Download_use-3d value="true"/>' in query
+        with self.assertRaises(AssertionError):
+            download_query([1], download_format='pdb')
+
+    def test_stream(self):
+        """
+        Test streamed query bodies.
+        """
+        ids = range(1, 200000, 3)
+        query = download_query(ids)
+        body = download_query(ids, stream=True)
+        assert len(body) == len(query)
+        assert str(body) == query
+        chunks = []
+        while True:
+            data = body.read(8192)
+            if not data:
+                break
+            chunks.append(data)
+        assert ''.join(chunks) == query
+        body.seek(0)
+        assert body.read() == query
+
+    def test_other_queries(self):
+        """
+        Test assay data, identifier exchange, status and cancel queries.
+        """
+        query = assay_data_query(466, concise=True)
+        assert '<PCT-ID-List_uids_E>466</PCT-ID-List_uids_E>' in query
+        assert 'value="concise"' in query
+        query = id_exchange_query(['CHEMBL25'], 'ChEMBL')
+        assert ('<PCT-RegistryIDs_source-ids_E>CHEMBL25'
+                '</PCT-RegistryIDs_source-ids_E>') in query
+        assert '>ChEMBL</PCT-RegistryIDs_source-name>' in query
+        assert '<PCT-Request_reqid>123</PCT-Request_reqid>' in status_query(
+            123)
+        assert 'value="cancel"' in cancel_query(123)
@@ -0,0 +1,110 @@
+"""
+Tests for ratelimit.py.
+"""
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from ..ratelimit import FileRateLimiter, RateLimiter
+
+
+def run_threads(target, n_threads):
+    """
+    Run a function in several threads and return the elapsed time.
+
+    Parameters
+    ----------
+    target : callable
+        Function to run in each thread.
+    n_threads : int
+        Number of threads.
+    """
+    threads = [threading.Thread(target=target) for _ in xrange(n_threads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+
+class TestRateLimiter(unittest.TestCase):
+    """
+    Tests for RateLimiter.
+    """
+    def test_burst(self):
+        """
+        Test that a full bucket does not block.
+        """
+        limiter = RateLimiter(10, burst=5)
+        start = time.time()
+        for _ in xrange(5):
+            assert limiter.acquire() == 0
+        assert time.time() - start < 0.05
+        assert limiter.acquire() > 0
+
+    def test_threads(self):
+        """
+        Test that threads share the request budget.
+        """
+        limiter = RateLimiter(100, burst=1)
+
+        def target():
+            for _ in xrange(10):
+                limiter.acquire()
+        elapsed = run_threads(target, 4)
+        assert 0.35 < elapsed < 1  # 40 requests at 100 per second
+
+    def test_pickle(self):
+        """
+        Test pickling.
+        """
+        limiter = pickle.loads(pickle.dumps(RateLimiter(5)))
+        assert limiter.rate == 5
+        limiter.acquire()
+
+    def test_invalid_rate(self):
+        """
+        Test that non-positive rates are rejected.
+        """
+        with self.assertRaises(ValueError):
+            RateLimiter(0)
+
+
+class TestFileRateLimiter(unittest.TestCase):
+    """
+    Tests for FileRateLimiter.
+    """
+    def setUp(self):
+        """
+        Set up tests.
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'bucket')
+
+    def tearDown(self):
+        """
+        Clean up tests.
+        """
+        shutil.rmtree(self.temp_dir)
+
+    def test_shared(self):
+        """
+        Test that limiters using the same file share the request budget.
+        """
+        limiters = [FileRateLimiter(self.filename, 100, burst=1)
+                    for _ in xrange(2)]
+        limiters.append(pickle.loads(pickle.dumps(limiters[0])))
+        lock = threading.Lock()
+
+        def target():
+            with lock:
+                limiter = limiters.pop()
+            for _ in xrange(10):
+                limiter.acquire()
+        elapsed = run_threads(target, 3)
+        assert 0.25 < elapsed < 1  # 30 requests at 100 per second
@@ -0,0 +1,338 @@
+"""
+Tests for streaming.py.
+"""
+import bz2
+import gzip
+import numpy as np
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+import unittest
+
+from ..streaming import (ChainedReader, DecompressingReader, iter_assay_table,
+                         iter_sdf_records, lzma, read_assay_table,
+                         read_int_array, read_sdf_records)
+
+
+class TestDecompressingReader(unittest.TestCase):
+    """
+    Tests for DecompressingReader.
+    """
+    def setUp(self):
+        """
+        Set up tests.
+        """
+        self.lines = ['record {}\n'.format(i) for i in xrange(1000)]
+        self.data = ''.join(self.lines)
+
+    def gzip(self, data):
+        """
+        Compress data with gzip.
+
+        Parameters
+        ----------
+        data : str
+            Data to compress.
+        """
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(data)
+        return buf.getvalue()
+
+    def check(self, compressed, compression):
+        """
+        Check reads, line iteration and chunk iteration.
+
+        Parameters
+        ----------
+        compressed : str
+            Compressed data.
+        compression : str
+            Compression type.
+        """
+        reader = DecompressingReader(StringIO(compressed), compression,
+                                     chunk_size=100)
+        assert reader.read() == self.data
+        reader = DecompressingReader(StringIO(compressed), compression,
+                                     chunk_size=100)
+        assert list(reader) == self.lines
+        reader = DecompressingReader(StringIO(compressed), compression,
+                                     chunk_size=100)
+        assert reader.readline() == self.lines[0]
+        chunks = list(reader.iter_chunks(64))
+        assert max(len(chunk) for chunk in chunks) == 64
+        assert ''.join(chunks) == ''.join(self.lines[1:])
+
+    def test_none(self):
+        """
+        Test uncompressed data.
+        """
+        self.check(self.data, None)
+        self.check(self.data, 'none')
+
+    def test_gzip(self):
+        """
+        Test gzip data.
+        """
+        self.check(self.gzip(self.data), 'gzip')
+
+    def test_gzip_members(self):
+        """
+        Test concatenated gzip members.
+        """
+        self.check(self.gzip(self.data[:5000]) + self.gzip(self.data[5000:]),
+                   'gzip')
+
+    def test_bzip2(self):
+        """
+        Test bzip2 data.
+        """
+        self.check(bz2.compress(self.data), 'bzip2')
+
+    def test_bzip2_streams(self):
+        """
+        Test concatenated bzip2 streams.
+        """
+        self.check(bz2.compress(self.data[:5000]) +
+                   bz2.compress(self.data[5000:]), 'bzip2')
+
+    @unittest.skipIf(lzma is None, 'lzma is not available.')
+    def test_xz_streams(self):
+        """
+        Test concatenated xz streams.
+        """
+        self.check(lzma.compress(self.data[:5000]) +
+                   lzma.compress(self.data[5000:]), 'xz')
+
+
+class TestChainedReader(unittest.TestCase):
+    """
+    Tests for ChainedReader.
+    """
+    def setUp(self):
+        """
+        Set up tests.
+        """
+        self.parts = ['a\nb', '', 'c\nd\n', 'e']
+
+    def get_reader(self):
+        """
+        Get a reader over the parts.
+        """
+        return ChainedReader(StringIO(part) for part in self.parts)
+
+    def test_read(self):
+        """
+        Test read.
+        """
+        f = self.get_reader()
+        assert f.read(2) == 'a\n'
+        assert f.read(3) == 'bc\n'
+        assert f.read() == 'd\ne'
+        assert f.read() == ''
+
+    def test_readline(self):
+        """
+        Test line iteration.
+        """
+        assert list(self.get_reader()) == ['a\n', 'b', 'c\n', 'd\n', 'e']
+
+    def test_close(self):
+        """
+        Test that streams are closed.
+        """
+        streams = [StringIO(part) for part in self.parts]
+        with ChainedReader(streams) as f:
+            assert f.read(4) == 'a\nbc'
+        assert [stream.closed for stream in streams] == [True, True, True,
+                                                         False]
+
+
+class TestSdfRecords(unittest.TestCase):
+    """
+    Tests for iter_sdf_records and read_sdf_records.
+    """
+    def setUp(self):
+        """
+        Set up tests.
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        self.records = []
+        for cid in [2244, 3672]:
+            self.records.append(
+                '{0}\n  -OEChem-\n\n  0  0  0     0  0  0  0  0  0999 V2000\n'
+                'M  END\n> <PUBCHEM_COMPOUND_CID>\n{0}\n\n$$$$\n'.format(
+                    cid))
+        self.data = ''.join(self.records)
+
+    def tearDown(self):
+        """
+        Clean up tests.
+        """
+        shutil.rmtree(self.temp_dir)
+
+    def test_iter_sdf_records(self):
+        """
+        Test iter_sdf_records.
+        """
+        records = list(iter_sdf_records(StringIO(self.data)))
+        assert records == zip([2244, 3672], self.records)
+
+    def test_iter_sdf_records_title(self):
+        """
+        Test iter_sdf_records with IDs from record titles.
+        """
+        records = list(iter_sdf_records(StringIO(self.data), sids=True))
+        assert [uid for uid, _ in records] == [2244, 3672]
+
+    def test_read_sdf_records(self):
+        """
+        Test read_sdf_records with a gzipped file.
+        """
+        filename = os.path.join(self.temp_dir, 'records.sdf.gz')
+        with gzip.open(filename, 'wb') as f:
+            f.write(self.data)
+        records = list(read_sdf_records(filename))
+        assert records == zip([2244, 3672], self.records)
+
+
+class TestReadIntArray(unittest.TestCase):
+    """
+    Tests for read_int_array.
+    """
+    def test_chunks(self):
+        """
+        Test that numbers split across chunks are parsed correctly.
+        """
+        ids = np.arange(0, 100000, 7, dtype=np.int64) ** 2
+        data = ''.join('{}\n'.format(uid) for uid in ids)
+        for chunk_size in [1, 5, 1000]:
+            parsed = read_int_array(StringIO(data), chunk_size=chunk_size)
+            assert parsed.dtype == np.int64
+            assert np.array_equal(parsed, ids)
+
+    def test_no_trailing_newline(self):
+        """
+        Test input without a trailing newline.
+        """
+        parsed = read_int_array(StringIO('1\n22\n333'), chunk_size=4)
+        assert np.array_equal(parsed, [1, 22, 333])
+
+    def test_empty(self):
+        """
+        Test empty input.
+        """
+        assert read_int_array(StringIO('')).size == 0
+
+    def test_dtype(self):
+        """
+        Test conversion to a narrower dtype, including range checks.
+        """
+        parsed = read_int_array(StringIO('1\n4294967295\n'), np.uint32)
+        assert parsed.dtype == np.uint32
+        assert np.array_equal(parsed, [1, 4294967295])
+        with self.assertRaises(ValueError):
+            read_int_array(StringIO('-1\n'), np.uint32)
+
+    def test_int64_range(self):
+        """
+        Test that values that do not fit in int64 raise ValueError.
+        """
+        limits = '9223372036854775807\n-9223372036854775808\n'
+        assert np.array_equal(read_int_array(StringIO(limits)),
+                              [2 ** 63 - 1, -2 ** 63])
+        for data in ['1\n99999999999999999999\n', '9223372036854775808\n',
+                     '-9223372036854775809\n']:
+            with self.assertRaises(ValueError):
+                read_int_array(StringIO(data))
+
+    def test_invalid(self):
+        """
+        Test that non-integer data raises ValueError.
+        """
+        with self.assertRaises(ValueError):
+            read_int_array(StringIO('1\n2.5\n'))
+
+    def test_invalid_minus(self):
+        """
+        Test that misplaced minus signs raise ValueError.
+        """
+        for data in ['1-2\n', '--5\n', '3\n-\n']:
+            with self.assertRaises(ValueError):
+                read_int_array(StringIO(data))
+        assert np.array_equal(read_int_array(StringIO('-1\n2\n')), [-1, 2])
+
+
+class TestIterAssayTable(unittest.TestCase):
+    """
+    Tests for iter_assay_table.
+    """
+    def setUp(self):
+        """
+        Set up tests.
+        """
+        self.temp_dir = tempfile.mkdtemp()
+        self.data = ('PUBCHEM_RESULT_TAG,PUBCHEM_SID,PUBCHEM_CID,'
+                     'PUBCHEM_ACTIVITY_OUTCOME,PUBCHEM_ACTIVITY_SCORE,'
+                     'Potency,Phenotype,Count\n')
+        self.data += """RESULT_TYPE,,,,,FLOAT,STRING,INTEGER
+RESULT_UNIT,,,,,MICROMOLAR,,
+1,11,2244,Active,90,0.5,"Inhibitor, weak",3
+2,12,,Inactive,,,Inactive,
+3,13,3672,3,10,,Inconclusive,1
+"""
+
+    def tearDown(self):
+        """
+        Clean up tests.
+        """
+        shutil.rmtree(self.temp_dir)
+
+    def test_default_columns(self):
+        """
+        Test default columns and chunking.
+        """
+        chunks = list(iter_assay_table(StringIO(self.data), chunk_size=2))
+        assert [len(chunk) for chunk in chunks] == [2, 1]
+        table = np.concatenate(chunks)
+        assert table.dtype.names == ('PUBCHEM_SID', 'PUBCHEM_CID',
+                                     'PUBCHEM_ACTIVITY_OUTCOME',
+                                     'PUBCHEM_ACTIVITY_SCORE')
+        assert np.array_equal(table['PUBCHEM_SID'], [11, 12, 13])
+        assert np.array_equal(table['PUBCHEM_CID'], [2244, 0, 3672])
+        assert np.array_equal(table['PUBCHEM_ACTIVITY_OUTCOME'], [2, 1, 3])
+        assert table['PUBCHEM_ACTIVITY_SCORE'][0] == 90
+        assert np.isnan(table['PUBCHEM_ACTIVITY_SCORE'][1])
+
+    def test_columns(self):
+        """
+        Test selected columns typed by the RESULT_TYPE row.
+        """
+        table, = iter_assay_table(StringIO(self.data),
+                                  ['Phenotype', 'Potency', 'Count'])
+        assert table.dtype['Phenotype'] == object
+        assert table.dtype['Potency'] == np.float64
+        assert table.dtype['Count'] == np.int64
+        assert list(table['Phenotype']) == ['Inhibitor, weak', 'Inactive',
+                                            'Inconclusive']
+        assert np.array_equal(table['Count'], [3, 0, 1])
+        with self.assertRaises(ValueError):
+            list(iter_assay_table(StringIO(self.data), ['Efficacy']))
+
+    def test_empty(self):
+        """
+        Test a table without rows.
+        """
+        table, = iter_assay_table(StringIO(self.data.split('\n', 1)[0]))
+        assert len(table) == 0
+
+    def test_read_assay_table(self):
+        """
+        Test read_assay_table with a gzipped file.
+        """
+        filename = os.path.join(self.temp_dir, 'data.csv.gz')
+        with gzip.open(filename, 'wb') as f:
+            f.write(self.data)
+        table, = read_assay_table(filename)
+        assert np.array_equal(table['PUBCHEM_SID'], [11, 12, 13])